@@ -0,0 +1,472 @@
+# pylint: disable=line-too-long
+# pylint: disable=bad-whitespace
+# pylint: disable=invalid-name
+
+"""Microbenchmarks for Pymarquise's write paths.
+
+Run with `make bench` against the installed libmarquise, or with `make
+bench-stub` against the stub library in stub/, which throws writes away
+(or spools them to a tmpfs), leaving only the Python and FFI costs. The
+numbers are only meaningful relative to each other on the same host, so
+compare before and after a change:
+
+    python bench_pymarquise.py --json before.json
+    python bench_pymarquise.py --json after.json
+    python bench_pymarquise.py --compare before.json after.json
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+import subprocess
+import json
+import timeit
+import argparse
+import platform
+import socket
+import threading
+from marquise import Marquise
+from marquise.pool import MarquisePool
+from marquise.trace import Tracer
+from marquise.index import SourceIndex
+from marquise.identifier import SourceIdentifier
+from marquise.clock import CoarseClock
+from marquise import ingestd
+
+BENCH_NAMESPACE = "benchpymarquise"
+BENCH_ADDRESS   = 5753895591108871589
+
+
+# Every result reported, for --json.
+RESULTS = []
+
+def report(name, seconds, iterations, nbytes=None):
+    """Print one line of results for a benchmark, and keep it for --json."""
+    result = {'name': name, 'ns_per_op': seconds / iterations * 1e9, 'ops_per_sec': iterations / seconds}
+    line = "%-40s %12.1f ns/op %12.0f ops/sec" % (name, result['ns_per_op'], result['ops_per_sec'])
+    if nbytes is not None:
+        result['mib_per_sec'] = nbytes * iterations / seconds / (1024 * 1024)
+        line += " %10.1f MiB/sec" % result['mib_per_sec']
+    RESULTS.append(result)
+    print(line)
+
+
+def best_of(function, iterations, repeat=5):
+    """Return the fastest of `repeat` timings of `iterations` calls."""
+    return min(timeit.repeat(function, number=iterations, repeat=repeat))
+
+
+def bench_hash_identifier(iterations=200000):
+    """Measure hash_identifier for short and long identifiers."""
+    for identifier in ("hostname:fe1.example.com,metric:BytesUsed,service:memory,", "x" * 4096):
+        seconds = best_of(lambda: Marquise.hash_identifier(identifier), iterations)
+        report("hash_identifier %dB" % len(identifier), seconds, iterations)
+
+
+def bench_send_simple(iterations=200000):
+    """Measure send_simple with and without a timestamp."""
+    marq = Marquise(BENCH_NAMESPACE)
+    seconds = best_of(lambda: marq.send_simple(BENCH_ADDRESS, 1234567890, 42), iterations)
+    report("send_simple", seconds, iterations)
+    seconds = best_of(lambda: marq.send_simple(BENCH_ADDRESS, None, 42), iterations)
+    report("send_simple, no timestamp", seconds, iterations)
+    marq.close()
+
+
+def bench_clock(iterations=500000):
+    """Measure reading the system clock and a coarse clock, and
+    send_simple stamped by each.
+    """
+    seconds = best_of(lambda: int(time.time() * 1000000000), iterations)
+    report("float time.time() * 1e9", seconds, iterations)
+    seconds = best_of(lambda: Marquise.current_timestamp(), iterations)
+    report("current_timestamp, system clock", seconds, iterations)
+    clock = CoarseClock()
+    seconds = best_of(lambda: clock.now(), iterations)
+    report("current_timestamp, coarse clock (%gs tick)" % clock.tick, seconds, iterations)
+    for name, marq in (("system clock", Marquise(BENCH_NAMESPACE)), ("coarse clock", Marquise(BENCH_NAMESPACE, clock=clock))):
+        seconds = best_of(lambda: marq.send_simple(BENCH_ADDRESS, None, 42), iterations // 2)
+        report("send_simple, no timestamp, %s" % name, seconds, iterations // 2)
+        marq.close()
+    clock.close()
+
+
+def bench_send_extended(iterations=100000):
+    """Measure send_extended with small text and binary payloads."""
+    marq = Marquise(BENCH_NAMESPACE)
+    text = "x" * 32
+    binary = b"x" * 32
+    seconds = best_of(lambda: marq.send_extended(BENCH_ADDRESS, 1234567890, text), iterations)
+    report("send_extended str 32B", seconds, iterations, len(text))
+    seconds = best_of(lambda: marq.send_extended(BENCH_ADDRESS, 1234567890, binary), iterations)
+    report("send_extended bytes 32B", seconds, iterations, len(binary))
+    marq.close()
+
+
+def bench_update_source(iterations=20000):
+    """Measure update_source for small and large source dicts, with the
+    source cache off so every call reaches libmarquise.
+    """
+    marq = Marquise(BENCH_NAMESPACE)
+    for n_keys in (4, 200):
+        source_dict = dict([ ("key%d" % i, "value%d" % i) for i in range(n_keys) ])
+        seconds = best_of(lambda: marq.update_source(BENCH_ADDRESS, source_dict), iterations, repeat=3)
+        report("update_source %d keys" % n_keys, seconds, iterations)
+    marq.close()
+
+
+def bench_init_close(iterations=2000):
+    """Measure opening and closing a handle, which creates spool files."""
+    seconds = best_of(lambda: Marquise(BENCH_NAMESPACE).close(), iterations, repeat=3)
+    report("Marquise init and close", seconds, iterations)
+
+
+def compare(before_path, after_path):
+    """Print the change in ns/op of every benchmark in two --json files."""
+    with open(before_path) as before_file:
+        before = dict([ (result['name'], result) for result in json.load(before_file)['results'] ])
+    with open(after_path) as after_file:
+        after = json.load(after_file)['results']
+    for result in after:
+        old = before.get(result['name'])
+        if old is None:
+            print("%-40s %12.1f ns/op          new" % (result['name'], result['ns_per_op']))
+            continue
+        change = (result['ns_per_op'] - old['ns_per_op']) / old['ns_per_op'] * 100
+        print("%-40s %12.1f ns/op %+11.1f%%" % (result['name'], result['ns_per_op'], change))
+
+
+def bench_send_extended_large(iterations=2000):
+    """Compare the text and zero-copy binary send_extended paths for
+    payloads of 64 KiB and up.
+    """
+    marq = Marquise(BENCH_NAMESPACE)
+    for size in (64 * 1024, 256 * 1024, 1024 * 1024):
+        text = "x" * size
+        binary = b"x" * size
+        seconds = timeit.timeit(lambda: marq.send_extended(BENCH_ADDRESS, 1234567890, text), number=iterations)
+        report("send_extended str %dKiB" % (size // 1024), seconds, iterations, size)
+        seconds = timeit.timeit(lambda: marq.send_extended(BENCH_ADDRESS, 1234567890, binary), number=iterations)
+        report("send_extended bytes %dKiB" % (size // 1024), seconds, iterations, size)
+        seconds = timeit.timeit(lambda: marq.send_extended(BENCH_ADDRESS, 1234567890, memoryview(binary)), number=iterations)
+        report("send_extended memoryview %dKiB" % (size // 1024), seconds, iterations, size)
+    marq.close()
+
+
+class EagerDebugMarquise(Marquise):
+
+    """
+    A Marquise whose writes format their debug messages the way they did
+    before tracing hooks: on every call, then thrown away unless debug
+    output is enabled.
+    """
+
+    def eager_debug(self, msg):
+        """Print `msg` if debug output is enabled, as the old writes did."""
+        if self.debug_enabled:
+            print("DEBUG: %s" % msg)
+
+    def send_simple(self, address, timestamp, value):
+        self.eager_debug("Supplied address: %s" % address)
+        success = Marquise.send_simple(self, address, timestamp, value)
+        self.eager_debug("send_simple returned %d" % success)
+        return success
+
+    def send_extended(self, address, timestamp, value):
+        self.eager_debug("Supplied address: %s" % address)
+        self.eager_debug("Sending extended value '%s' with length of %d" % (value, len(value)))
+        success = Marquise.send_extended(self, address, timestamp, value)
+        self.eager_debug("send_extended returned %d" % success)
+        return success
+
+
+def bench_tracing(iterations=200000):
+    """Compare send_simple and send_extended with tracing off, with a
+    hook sampling 1 in 100 writes, and with a hook on every write,
+    against the same writes formatting their debug messages eagerly, as
+    they did before tracing.
+    """
+    def noop_hook(event, fields):
+        """Throw an event away."""
+        pass
+
+    value = "x" * 4096
+    for name, marq in (
+            ("tracing off", Marquise(BENCH_NAMESPACE)),
+            ("hook, 1 in 100", Marquise(BENCH_NAMESPACE, tracer=Tracer([noop_hook], sample_every=100))),
+            ("hook, every write", Marquise(BENCH_NAMESPACE, tracer=Tracer([noop_hook]))),
+            ("eager debug", EagerDebugMarquise(BENCH_NAMESPACE))):
+        seconds = best_of(lambda: marq.send_simple(BENCH_ADDRESS, 1234567890, 42), iterations)
+        report("send_simple, %s" % name, seconds, iterations)
+        seconds = best_of(lambda: marq.send_extended(BENCH_ADDRESS, 1234567890, value), iterations // 10)
+        report("send_extended 4KiB, %s" % name, seconds, iterations // 10)
+        marq.close()
+
+
+def bench_import_time(iterations=20):
+    """Measure the wall time of starting an interpreter that imports
+    marquise, against one that imports nothing.
+    """
+    for name, code in (("bare interpreter", "pass"), ("import marquise", "import marquise")):
+        timings = []
+        for _ in range(iterations):
+            start = time.time()
+            subprocess.check_call([sys.executable, "-c", code])
+            timings.append(time.time() - start)
+        timings.sort()
+        print("%-40s %12.1f ms median %9.1f ms max" % (name, timings[len(timings) // 2] * 1e3, timings[-1] * 1e3))
+
+
+def run_threads(n_threads, target):
+    """Run `target` in `n_threads` threads at once, return the elapsed seconds."""
+    threads = [ threading.Thread(target=target) for _ in range(n_threads) ]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.time() - start
+
+
+def bench_pool_threads(points_per_thread=20000):
+    """Compare a single Marquise handle shared behind a lock with a
+    MarquisePool of one handle per thread, at increasing thread counts.
+    """
+    for n_threads in (1, 4, 16, 32):
+        marq = Marquise(BENCH_NAMESPACE)
+        lock = threading.Lock()
+        def locked_writer():
+            for i in range(points_per_thread):
+                with lock:
+                    marq.send_simple(BENCH_ADDRESS, 1234567890, i)
+        seconds = run_threads(n_threads, locked_writer)
+        report("locked handle, %d threads" % n_threads, seconds, n_threads * points_per_thread)
+        marq.close()
+
+        pool = MarquisePool(BENCH_NAMESPACE, n_threads)
+        def pool_writer():
+            for i in range(points_per_thread):
+                pool.send_simple(BENCH_ADDRESS, 1234567890, i)
+        seconds = run_threads(n_threads, pool_writer)
+        report("MarquisePool, %d threads" % n_threads, seconds, n_threads * points_per_thread)
+        pool.close()
+
+
+def bench_flush(n_points=20000):
+    """Measure send_simple grouped into sessions of 1, 100 and 10000
+    datapoints, with no flush, a plain flush and a durable (fsync) flush
+    at the end of each session, for both backends. ns/op is per
+    datapoint, so the flush cost is spread over the group.
+
+    Durable flushes cost what the spool's filesystem makes them cost, so
+    point MARQUISE_SPOOL_DIR at the real spool disk rather than a tmpfs
+    to measure them.
+    """
+    for backend in ('cffi', 'native'):
+        marq = Marquise(BENCH_NAMESPACE, backend=backend)
+        for group in (1, 100, 10000):
+            for mode, flush in (("no flush", None), ("flush", False), ("durable", True)):
+                iterations = min(n_points, group * 200) if flush else n_points
+                start = time.time()
+                for first in range(0, iterations, group):
+                    if flush is None:
+                        for i in range(group):
+                            marq.send_simple(BENCH_ADDRESS, 1234567890, i)
+                    else:
+                        with marq.session(durable=flush):
+                            for i in range(group):
+                                marq.send_simple(BENCH_ADDRESS, 1234567890, i)
+                report("%s group of %d, %s" % (backend, group, mode), time.time() - start, iterations)
+        marq.close()
+
+
+def bench_source_index(n_series=100000):
+    """Measure a warm restart with a SourceIndex: looking up identifiers
+    already in it, and update_source skipping source dicts already sent,
+    against hashing and sending everything again.
+    """
+    import tempfile
+    path = os.path.join(tempfile.mkdtemp(), "sources.idx")
+    identifiers = [ "hostname:fe%d.example.com,metric:BytesUsed,service:memory," % i for i in range(n_series) ]
+    source_dict = {'hostname': 'fe1.example.com', 'metric': 'BytesUsed', 'service': 'memory'}
+    index = SourceIndex(path, capacity=n_series)
+    marq = Marquise(BENCH_NAMESPACE, source_cache=index)
+    for address in index.hash_identifiers(identifiers):
+        marq.update_source(address, source_dict)
+    marq.close()
+    index.close()
+
+    index = SourceIndex(path)
+    start = time.time()
+    addresses = index.hash_identifiers(identifiers)
+    report("SourceIndex.hash_identifier, warm", time.time() - start, n_series)
+    start = time.time()
+    Marquise.hash_identifiers(identifiers)
+    report("Marquise.hash_identifiers", time.time() - start, n_series)
+    for name, source_cache in (("warm index", index), ("no cache", None)):
+        marq = Marquise(BENCH_NAMESPACE, source_cache=source_cache)
+        start = time.time()
+        for address in addresses:
+            marq.update_source(address, source_dict)
+        report("update_source restarted, %s" % name, time.time() - start, n_series)
+        marq.close()
+    index.close()
+    os.unlink(path)
+    os.rmdir(os.path.dirname(path))
+
+
+def bench_source_identifier(n_samples=200000, n_series=1000):
+    """Measure a collector's per-sample work for a series: building the
+    identifier by hand, hashing it and sending its source dict each time,
+    against reusing a SourceIdentifier per series.
+    """
+    tags = [ {'hostname': 'fe%d.example.com' % i, 'metric': 'BytesUsed', 'service': 'memory'} for i in range(n_series) ]
+    marq = Marquise(BENCH_NAMESPACE, source_cache=n_series * 2)
+    start = time.time()
+    for i in range(n_samples):
+        source_dict = tags[i % n_series]
+        address = marq.hash_identifier("".join([ "%s:%s," % pair for pair in sorted(source_dict.items()) ]))
+        marq.update_source(address, source_dict)
+        marq.send_simple(address, i, i)
+    report("by hand, per sample", time.time() - start, n_samples)
+    marq.close()
+
+    marq = Marquise(BENCH_NAMESPACE, source_cache=n_series * 2)
+    start = time.time()
+    sources = [ SourceIdentifier(source_dict) for source_dict in tags ]
+    for i in range(n_samples):
+        source = sources[i % n_series]
+        source.update_source(marq)
+        marq.send_simple(source.address, i, i)
+    report("SourceIdentifier, per sample", time.time() - start, n_samples)
+    marq.close()
+
+
+def bench_consume(n_points=500000, n_series=10000):
+    """Measure an exporter's cycle: building the full list of samples and
+    looping over send_simple, against streaming a generator through
+    consume. Peak Python heap use is measured on a separate run of each.
+    """
+    import tracemalloc
+    def samples():
+        for i in range(n_points):
+            yield (BENCH_ADDRESS + 2 * (i % n_series), 1400000000000000000 + i, i)
+    def by_list(marq):
+        for address, timestamp, value in list(samples()):
+            marq.send_simple(address, timestamp, value)
+    def by_consume(marq):
+        marq.consume(samples())
+    for name, cycle in (("list + send_simple", by_list), ("consume", by_consume)):
+        marq = Marquise(BENCH_NAMESPACE)
+        start = time.time()
+        cycle(marq)
+        report(name, time.time() - start, n_points)
+        tracemalloc.start()
+        cycle(marq)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print("%-40s %12.1f MiB peak heap" % ("", peak / (1024.0 * 1024)))
+        marq.close()
+
+
+def ingestd_lines(protocol, n_lines, n_series=1000):
+    """Return `n_lines` lines of `protocol` over `n_series` series."""
+    formats = {
+        'graphite': "bench.series%d %d 1400000000",
+        'statsd':   "bench.series%d:%d|c",
+        'collectd': "PUTVAL bench/series%d/gauge 1400000000:%d",
+    }
+    return [ formats[protocol] % (i % n_series, i) for i in range(n_lines) ]
+
+
+def bench_ingestd(n_lines=400000):
+    """Load-test marquise-ingestd: first parsing and writing alone, fed
+    from memory, then end to end with a sender blasting graphite lines
+    over UDP loopback to a server in another thread. The UDP figure
+    counts lines received; the rest were dropped by the kernel.
+    """
+    import asyncio
+    for protocol in ingestd.PROTOCOLS:
+        lines = ingestd_lines(protocol, n_lines)
+        chunks = [ "\n".join(lines[i:i + 100]).encode('ascii') for i in range(0, n_lines, 100) ]
+        loop = asyncio.new_event_loop()
+        server = ingestd.IngestServer(Marquise(BENCH_NAMESPACE), loop)
+        start = time.time()
+        for chunk in chunks:
+            server.feed(protocol, chunk)
+            server.flush_points()
+        report("ingestd feed %s" % protocol, time.time() - start, n_lines)
+        server.close()
+        loop.close()
+
+    loop = asyncio.new_event_loop()
+    server = ingestd.IngestServer(Marquise(BENCH_NAMESPACE), loop)
+    address = server.listen("graphite=udp://127.0.0.1:0")
+    thread = threading.Thread(target=loop.run_forever)
+    thread.start()
+    lines = ingestd_lines('graphite', n_lines)
+    datagrams = [ "\n".join(lines[i:i + 40]).encode('ascii') for i in range(0, n_lines, 40) ]
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    start = time.time()
+    for datagram in datagrams:
+        sender.sendto(datagram, address)
+    # Wait for the server to go quiet.
+    received = -1
+    while received != server.lines['graphite']:
+        received = server.lines['graphite']
+        time.sleep(0.1)
+    seconds = time.time() - start - 0.1
+    sender.close()
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    server.close()
+    loop.close()
+    report("ingestd udp graphite", seconds, received)
+    print("%-40s %12d of %d lines received" % ("", received, n_lines))
+
+
+BENCHMARKS = [
+    bench_hash_identifier,
+    bench_send_simple,
+    bench_clock,
+    bench_send_extended,
+    bench_send_extended_large,
+    bench_update_source,
+    bench_init_close,
+    bench_tracing,
+    bench_pool_threads,
+    bench_ingestd,
+    bench_source_index,
+    bench_source_identifier,
+    bench_consume,
+    bench_flush,
+    bench_import_time,
+]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Microbenchmarks for Pymarquise's write paths.")
+    parser.add_argument("--json", metavar="PATH", help="also write the results to PATH as JSON")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"), help="compare two --json files instead of benchmarking")
+    parser.add_argument("benchmarks", nargs="*", help="the benchmarks to run, eg. send_simple, by default all of them")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        sys.exit(0)
+
+    os.environ.setdefault('MARQUISE_SPOOL_DIR', '/tmp')
+    for benchmark in BENCHMARKS:
+        if not args.benchmarks or benchmark.__name__[len("bench_"):] in args.benchmarks:
+            benchmark()
+
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump({
+                'python':   "%s %s" % (platform.python_implementation(), platform.python_version()),
+                'library':  "stub (%s sink)" % os.environ.get('PYMARQUISE_STUB_SINK', 'null') if 'PYMARQUISE_STUB_SINK' in os.environ else "libmarquise",
+                'time':     time.time(),
+                'results':  RESULTS,
+            }, json_file, indent=2, sort_keys=True)
@@ -1 +1,32 @@
-from .marquise import Marquise
+from .errors import BatchWriteError
+from .native import NativeMarquise
+
+# Only the handles are imported here, so that importing marquise stays
+# cheap; the optional helpers are imported from their own modules, such as
+# marquise.pool or marquise.pipeline.
+#
+# Marquise needs the CFFI shim, which needs libmarquise. Hosts without it
+# can still use NativeMarquise, and get the reason the shim couldn't be
+# loaded when they try to use Marquise.
+try:
+    from .marquise import Marquise
+except ImportError as exc:
+    # Only a shim that isn't built, or whose libmarquise can't be loaded,
+    # is expected. Anything else is a real failure. The first is named
+    # marquise._marquise_cffi, the second just _marquise_cffi.
+    if exc.name not in (__name__ + "._marquise_cffi", "_marquise_cffi"):
+        raise
+    SHIM_IMPORT_ERROR = exc
+
+    class Marquise(object):
+
+        """
+        Stands in for Marquise where the CFFI shim can't be imported. The
+        'native' backend still works; anything else raises the ImportError
+        that importing the shim did.
+        """
+
+        def __new__(cls, namespace, backend='cffi', **kwargs):
+            if backend == 'native':
+                return NativeMarquise(namespace, **kwargs)
+            raise SHIM_IMPORT_ERROR
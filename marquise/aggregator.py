@@ -0,0 +1,292 @@
+# pylint: disable=line-too-long
+# pylint: disable=bad-whitespace
+
+"""This module provides a statsd-like aggregating front-end to a Marquise
+handle, which folds many events per series into one datapoint per flush
+interval instead of writing each event to the spool.
+"""
+
+import random
+import threading
+from array import array
+
+import six
+
+from .errors import BatchWriteError
+
+# The statistics sent for each timer, and the identifier suffix of each.
+TIMER_STATISTICS = ('count', 'sum', 'min', 'max', 'p50', 'p90', 'p99')
+
+# The most samples a timer keeps per interval for its percentiles.
+MAX_TIMER_SAMPLES = 10000
+
+class TimerSeries(object):
+
+    """
+    The samples of one timer in the current interval. The count, sum, min
+    and max are exact. The percentiles come from a uniform random sample
+    of at most MAX_TIMER_SAMPLES of them, so memory use per timer is
+    bounded however many samples arrive.
+    """
+
+    __slots__ = ('samples', 'count', 'total', 'low', 'high')
+
+    def __init__(self):
+        self.samples = array('Q')
+        self.count = 0
+        self.total = 0
+        self.low = None
+        self.high = None
+
+    def add(self, value):
+        """Add a sample."""
+        self.count += 1
+        self.total += value
+        if self.low is None or value < self.low:
+            self.low = value
+        if self.high is None or value > self.high:
+            self.high = value
+        if len(self.samples) < MAX_TIMER_SAMPLES:
+            self.samples.append(value)
+        else:
+            # Reservoir sampling: every sample so far is equally likely
+            # to be kept.
+            i = random.randrange(self.count)
+            if i < MAX_TIMER_SAMPLES:
+                self.samples[i] = value
+
+    def merge(self, other):
+        """Add the samples of `other`, another TimerSeries."""
+        if not other.count:
+            return
+        if len(self.samples) + len(other.samples) <= MAX_TIMER_SAMPLES:
+            self.samples.extend(other.samples)
+        else:
+            # Keep each side's samples in proportion to how many it stands for.
+            keep = min(len(self.samples), MAX_TIMER_SAMPLES * self.count // (self.count + other.count))
+            other_keep = min(len(other.samples), MAX_TIMER_SAMPLES - keep)
+            self.samples = array('Q', random.sample(list(self.samples), keep) + random.sample(list(other.samples), other_keep))
+        self.count += other.count
+        self.total += other.total
+        self.low = other.low if self.low is None else min(self.low, other.low)
+        self.high = other.high if self.high is None else max(self.high, other.high)
+
+    def summary(self):
+        """Return the values of TIMER_STATISTICS for the samples."""
+        samples = sorted(self.samples)
+        kept = len(samples)
+        def percentile(percent):
+            """Return the nearest-rank `percent`th percentile."""
+            return samples[max(0, -(-kept * percent // 100) - 1)]
+        return (self.count, self.total, self.low, self.high, percentile(50), percentile(90), percentile(99))
+
+
+class Aggregator(object):
+
+    """
+    Accumulates counters, gauges and timers in memory, and writes one
+    datapoint per series to the wrapped Marquise handle every `interval`
+    seconds, all in a single `send_simple_many` call.
+
+    - A counter sends the sum of its increments over the interval.
+    - A gauge sends the last value it was set to in the interval.
+    - A timer sends the count, sum, min, max and 50th, 90th and 99th
+      percentiles of its samples, each as its own series; see
+      `timer_identifiers`. Past MAX_TIMER_SAMPLES samples in an
+      interval, the percentiles are estimated from a random sample.
+
+    Series that weren't touched in an interval send nothing. Series are
+    keyed by address, or by identifier string, which is hashed once and
+    remembered. Timers must be keyed by identifier, as their statistics'
+    identifiers are derived from it. All values must be non-negative
+    integers, as for `Marquise.send_simple`.
+    """
+
+    def __init__(self, marquise, interval=10.0, start=True):
+        """Wrap `marquise`, a Marquise handle, and start flushing.
+
+        Arguments:
+        marquise -- the Marquise handle to write to.
+        interval -- the seconds between flushes.
+        start -- if False, nothing is flushed in the background until
+            `start` is called, though `flush` can still be called.
+        """
+        if interval <= 0:
+            raise ValueError("interval must be positive, got %r" % interval)
+        self.marquise = marquise
+        self.interval = interval
+
+        self.flushes = 0
+        self.written = 0
+        self.errors = 0
+        self.last_error = None
+
+        self._counters = {}
+        self._gauges = {}
+        self._timers = {}
+        self._addresses = {}
+        self._timer_addresses = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="Aggregator flusher")
+        self._thread.daemon = True
+        if start:
+            self.start()
+
+    def __str__(self):
+        """Return a human-readable description of the aggregator."""
+        return "<Aggregator flushing to %s every %ss>" % (self.marquise, self.interval)
+
+    def start(self):
+        """Start flushing in the background, if it wasn't started on creation."""
+        self._thread.start()
+
+    def _address(self, key):
+        """Return the address for `key`, an address or identifier.
+        Intended for internal use.
+        """
+        if isinstance(key, six.integer_types):
+            return key
+        address = self._addresses.get(key)
+        if address is None:
+            address = self._addresses[key] = self.marquise.hash_identifier(key)
+        return address
+
+    @staticmethod
+    def timer_identifiers(identifier):
+        """Return the identifiers of the series a timer sends, one for each
+        of TIMER_STATISTICS, by appending "statistic:<name>," to it.
+        """
+        return [ "%sstatistic:%s," % (identifier, statistic) for statistic in TIMER_STATISTICS ]
+
+    @staticmethod
+    def _check_value(value):
+        """Raise unless `value` can be sent as a simple datapoint.
+        Intended for internal use.
+        """
+        if not isinstance(value, six.integer_types):
+            raise TypeError("Values must be integers, got %r" % (value,))
+        if value < 0:
+            raise ValueError("Values must be non-negative, got %r" % (value,))
+
+    def incr(self, key, count=1):
+        """Add `count` to the counter for `key`."""
+        self._check_value(count)
+        address = self._address(key)
+        with self._lock:
+            self._counters[address] = self._counters.get(address, 0) + count
+
+    def gauge(self, key, value):
+        """Set the gauge for `key` to `value`."""
+        self._check_value(value)
+        address = self._address(key)
+        with self._lock:
+            self._gauges[address] = value
+
+    def timing(self, identifier, value):
+        """Add a sample of `value` (eg. a duration in nanoseconds) to the
+        timer for `identifier`.
+        """
+        self._check_value(value)
+        if not isinstance(identifier, six.string_types):
+            raise TypeError("Timers must be keyed by identifier, got %r" % (identifier,))
+        with self._lock:
+            series = self._timers.get(identifier)
+            if series is None:
+                series = self._timers[identifier] = TimerSeries()
+            series.add(value)
+
+    def flush(self):
+        """Write one datapoint for every series touched since the last
+        flush, return the number written.
+
+        If the write fails, the series that weren't written are merged
+        back into the current interval, to be sent with the next flush,
+        and the exception is raised. A timer that was only partly
+        written is merged back whole.
+        """
+        with self._flush_lock:
+            with self._lock:
+                counters, self._counters = self._counters, {}
+                gauges, self._gauges = self._gauges, {}
+                timers, self._timers = self._timers, {}
+            if not (counters or gauges or timers):
+                return 0
+            counters = list(counters.items())
+            gauges = list(gauges.items())
+            timers = list(timers.items())
+
+            try:
+                addresses = array('Q', [ address for address, _ in counters ])
+                values = array('Q', [ count for _, count in counters ])
+                addresses.extend([ address for address, _ in gauges ])
+                values.extend([ value for _, value in gauges ])
+                for identifier, series in timers:
+                    timer_addresses = self._timer_addresses.get(identifier)
+                    if timer_addresses is None:
+                        timer_addresses = self._timer_addresses[identifier] = array('Q', self.marquise.hash_identifiers(self.timer_identifiers(identifier)))
+                    addresses.extend(timer_addresses)
+                    values.extend(series.summary())
+
+                # Every series gets the same timestamp, the end of the interval.
+                timestamp = self.marquise.current_timestamp()
+                sent = self.marquise.send_simple_many(addresses, array('Q', [timestamp]) * len(addresses), values)
+            except Exception as exc:
+                self._merge_unsent(counters, gauges, timers, exc.index if isinstance(exc, BatchWriteError) else 0)
+                raise
+            self.flushes += 1
+            self.written += sent
+            return sent
+
+    def _merge_unsent(self, counters, gauges, timers, sent):
+        """Merge the series of a failed flush after the first `sent` back
+        into the current interval. Intended for internal use.
+        """
+        with self._lock:
+            for address, count in counters[sent:]:
+                self._counters[address] = self._counters.get(address, 0) + count
+            sent = max(0, sent - len(counters))
+            for address, value in gauges[sent:]:
+                # A gauge set since the flush began is newer, keep it.
+                self._gauges.setdefault(address, value)
+            sent = max(0, sent - len(gauges))
+            for identifier, series in timers[sent // len(TIMER_STATISTICS):]:
+                current = self._timers.get(identifier)
+                if current is not None:
+                    series.merge(current)
+                self._timers[identifier] = series
+
+    def _run(self):
+        """Flusher thread main loop. Intended for internal use."""
+        while not self._stop_event.wait(self.interval):
+            try:
+                self.flush()
+            except Exception as exc: # pylint: disable=broad-except
+                # The flusher must survive a failed write, the next
+                # interval may well succeed.
+                self.errors += 1
+                self.last_error = exc
+
+    def close(self):
+        """Stop the background flushes, flush one last time and close the
+        wrapped Marquise handle. Multiple close() calls are okay.
+        """
+        self._stop_event.set()
+        if self._thread.ident is not None:
+            self._thread.join()
+        try:
+            self.flush()
+        finally:
+            self.marquise.close()
+
+    def stats(self):
+        """Return a dict of the pending series and flush counters."""
+        with self._lock:
+            pending = len(self._counters) + len(self._gauges) + len(self._timers)
+        return {
+            'pending':  pending,
+            'flushes':  self.flushes,
+            'written':  self.written,
+            'errors':   self.errors,
+        }
@@ -0,0 +1,266 @@
+# pylint: disable=line-too-long
+# pylint: disable=bad-whitespace
+
+"""This module provides a non-blocking front-end to a Marquise handle, which
+hands writes off to a background thread so that slow spool I/O doesn't stall
+the caller.
+"""
+
+import time
+import threading
+from collections import deque
+
+from .errors import BatchWriteError
+
+SEND_SIMPLE   = 0
+SEND_EXTENDED = 1
+UPDATE_SOURCE = 2
+
+BACKPRESSURE_POLICIES = ('block', 'drop_oldest', 'drop_newest')
+
+class AsyncMarquise(object):
+
+    """
+    Wraps a Marquise handle so that `send_simple`, `send_extended` and
+    `update_source` queue the write and return immediately. A dedicated
+    writer thread drains the queue in batches, sending runs of consecutive
+    datapoints with `send_simple_many`/`send_extended_many`.
+
+    Only the writer thread touches the wrapped handle, so it mustn't be
+    used directly until this is closed.
+    """
+
+    def __init__(self, marquise, maxsize=100000, batch_size=1000, policy='block', start=True):
+        """Wrap `marquise`, a Marquise handle, and start the writer thread.
+
+        Arguments:
+        marquise -- the Marquise handle to write to.
+        maxsize -- the maximum number of writes waiting in the queue.
+        batch_size -- the maximum number of writes the writer thread takes
+            off the queue at once.
+        policy -- what to do when the queue is full. 'block' waits for
+            room, 'drop_oldest' discards the oldest queued write to make
+            room, and 'drop_newest' discards the write being queued.
+        start -- if False, the writer thread isn't started until `start`
+            is called.
+        """
+        if policy not in BACKPRESSURE_POLICIES:
+            raise ValueError("policy must be one of %s, got %r" % (", ".join(BACKPRESSURE_POLICIES), policy))
+        if maxsize < 1 or batch_size < 1:
+            raise ValueError("maxsize and batch_size must be positive")
+
+        self.marquise = marquise
+        self.maxsize = maxsize
+        self.batch_size = batch_size
+        self.policy = policy
+
+        self.enqueued = 0
+        self.written = 0
+        self.dropped = 0
+        self.errors = 0
+        self.last_error = None
+
+        self._queue = deque()
+        self._in_flight = 0
+        self._closing = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="AsyncMarquise writer")
+        self._thread.daemon = True
+        if start:
+            self.start()
+
+    def __str__(self):
+        """Return a human-readable description of the writer."""
+        return "<AsyncMarquise writing to %s, %d queued>" % (self.marquise, len(self._queue))
+
+    def start(self):
+        """Start the writer thread, if it wasn't started on creation."""
+        self._thread.start()
+
+    def _put(self, item):
+        """Queue `item` according to the backpressure policy, return True
+        if it was queued. Intended for internal use.
+        """
+        cond = self._cond
+        with cond:
+            if self._closing:
+                raise ValueError("Attempted to write to a closed AsyncMarquise.")
+            if len(self._queue) >= self.maxsize:
+                if self.policy == 'drop_newest':
+                    self.dropped += 1
+                    return False
+                elif self.policy == 'drop_oldest':
+                    self._queue.popleft()
+                    self.dropped += 1
+                else:
+                    while len(self._queue) >= self.maxsize and not self._closing:
+                        cond.wait()
+                    if self._closing:
+                        raise ValueError("Attempted to write to a closed AsyncMarquise.")
+            self._queue.append(item)
+            self.enqueued += 1
+            cond.notify_all()
+        return True
+
+    def send_simple(self, address, timestamp, value):
+        """Queue a simple datapoint, return True if it was queued or False
+        if it was dropped. See `Marquise.send_simple`.
+
+        A None `timestamp` is filled in with the time of queueing, by the
+        wrapped handle's clock.
+        """
+        if value is None:
+            raise TypeError("Can't store None as a value.")
+        if timestamp is None:
+            timestamp = self.marquise.current_timestamp()
+        return self._put((SEND_SIMPLE, address, timestamp, value))
+
+    def send_extended(self, address, timestamp, value):
+        """Queue an extended datapoint, return True if it was queued or
+        False if it was dropped. See `Marquise.send_extended`.
+
+        A None `timestamp` is filled in with the time of queueing, by the
+        wrapped handle's clock.
+        """
+        if value is None:
+            raise TypeError("Can't store None as a value.")
+        if timestamp is None:
+            timestamp = self.marquise.current_timestamp()
+        return self._put((SEND_EXTENDED, address, timestamp, value))
+
+    def update_source(self, address, metadata_dict, force=False):
+        """Queue a source dict update, return True if it was queued or
+        False if it was dropped. See `Marquise.update_source`.
+
+        The dict is copied, so the caller is free to modify it afterwards.
+        """
+        # Source dict updates have no timestamp, so `force` takes its place.
+        return self._put((UPDATE_SOURCE, address, force, dict(metadata_dict)))
+
+    def _run(self):
+        """Writer thread main loop. Intended for internal use."""
+        cond = self._cond
+        while True:
+            with cond:
+                while not self._queue and not self._closing:
+                    cond.wait()
+                if not self._queue:
+                    return
+                batch = []
+                while self._queue and len(batch) < self.batch_size:
+                    batch.append(self._queue.popleft())
+                self._in_flight = len(batch)
+                cond.notify_all()
+
+            self._write_batch(batch)
+
+            with cond:
+                self._in_flight = 0
+                cond.notify_all()
+
+    def _write_batch(self, batch):
+        """Write a batch of queued items, grouping consecutive datapoints
+        of the same kind. Intended for internal use.
+        """
+        start = 0
+        while start < len(batch):
+            kind = batch[start][0]
+            end = start + 1
+            if kind != UPDATE_SOURCE:
+                while end < len(batch) and batch[end][0] == kind:
+                    end += 1
+            self._write_run(kind, batch[start:end])
+            start = end
+
+    def _write_run(self, kind, run):
+        """Write a run of items of the same `kind`, counting successes and
+        failures. Intended for internal use.
+        """
+        try:
+            if kind == UPDATE_SOURCE:
+                for _, address, force, metadata_dict in run:
+                    self.marquise.update_source(address, metadata_dict, force)
+            else:
+                addresses  = [ item[1] for item in run ]
+                timestamps = [ item[2] for item in run ]
+                values     = [ item[3] for item in run ]
+                if kind == SEND_SIMPLE:
+                    self.marquise.send_simple_many(addresses, timestamps, values)
+                else:
+                    self.marquise.send_extended_many(addresses, timestamps, values)
+        except BatchWriteError as exc:
+            self.written += exc.index
+            self.errors += len(run) - exc.index
+            self.last_error = exc
+        except Exception as exc: # pylint: disable=broad-except
+            # The writer thread must survive bad input, so note the error
+            # and carry on. A bad datapoint rejects the whole run before
+            # anything is written, so retry the run one at a time to write
+            # the good ones.
+            if len(run) > 1:
+                for item in run:
+                    self._write_run(kind, [item])
+                return
+            self.errors += 1
+            self.last_error = exc
+        else:
+            self.written += len(run)
+
+    def flush(self, timeout=None):
+        """Block until everything queued so far has been written, return
+        True, or False if `timeout` seconds elapse first.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        cond = self._cond
+        with cond:
+            if self._thread.ident is None:
+                raise ValueError("The writer thread hasn't been started.")
+            while self._queue or self._in_flight:
+                if deadline is None:
+                    cond.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    cond.wait(remaining)
+        return True
+
+    def close(self):
+        """Write everything queued, stop the writer thread and close the
+        wrapped Marquise handle. Multiple close() calls are okay.
+        """
+        with self._cond:
+            self._closing = True
+            self._cond.notify_all()
+        # An unstarted writer still needs to drain what's been queued.
+        if self._thread.ident is None:
+            self._thread.start()
+        self._thread.join()
+        self.marquise.close()
+
+    def stats(self):
+        """Return a dict of the queue length and write counters."""
+        with self._cond:
+            return {
+                'queued':   len(self._queue) + self._in_flight,
+                'enqueued': self.enqueued,
+                'written':  self.written,
+                'dropped':  self.dropped,
+                'errors':   self.errors,
+            }
+
+    def aflush(self, loop=None):
+        """Return an awaitable that completes when `flush` would return,
+        without blocking the asyncio event loop.
+        """
+        import asyncio
+        loop = loop or asyncio.get_event_loop()
+        return loop.run_in_executor(None, self.flush)
+
+    def aclose(self, loop=None):
+        """Return an awaitable that completes when `close` would return,
+        without blocking the asyncio event loop.
+        """
+        import asyncio
+        loop = loop or asyncio.get_event_loop()
+        return loop.run_in_executor(None, self.close)
@@ -0,0 +1,134 @@
+# pylint: disable=line-too-long
+# pylint: disable=bad-whitespace
+
+"""This module describes the CFFI shim for libmarquise. setup.py builds it
+into the marquise._marquise_cffi extension, or run it directly to build the
+extension in place.
+
+It's loaded by setuptools on its own rather than as part of the package, so
+it mustn't import anything from the package.
+"""
+
+import os.path
+
+from cffi import FFI
+
+MODULE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# This kinda beats dragging the header file in here manually, assuming you can
+# clean it up suitably.  Assume that you've symlinked to marquise.h from here.
+def get_libmarquise_header():
+    """Read the libmarquise header to extract definitions."""
+    # Header file is packaged in the same place as the rest of the
+    # module.
+    header_path = os.path.join(MODULE_DIR, "marquise.h")
+    with open(header_path) as header:
+        libmarquise_header_lines = header.readlines()
+
+    libmarquise_header_lines = [ line for line in libmarquise_header_lines if not line.startswith('#include ') and not line.startswith('#define ') ]
+    libmarquise_header_lines = [ line for line in libmarquise_header_lines if not line.startswith('#include ') ]
+    # We can't #include glib so FFI doesn't know what a GTree is. Leave it for
+    # later and let the C compiler resolve it when we build the extension.
+    libmarquise_header_lines = [ line.replace("GTree *sd_hashes;", "...;") for line in libmarquise_header_lines ]
+    return ''.join(libmarquise_header_lines)
+
+
+# Batch helpers that loop over libmarquise calls in C, so that bulk writes
+# don't pay for a trip through the interpreter on every datapoint. They're
+# compiled into the same extension as the libmarquise bindings.
+PYMARQUISE_HELPERS_CDEF = """
+size_t pymarquise_send_simple_many(marquise_ctx *ctx, const uint64_t *addresses, const uint64_t *timestamps, uint64_t default_timestamp, const uint64_t *values, size_t n);
+void pymarquise_hash_identifiers(const unsigned char *buffer, const uint64_t *lengths, uint64_t *addresses, size_t n);
+size_t pymarquise_check_extents(const uint64_t *offsets, const uint64_t *lengths, size_t n, size_t buffer_len);
+size_t pymarquise_send_extended_many(marquise_ctx *ctx, const uint64_t *addresses, const uint64_t *timestamps, uint64_t default_timestamp, char *buffer, const uint64_t *offsets, const uint64_t *lengths, size_t n);
+"""
+
+PYMARQUISE_HELPERS_SOURCE = """
+/* Send `n` simple datapoints, stopping at the first failure. Returns the
+ * number of datapoints sent, so a return value less than `n` is the index
+ * of the datapoint that failed (with errno set by libmarquise). If
+ * `timestamps` is NULL, every datapoint is sent with `default_timestamp`.
+ */
+static size_t pymarquise_send_simple_many(marquise_ctx *ctx, const uint64_t *addresses, const uint64_t *timestamps, uint64_t default_timestamp, const uint64_t *values, size_t n)
+{
+	size_t i;
+	for (i = 0; i < n; i++) {
+		uint64_t timestamp = timestamps ? timestamps[i] : default_timestamp;
+		if (marquise_send_simple(ctx, addresses[i], timestamp, values[i]) != 0)
+			break;
+	}
+	return i;
+}
+
+/* Hash `n` identifiers packed end-to-end in `buffer` into `addresses`. */
+static void pymarquise_hash_identifiers(const unsigned char *buffer, const uint64_t *lengths, uint64_t *addresses, size_t n)
+{
+	size_t i;
+	for (i = 0; i < n; i++) {
+		addresses[i] = marquise_hash_identifier(buffer, lengths[i]);
+		buffer += lengths[i];
+	}
+}
+
+/* Check that `n` values described by `offsets` and `lengths` all fall
+ * within a buffer of `buffer_len` bytes. If `offsets` is NULL the values
+ * are packed end-to-end from the start of the buffer. Returns the index
+ * of the first value out of bounds, or `n` if they're all fine.
+ */
+static size_t pymarquise_check_extents(const uint64_t *offsets, const uint64_t *lengths, size_t n, size_t buffer_len)
+{
+	size_t i;
+	uint64_t offset = 0;
+	for (i = 0; i < n; i++) {
+		if (offsets)
+			offset = offsets[i];
+		if (offset > buffer_len || lengths[i] > buffer_len - offset)
+			break;
+		offset += lengths[i];
+	}
+	return i;
+}
+
+/* Send `n` extended datapoints sliced out of `buffer`, stopping at the
+ * first failure; the return value is as for pymarquise_send_simple_many.
+ * The extents must have been checked with pymarquise_check_extents.
+ */
+static size_t pymarquise_send_extended_many(marquise_ctx *ctx, const uint64_t *addresses, const uint64_t *timestamps, uint64_t default_timestamp, char *buffer, const uint64_t *offsets, const uint64_t *lengths, size_t n)
+{
+	size_t i;
+	uint64_t offset = 0;
+	for (i = 0; i < n; i++) {
+		uint64_t timestamp = timestamps ? timestamps[i] : default_timestamp;
+		if (offsets)
+			offset = offsets[i];
+		if (marquise_send_extended(ctx, addresses[i], timestamp, buffer + offset, lengths[i]) != 0)
+			break;
+		offset += lengths[i];
+	}
+	return i;
+}
+"""
+
+# The GLib headers are in different locations on different distros, which is
+# annoying. glib.h seems to be consistent between Debian and Fedora, but
+# glibconfig.h moves.
+distro_include_dirs = [ MODULE_DIR, '/usr/include/glib-2.0' ]
+glibconfig_paths = ('/usr/lib64/glib-2.0/include', '/usr/lib/x86_64-linux-gnu/glib-2.0/include')
+distro_include_dirs += [ path for path in glibconfig_paths if os.path.isfile(os.path.join(path, 'glibconfig.h')) ]
+
+FFI_BUILDER = FFI()
+
+# Get all our cdefs from the headers.
+FFI_BUILDER.cdef(get_libmarquise_header())
+FFI_BUILDER.cdef(PYMARQUISE_HELPERS_CDEF)
+
+# Throw libmarquise at CFFI, let it do the hard work. This gives us
+# API-level access instead of ABI access, and is generally preferred.
+FFI_BUILDER.set_source("marquise._marquise_cffi",
+                       """#include "marquise.h" """ + PYMARQUISE_HELPERS_SOURCE,
+                       include_dirs=distro_include_dirs,
+                       libraries=['marquise'])
+
+
+if __name__ == '__main__':
+    FFI_BUILDER.compile(tmpdir=os.path.dirname(MODULE_DIR), verbose=True)
@@ -0,0 +1,44 @@
+# pylint: disable=line-too-long
+# pylint: disable=bad-whitespace
+
+"""This module provides bounded caches for values that are expensive to
+recompute on every write, such as the address of a source identifier.
+"""
+
+from .lru import LRUCache
+from .marquise import Marquise
+
+
+class AddressCache(LRUCache):
+
+    """
+    Memoizes `Marquise.hash_identifier`, for callers that compute the
+    address of the same source identifiers over and over.
+    """
+
+    def __init__(self, maxsize=1000000):
+        LRUCache.__init__(self, maxsize)
+
+    def hash_identifier(self, identifier):
+        """Return the address for `identifier`, hashing it only if it
+        isn't already cached.
+        """
+        address = self.get(identifier)
+        if address is None:
+            address = Marquise.hash_identifier(identifier)
+            self[identifier] = address
+        return address
+
+    def hash_identifiers(self, identifiers):
+        """Return a list of the addresses for an iterable of identifiers.
+        Any that aren't cached are hashed together in a single batch.
+        """
+        identifiers = list(identifiers)
+        addresses = [ self.get(identifier) for identifier in identifiers ]
+        missing = [ i for i, address in enumerate(addresses) if address is None ]
+        if missing:
+            hashed = Marquise.hash_identifiers([ identifiers[i] for i in missing ])
+            for i, address in zip(missing, hashed):
+                addresses[i] = address
+                self[identifiers[i]] = address
+        return addresses
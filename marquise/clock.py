@@ -0,0 +1,144 @@
+# pylint: disable=line-too-long
+# pylint: disable=bad-whitespace
+
+"""This module provides the clocks that stamp datapoints sent without a
+timestamp: the system clock, read in integer nanoseconds, and a coarse
+clock that reads it once per tick for hot loops.
+"""
+
+import os
+import time
+import weakref
+import threading
+from array import array
+
+try:
+    time_ns = time.time_ns # pylint: disable=invalid-name
+except AttributeError:
+    def time_ns():
+        """Return the current time in nanoseconds since epoch. Without
+        time.time_ns, this is only as precise as a float allows.
+        """
+        return int(time.time() * 1000000000)
+
+# Coarse clocks whose ticking thread needs restarting in a forked child.
+LIVE_CLOCKS = weakref.WeakSet()
+
+def _after_fork_in_child():
+    """Restart every coarse clock that was ticking in a newly forked child."""
+    for clock in list(LIVE_CLOCKS):
+        clock.after_fork()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+class Clock(object):
+
+    """
+    The system clock, in integer nanoseconds since epoch. A Marquise
+    handle's `clock` is asked for the timestamp of every datapoint sent
+    without one.
+    """
+
+    @staticmethod
+    def now():
+        """Return the current timestamp, nanoseconds since epoch."""
+        return time_ns()
+
+    def stamp(self, n_points):
+        """Return an array('Q') of `n_points` copies of the current
+        timestamp, to pass as the timestamps of a batch send.
+        """
+        return array('Q', [self.now()]) * n_points
+
+    def close(self):
+        """Release the clock. Multiple close() calls are okay."""
+        pass
+
+
+class CoarseClock(Clock):
+
+    """
+    A clock that reads the system clock once every `tick` seconds from a
+    background thread, and hands out that reading until the next tick.
+    `now` is then an attribute lookup, for loops stamping more datapoints
+    per tick than there's time to read the system clock for. Timestamps
+    can be up to a tick (and a thread switch) stale, and datapoints sent
+    within one tick share one.
+
+    The ticking thread wakes 1/`tick` times a second, and each wakeup
+    takes the GIL from the threads writing datapoints. The default 10 ms
+    tick keeps that to 100 wakeups a second; a finer tick buys fresher
+    timestamps at the writers' expense.
+
+    Readings never go backwards, even if the system clock is stepped
+    back; they stand still until it catches up.
+
+    One clock can be shared by any number of handles and threads. Stop
+    it with `close` when done.
+    """
+
+    def __init__(self, tick=0.01, start=True):
+        """Read the system clock, and start ticking.
+
+        Arguments:
+        tick -- the seconds between readings of the system clock.
+        start -- if False, the clock only moves when `update` is called,
+            until `start` is called.
+        """
+        if tick <= 0:
+            raise ValueError("tick must be positive, got %r" % tick)
+        self.tick = tick
+        self._now = time_ns()
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._running = False
+        LIVE_CLOCKS.add(self)
+        if start:
+            self.start()
+
+    def __str__(self):
+        """Return a human-readable description of the clock."""
+        return "<CoarseClock ticking every %gs>" % self.tick
+
+    def start(self):
+        """Start ticking in the background, if it wasn't started on
+        creation.
+        """
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="Marquise coarse clock")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        """Ticking thread main loop. Intended for internal use."""
+        while not self._stop_event.wait(self.tick):
+            self.update()
+
+    def update(self):
+        """Read the system clock now, rather than waiting for the next tick."""
+        now = time_ns()
+        if now > self._now:
+            self._now = now
+
+    def now(self):
+        """Return the timestamp of the last tick, nanoseconds since epoch."""
+        return self._now
+
+    def after_fork(self):
+        """Restart ticking in a forked child, where the thread is gone.
+        Called automatically where os.register_at_fork exists.
+        """
+        self.update()
+        if self._running:
+            self._stop_event = threading.Event()
+            self.start()
+
+    def close(self):
+        """Stop ticking. Multiple close() calls are okay."""
+        self._running = False
+        self._stop_event.set()
+        if self._thread is not None and self._thread.ident is not None:
+            self._thread.join()
+        LIVE_CLOCKS.discard(self)
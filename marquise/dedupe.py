@@ -0,0 +1,301 @@
+# pylint: disable=line-too-long
+# pylint: disable=bad-whitespace
+
+"""This module provides a filter in front of a Marquise handle that drops
+datapoints repeating the last value written for their address, writing a
+heartbeat now and then so that unchanging series stay alive.
+"""
+
+from array import array
+
+from .oslo_strutils import safe_encode
+from .errors import BatchWriteError
+
+MASK64 = 0xffffffffffffffff
+
+# Fibonacci hashing spreads even sequential addresses across the table.
+GOLDEN = 0x9e3779b97f4a7c15
+
+class LastValueTable(object):
+
+    """
+    An open-addressing hash table from 64-bit addresses to a 64-bit value
+    and a 64-bit timestamp, kept in three parallel array('Q') columns with
+    linear probing. The table grows at a 2/3 load factor, so each entry
+    costs about 36 bytes of array just before growing, and about 72 just
+    after; there's no per-entry Python object.
+
+    Address 0 marks an empty slot, so it's kept aside on its own.
+    """
+
+    def __init__(self, capacity=1024):
+        """Create an empty table with room for `capacity` entries before
+        it has to grow.
+        """
+        size = 8
+        while size * 2 < capacity * 3:
+            size *= 2
+        self._allocate(size)
+        self._zero = None
+
+    def _allocate(self, size):
+        """Replace the columns with empty ones of `size` slots. Intended
+        for internal use.
+        """
+        self._keys = array('Q', [0]) * size
+        self._values = array('Q', [0]) * size
+        self._times = array('Q', [0]) * size
+        self._mask = size - 1
+        self._shift = 64 - (size.bit_length() - 1)
+        self._used = 0
+
+    def __len__(self):
+        return self._used + (self._zero is not None)
+
+    def _slot(self, key):
+        """Return the slot holding `key`, or the empty slot where it
+        belongs. Intended for internal use.
+        """
+        keys = self._keys
+        mask = self._mask
+        i = ((key * GOLDEN) & MASK64) >> self._shift
+        while True:
+            found = keys[i]
+            if found == key or found == 0:
+                return i
+            i = (i + 1) & mask
+
+    def get(self, key):
+        """Return the (value, timestamp) for `key`, or None."""
+        if key == 0:
+            return self._zero
+        i = self._slot(key)
+        if self._keys[i] == 0:
+            return None
+        return self._values[i], self._times[i]
+
+    def set(self, key, value, timestamp):
+        """Store the `value` and `timestamp` for `key`."""
+        if key == 0:
+            self._zero = (value, timestamp)
+            return
+        i = self._slot(key)
+        if self._keys[i] == 0:
+            if (self._used + 1) * 3 > len(self._keys) * 2:
+                self._grow()
+                i = self._slot(key)
+            self._keys[i] = key
+            self._used += 1
+        self._values[i] = value
+        self._times[i] = timestamp
+
+    def _grow(self):
+        """Double the number of slots, rehashing every entry. Intended for
+        internal use.
+        """
+        keys, values, times = self._keys, self._values, self._times
+        self._allocate(len(keys) * 2)
+        for key, value, timestamp in zip(keys, values, times):
+            if key:
+                i = self._slot(key)
+                self._keys[i] = key
+                self._values[i] = value
+                self._times[i] = timestamp
+                self._used += 1
+
+    def clear(self):
+        """Remove every entry."""
+        self._allocate(8)
+        self._zero = None
+
+
+class DedupeFilter(object):
+
+    """
+    Wraps a Marquise handle so that `send_simple` and `send_extended` drop
+    a datapoint whose value is the same as the last one written for its
+    address, unless `heartbeat` seconds (by datapoint timestamp) have
+    passed since that address was last written. Extended values are
+    compared by hash.
+
+    Dropped datapoints still count as sent, so the methods return what
+    the wrapped handle's would; see `stats` for how many were dropped.
+    Source dicts pass straight through. Like a Marquise handle, it isn't
+    safe to share between threads without a lock.
+    """
+
+    def __init__(self, marquise, heartbeat=600, capacity=1024):
+        """Wrap `marquise`, a Marquise handle.
+
+        Arguments:
+        marquise -- the Marquise handle to write to.
+        heartbeat -- the most seconds an unchanging series goes between
+            datapoints.
+        capacity -- the number of addresses to make room for up front.
+        """
+        if heartbeat <= 0:
+            raise ValueError("heartbeat must be positive, got %r" % heartbeat)
+        self.marquise = marquise
+        self.heartbeat_ns = int(heartbeat * 1000000000)
+        self.last_values = LastValueTable(capacity)
+        self.written = 0
+        self.suppressed = 0
+
+    def __str__(self):
+        """Return a human-readable description of the filter."""
+        return "<DedupeFilter tracking %d addresses in front of %s>" % (len(self.last_values), self.marquise)
+
+    def _is_repeat(self, key, timestamp, value_key):
+        """Return True if the datapoint can be dropped. Intended for
+        internal use.
+        """
+        last = self.last_values.get(key)
+        return last is not None and last[0] == value_key and timestamp - last[1] < self.heartbeat_ns
+
+    @staticmethod
+    def _value_key(value):
+        """Return the 64-bit value an extended value is compared by.
+        Intended for internal use.
+        """
+        if not isinstance(value, (bytes, bytearray, memoryview)):
+            value = safe_encode(str(value), 'utf8')
+        elif not isinstance(value, bytes):
+            value = bytes(value)
+        return hash(value) & MASK64
+
+    def send_simple(self, address, timestamp, value):
+        """Queue a simple datapoint unless it repeats the last value, see
+        `Marquise.send_simple`.
+        """
+        if value is None:
+            raise TypeError("Can't store None as a value.")
+        if timestamp is None:
+            timestamp = self.marquise.current_timestamp()
+        key = address & ~1
+        if self._is_repeat(key, timestamp, value):
+            self.suppressed += 1
+            return True
+        result = self.marquise.send_simple(address, timestamp, value)
+        self.last_values.set(key, value, timestamp)
+        self.written += 1
+        return result
+
+    def send_extended(self, address, timestamp, value):
+        """Queue an extended datapoint unless it repeats the last value,
+        see `Marquise.send_extended`.
+        """
+        if value is None:
+            raise TypeError("Can't store None as a value.")
+        if timestamp is None:
+            timestamp = self.marquise.current_timestamp()
+        key = address | 1
+        value_key = self._value_key(value)
+        if self._is_repeat(key, timestamp, value_key):
+            self.suppressed += 1
+            return True
+        result = self.marquise.send_extended(address, timestamp, value)
+        self.last_values.set(key, value_key, timestamp)
+        self.written += 1
+        return result
+
+    def _send_many(self, method_name, addresses, keys, timestamps, values, value_keys):
+        """Send the datapoints that aren't repeats with the wrapped
+        handle's `method_name` in one call, then remember them. Intended
+        for internal use.
+        """
+        if timestamps is None:
+            timestamps = [self.marquise.current_timestamp()] * len(keys)
+        if not len(addresses) == len(timestamps) == len(values):
+            raise ValueError("Got %d addresses, %d timestamps and %d values" % (len(addresses), len(timestamps), len(values)))
+
+        kept = []
+        latest = {}
+        for i, (key, timestamp, value_key) in enumerate(zip(keys, timestamps, value_keys)):
+            # A repeat earlier in the same batch counts as the last value.
+            last = latest.get(key)
+            if last is None:
+                repeat = self._is_repeat(key, timestamp, value_key)
+            else:
+                repeat = last[0] == value_key and timestamp - last[1] < self.heartbeat_ns
+            if not repeat:
+                kept.append(i)
+                latest[key] = (value_key, timestamp)
+        self.suppressed += len(keys) - len(kept)
+
+        try:
+            getattr(self.marquise, method_name)([ addresses[i] for i in kept ], [ timestamps[i] for i in kept ], [ values[i] for i in kept ])
+        except BatchWriteError as exc:
+            self.__remember(kept[:exc.index], keys, timestamps, value_keys)
+            index = kept[exc.index] if exc.index < len(kept) else len(keys)
+            raise BatchWriteError("%s was unsuccessful at index %d, errno is %d" % (method_name, index, exc.errno), index, exc.errno)
+        self.__remember(kept, keys, timestamps, value_keys)
+        return len(keys)
+
+    def __remember(self, indices, keys, timestamps, value_keys):
+        """Record the datapoints at `indices` as written. Intended for
+        internal use.
+        """
+        for i in indices:
+            self.last_values.set(keys[i], value_keys[i], timestamps[i])
+        self.written += len(indices)
+
+    def send_simple_many(self, addresses, timestamps, values):
+        """Queue the simple datapoints that don't repeat their address'
+        last value in one call, return the number handled including those
+        dropped. See `Marquise.send_simple_many`.
+        """
+        addresses = list(addresses)
+        values = list(values)
+        if timestamps is not None:
+            timestamps = list(timestamps)
+        return self._send_many('send_simple_many', addresses, [ address & ~1 for address in addresses ], timestamps, values, values)
+
+    def send_extended_many(self, addresses, timestamps, values):
+        """Queue the extended datapoints that don't repeat their address'
+        last value in one call, return the number handled including those
+        dropped. See `Marquise.send_extended_many`.
+
+        Unlike Marquise's, this only takes a sequence of values, not a
+        packed buffer.
+        """
+        addresses = list(addresses)
+        values = list(values)
+        if any([ value is None for value in values ]):
+            raise TypeError("Can't store None as a value.")
+        if timestamps is not None:
+            timestamps = list(timestamps)
+        return self._send_many('send_extended_many', addresses, [ address | 1 for address in addresses ], timestamps, values, [ self._value_key(value) for value in values ])
+
+    def update_source(self, address, metadata_dict, force=False):
+        """Ship a source dict, see `Marquise.update_source`."""
+        return self.marquise.update_source(address, metadata_dict, force)
+
+    def update_sources(self, sources, force=False):
+        """Ship many source dicts, see `Marquise.update_sources`."""
+        return self.marquise.update_sources(sources, force)
+
+    def hash_identifier(self, identifier):
+        """See `Marquise.hash_identifier`."""
+        return self.marquise.hash_identifier(identifier)
+
+    def hash_identifiers(self, identifiers):
+        """See `Marquise.hash_identifiers`."""
+        return self.marquise.hash_identifiers(identifiers)
+
+    def current_timestamp(self):
+        """See `Marquise.current_timestamp`."""
+        return self.marquise.current_timestamp()
+
+    def close(self):
+        """Close the wrapped Marquise handle. Multiple close() calls are okay."""
+        self.marquise.close()
+
+    def stats(self):
+        """Return a dict of the datapoints written and dropped, and the
+        number of addresses tracked.
+        """
+        return {
+            'written':    self.written,
+            'suppressed': self.suppressed,
+            'tracked':    len(self.last_values),
+        }
@@ -0,0 +1,17 @@
+# pylint: disable=line-too-long
+# pylint: disable=bad-whitespace
+
+"""This module holds the exceptions shared by the Marquise backends."""
+
+class BatchWriteError(RuntimeError):
+
+    """Raised when a batch write fails part way through.
+
+    All datapoints before `index` were queued successfully, the datapoint
+    at `index` failed with `errno`, and nothing after it was attempted.
+    """
+
+    def __init__(self, message, index, errno_value):
+        RuntimeError.__init__(self, message)
+        self.index = index
+        self.errno = errno_value
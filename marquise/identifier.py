@@ -0,0 +1,163 @@
+# pylint: disable=line-too-long
+# pylint: disable=bad-whitespace
+
+"""This module provides a compact source identifier that builds the
+canonical "key:value," identifier string for a source dict once, and keeps
+its encoded bytes, address and source dict for every datapoint after.
+"""
+
+import six
+
+from .native import NativeMarquise
+
+try:
+    from .marquise import Marquise
+    HASH_IDENTIFIER = Marquise.hash_identifier
+    HASH_IDENTIFIERS = Marquise.hash_identifiers
+except ImportError:
+    # Hash in pure Python when the C shim isn't built, the addresses are
+    # the same.
+    HASH_IDENTIFIER = NativeMarquise.hash_identifier
+    HASH_IDENTIFIERS = NativeMarquise.hash_identifiers
+
+FORBIDDEN = (",", ":")
+
+def field_text(field):
+    """Return the text of a source dict key or value, None becoming "".
+    Raise ValueError if it holds a character the identifier syntax
+    reserves. Intended for internal use.
+    """
+    if field is None:
+        return u""
+    if isinstance(field, bytes):
+        field = field.decode('utf8')
+    elif not isinstance(field, six.text_type):
+        field = six.text_type(field)
+    for char in FORBIDDEN:
+        if char in field:
+            raise ValueError("%r contains %r, which can't be used in a source identifier" % (field, char))
+    return field
+
+
+class SourceIdentifier(object):
+
+    """
+    The canonical identifier of a source dict: its "key:value," pairs,
+    sorted, as one string. This is the string whose hash is the address of
+    the source's datapoints, and also what `Marquise.source_digest` hashes,
+    so the address doubles as the source dict's digest.
+
+    Keys and values are checked for "," and ":" when the identifier is
+    built, not when it's first sent. Only the encoded identifier is kept;
+    the address and source dict are worked out on first use and then
+    remembered, so that a collector holding one of these per series
+    never rebuilds, re-encodes or rehashes it. Identifiers compare and
+    hash by their encoded bytes.
+    """
+
+    __slots__ = ('encoded', '_address', '_metadata')
+
+    def __init__(self, metadata):
+        """Build the identifier for `metadata`, a source dict or an
+        iterable of (key, value) pairs. Keys and values are stringified,
+        and None values become empty strings.
+
+        Raise ValueError if a key is empty, or if a key or value contains
+        "," or ":".
+        """
+        if hasattr(metadata, 'items'):
+            metadata = metadata.items()
+        pairs = []
+        for key, value in metadata:
+            key = field_text(key)
+            if not key:
+                raise ValueError("Source identifier keys can't be empty")
+            pairs.append(u"%s:%s," % (key, field_text(value)))
+        pairs.sort()
+        self.encoded = u"".join(pairs).encode('utf8')
+        self._address = None
+        self._metadata = None
+
+    @classmethod
+    def parse(cls, identifier):
+        """Return the SourceIdentifier for an `identifier` string of
+        "key:value," pairs, in any order.
+        """
+        if isinstance(identifier, bytes):
+            identifier = identifier.decode('utf8')
+        pairs = []
+        for pair in identifier.split(u","):
+            if not pair:
+                continue
+            key, sep, value = pair.partition(u":")
+            if not sep:
+                raise ValueError("%r isn't a key:value pair" % pair)
+            pairs.append((key, value))
+        return cls(pairs)
+
+    @classmethod
+    def resolve(cls, identifiers):
+        """Work out the addresses of the SourceIdentifiers in `identifiers`
+        that don't have one yet, hashing them all in one call. Return a
+        list of every address, in order.
+        """
+        identifiers = list(identifiers)
+        pending = [ identifier for identifier in identifiers if identifier._address is None ] # pylint: disable=protected-access
+        if pending:
+            for identifier, address in zip(pending, HASH_IDENTIFIERS([ identifier.encoded for identifier in pending ])):
+                identifier._address = address # pylint: disable=protected-access
+        return [ identifier._address for identifier in identifiers ] # pylint: disable=protected-access
+
+    @property
+    def identifier(self):
+        """The identifier as a string."""
+        return self.encoded.decode('utf8')
+
+    @property
+    def address(self):
+        """The address of the source's datapoints."""
+        if self._address is None:
+            self._address = HASH_IDENTIFIER(self.encoded)
+        return self._address
+
+    @property
+    def metadata(self):
+        """The source dict, as sent by `update_source`. Don't modify it,
+        it's shared by every use of this identifier.
+        """
+        if self._metadata is None:
+            self._metadata = dict([ pair.split(u":", 1) for pair in self.identifier.split(u",")[:-1] ])
+        return self._metadata
+
+    def update_source(self, marquise, force=False):
+        """Ship the source dict for this identifier with `marquise`, see
+        `Marquise.update_source`.
+
+        If the handle has a `source_cache` that already holds this
+        source, this returns True without rebuilding its digest.
+        """
+        address = self.address
+        source_cache = getattr(marquise, 'source_cache', None)
+        if not force and source_cache is not None and source_cache.get(address) == address:
+            return True
+        return marquise.update_source(address, self.metadata, force)
+
+    def __eq__(self, other):
+        if not isinstance(other, SourceIdentifier):
+            return NotImplemented
+        return self.encoded == other.encoded
+
+    def __ne__(self, other):
+        if not isinstance(other, SourceIdentifier):
+            return NotImplemented
+        return self.encoded != other.encoded
+
+    def __hash__(self):
+        return hash(self.encoded)
+
+    def __str__(self):
+        """Return the identifier string."""
+        return str(self.identifier) if six.PY3 else self.encoded
+
+    def __repr__(self):
+        return "SourceIdentifier.parse(%r)" % self.identifier
@@ -0,0 +1,281 @@
+# pylint: disable=line-too-long
+# pylint: disable=bad-whitespace
+
+"""This module provides a persistent, memory-mapped index of source
+identifiers to addresses, and of addresses to the digest of the source
+dict last sent for them, so that a restarted collector neither rehashes
+its identifiers nor resends unchanged source dicts.
+"""
+
+import os
+import mmap
+import fcntl
+import struct
+import hashlib
+
+from .dedupe import GOLDEN, MASK64
+from .identifier import HASH_IDENTIFIER, HASH_IDENTIFIERS
+
+MAGIC = b"PYMQIDX1"
+
+# The header holds the magic, the slot counts of the two tables, the
+# entry counts, and the digest for address 0, which can't be kept in the
+# address table because address 0 marks an empty slot there.
+HEADER = struct.Struct("<8sQQQQQQ")
+HEADER_SIZE = 64
+ADDRESS_COUNT_OFFSET = 24
+IDENTIFIER_COUNT_OFFSET = 32
+HAS_ZERO_OFFSET = 40
+ZERO_DIGEST_OFFSET = 48
+
+# An (address, digest) slot, and an (identifier fingerprint, address) slot
+# where the fingerprint is the first 16 bytes of the identifier's MD5.
+ADDRESS_SLOT = struct.Struct("<QQ")
+IDENTIFIER_SLOT = struct.Struct("<QQQ")
+WORD = struct.Struct("<Q")
+
+class SourceIndex(object):
+
+    """
+    An open-addressing hash table in a memory-mapped file, with two parts:
+
+    - identifier to address, filled in by `hash_identifier`.
+    - address to source dict digest, read and written through `get` and
+      item assignment, so that it can be a Marquise handle's
+      `source_cache`.
+
+    Nothing is loaded into the Python heap: lookups probe the mapped file
+    directly, and the kernel pages it in and out as needed. The file is
+    created sparse, so a large capacity costs disk and memory only for
+    the pages actually touched.
+
+    Many processes can open the same index. Lookups take no lock; new
+    entries are claimed under an fcntl lock on the file, and each slot's
+    key is written after its value, so readers never see a half-written
+    entry.
+
+    The capacity is fixed when the file is created. Once an index is
+    three-quarters full, new entries are counted in `overflows` and not
+    stored, and lookups for them miss.
+    """
+
+    def __init__(self, path, capacity=1000000, readonly=False, hasher=None):
+        """Open the index at `path`, creating it if it doesn't exist.
+
+        Arguments:
+        path -- the index file.
+        capacity -- the number of identifiers and of addresses to make
+            room for, if the file is created. Ignored otherwise.
+        readonly -- if True, the file is mapped read-only and nothing new
+            is stored.
+        hasher -- the function `hash_identifier` uses for identifiers not
+            in the index. By default this is Marquise.hash_identifier, or
+            NativeMarquise.hash_identifier where the C shim isn't built,
+            and `hash_identifiers` hashes all its misses in one call.
+        """
+        if capacity < 1:
+            raise ValueError("capacity must be positive, got %r" % capacity)
+        self.path = path
+        self.readonly = readonly
+        if hasher is None:
+            self.hasher = HASH_IDENTIFIER
+            self._hash_many = HASH_IDENTIFIERS
+        else:
+            self.hasher = hasher
+            self._hash_many = lambda identifiers: [ hasher(identifier) for identifier in identifiers ]
+        self.overflows = 0
+        self._map = None
+
+        if readonly:
+            self._fd = os.open(path, os.O_RDONLY)
+        else:
+            self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+            fcntl.lockf(self._fd, fcntl.LOCK_EX)
+            try:
+                if os.fstat(self._fd).st_size == 0:
+                    slots = 8
+                    while slots * 3 < capacity * 4:
+                        slots *= 2
+                    os.ftruncate(self._fd, HEADER_SIZE + slots * (ADDRESS_SLOT.size + IDENTIFIER_SLOT.size))
+                    os.write(self._fd, HEADER.pack(MAGIC, slots, slots, 0, 0, 0, 0))
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN)
+        self._map = mmap.mmap(self._fd, 0, access=mmap.ACCESS_READ if readonly else mmap.ACCESS_WRITE)
+
+        magic, self._address_slots, self._identifier_slots = HEADER.unpack_from(self._map, 0)[:3]
+        if magic != MAGIC:
+            self.close()
+            raise ValueError("%s isn't a source index" % path)
+        self._address_shift = 64 - (self._address_slots.bit_length() - 1)
+        self._identifier_shift = 64 - (self._identifier_slots.bit_length() - 1)
+        self._addresses_offset = HEADER_SIZE
+        self._identifiers_offset = HEADER_SIZE + self._address_slots * ADDRESS_SLOT.size
+
+    def __str__(self):
+        """Return a human-readable description of the index."""
+        return "<SourceIndex %s with %d identifiers and %d addresses>" % (self.path, self.identifier_count, len(self))
+
+    @property
+    def identifier_count(self):
+        """The number of identifiers in the index."""
+        return WORD.unpack_from(self._map, IDENTIFIER_COUNT_OFFSET)[0]
+
+    def __len__(self):
+        return WORD.unpack_from(self._map, ADDRESS_COUNT_OFFSET)[0] + WORD.unpack_from(self._map, HAS_ZERO_OFFSET)[0]
+
+    def _address_slot(self, address):
+        """Return the offset of the slot holding `address`, or of the empty
+        slot where it belongs. Intended for internal use.
+        """
+        buf = self._map
+        mask = self._address_slots - 1
+        i = ((address * GOLDEN) & MASK64) >> self._address_shift
+        while True:
+            offset = self._addresses_offset + i * 16
+            found = WORD.unpack_from(buf, offset)[0]
+            if found == address or found == 0:
+                return offset
+            i = (i + 1) & mask
+
+    def get(self, address, default=None):
+        """Return the source dict digest recorded for `address`, or
+        `default`.
+        """
+        if address == 0:
+            has_zero, digest = struct.unpack_from("<QQ", self._map, HAS_ZERO_OFFSET)
+            return digest if has_zero else default
+        found, digest = ADDRESS_SLOT.unpack_from(self._map, self._address_slot(address))
+        return digest if found else default
+
+    def __contains__(self, address):
+        return self.get(address) is not None
+
+    def __setitem__(self, address, digest):
+        """Record `digest` as the last source dict digest sent for `address`."""
+        if self.readonly:
+            raise ValueError("Attempted to write to a read-only SourceIndex.")
+        buf = self._map
+        if address == 0:
+            WORD.pack_into(buf, ZERO_DIGEST_OFFSET, digest)
+            WORD.pack_into(buf, HAS_ZERO_OFFSET, 1)
+            return
+        offset = self._address_slot(address)
+        if WORD.unpack_from(buf, offset)[0] == address:
+            WORD.pack_into(buf, offset + 8, digest)
+            return
+        fcntl.lockf(self._fd, fcntl.LOCK_EX)
+        try:
+            # Another process may have claimed the slot before we locked.
+            offset = self._address_slot(address)
+            if WORD.unpack_from(buf, offset)[0] == 0:
+                count = WORD.unpack_from(buf, ADDRESS_COUNT_OFFSET)[0]
+                if (count + 1) * 4 > self._address_slots * 3:
+                    self.overflows += 1
+                    return
+                WORD.pack_into(buf, ADDRESS_COUNT_OFFSET, count + 1)
+            WORD.pack_into(buf, offset + 8, digest)
+            WORD.pack_into(buf, offset, address)
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN)
+
+    @staticmethod
+    def fingerprint(identifier):
+        """Return the two 64-bit words identifying `identifier` in the index."""
+        if not isinstance(identifier, bytes):
+            identifier = identifier.encode('utf8')
+        return struct.unpack("<QQ", hashlib.md5(identifier).digest())
+
+    def _identifier_slot(self, high, low):
+        """Return (offset, address) for the slot holding the fingerprint,
+        or (offset, None) for the empty slot where it belongs. Intended
+        for internal use.
+        """
+        buf = self._map
+        mask = self._identifier_slots - 1
+        i = high >> self._identifier_shift
+        while True:
+            offset = self._identifiers_offset + i * 24
+            found_high, found_low, address = IDENTIFIER_SLOT.unpack_from(buf, offset)
+            if found_high == high and found_low == low:
+                return offset, address
+            if found_high == 0 and found_low == 0:
+                return offset, None
+            i = (i + 1) & mask
+
+    def address(self, identifier):
+        """Return the address recorded for `identifier`, or None."""
+        return self._identifier_slot(*self.fingerprint(identifier))[1]
+
+    def hash_identifier(self, identifier):
+        """Return the address for `identifier`, hashing it and recording
+        it only if it isn't in the index already.
+        """
+        high, low = self.fingerprint(identifier)
+        address = self._identifier_slot(high, low)[1]
+        if address is None:
+            address = self.hasher(identifier)
+            self._record_identifiers([(high, low, address)])
+        return address
+
+    def hash_identifiers(self, identifiers):
+        """Return a list of the addresses for an iterable of identifiers,
+        see `hash_identifier`. The identifiers that aren't in the index
+        are hashed in one call.
+        """
+        identifiers = list(identifiers)
+        fingerprints = [ self.fingerprint(identifier) for identifier in identifiers ]
+        addresses = [ self._identifier_slot(high, low)[1] for high, low in fingerprints ]
+        misses = [ i for i, address in enumerate(addresses) if address is None ]
+        if misses:
+            hashed = self._hash_many([ identifiers[i] for i in misses ])
+            for i, address in zip(misses, hashed):
+                addresses[i] = address
+            self._record_identifiers([ fingerprints[i] + (addresses[i],) for i in misses ])
+        return addresses
+
+    def _record_identifiers(self, entries):
+        """Record the (high, low, address) of identifiers just hashed,
+        unless the index is read-only, or they were recorded meanwhile.
+        Intended for internal use.
+        """
+        if self.readonly:
+            return
+        fcntl.lockf(self._fd, fcntl.LOCK_EX)
+        try:
+            for high, low, address in entries:
+                offset, found = self._identifier_slot(high, low)
+                if found is not None:
+                    continue
+                count = WORD.unpack_from(self._map, IDENTIFIER_COUNT_OFFSET)[0]
+                if (count + 1) * 4 > self._identifier_slots * 3:
+                    self.overflows += 1
+                    continue
+                WORD.pack_into(self._map, offset + 16, address)
+                struct.pack_into("<QQ", self._map, offset, high, low)
+                WORD.pack_into(self._map, IDENTIFIER_COUNT_OFFSET, count + 1)
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN)
+
+    def flush(self):
+        """Write the index's dirty pages back to the file."""
+        if not self.readonly:
+            self._map.flush()
+
+    def close(self):
+        """Unmap and close the file. Multiple close() calls are okay."""
+        if self._map is not None:
+            self.flush()
+            self._map.close()
+            self._map = None
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def stats(self):
+        """Return a dict of the entry counts, capacities and overflows."""
+        return {
+            'identifiers': self.identifier_count,
+            'addresses':   len(self),
+            'capacity':    self._address_slots * 3 // 4,
+            'overflows':   self.overflows,
+        }
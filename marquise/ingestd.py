@@ -0,0 +1,495 @@
+# pylint: disable=line-too-long
+# pylint: disable=bad-whitespace
+
+"""This module provides marquise-ingestd, a local daemon that accepts
+metrics in the statsd, graphite plaintext and collectd plaintext
+protocols over UDP, TCP and Unix sockets, and writes them through a
+single Marquise handle. Services can then fire and forget their metrics
+without linking against pymarquise.
+
+Each metric name becomes a series whose identifier is the canonical
+serialisation of its source dict (eg. "metric:web.requests,", with any
+',' or ':' in the name replaced by '_'), and the source dict is sent the
+first time the series is seen.
+
+- graphite lines are written as they arrive.
+- statsd lines are aggregated and flushed every interval through an
+  Aggregator, as statsd does. A gauge sent as "+N" or "-N" is changed by
+  N, rather than set to it.
+- collectd PUTVAL lines are written as they arrive, one series per value.
+
+Integer values from 0 to 2**64 - 1 are written as simple datapoints;
+anything else, such as 0.5, is written as an extended datapoint holding
+the value's text, so no precision is lost.
+
+Everything runs on one asyncio event loop. UDP sockets are drained many
+datagrams at a time on each wakeup, and all the datapoints parsed in one
+pass of the loop are written in a single batch.
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import errno
+import socket
+import signal
+import argparse
+
+from .aggregator import Aggregator
+
+PROTOCOLS = ('statsd', 'graphite', 'collectd')
+TRANSPORTS = ('udp', 'tcp', 'unix')
+
+DEFAULT_LISTEN = ["statsd=udp://127.0.0.1:8125", "graphite=tcp://127.0.0.1:2003"]
+
+# How many datagrams to read from a UDP socket per wakeup.
+DATAGRAMS_PER_WAKEUP = 256
+MAX_DATAGRAM_SIZE = 65536
+# The longest line a TCP or Unix stream client may send; a connection
+# that goes past it without a newline is dropped.
+MAX_LINE_LENGTH = 65536
+MAX_UINT64 = 2**64 - 1
+
+def clean(text):
+    """Return `text` with the characters source dicts forbid, ',' and
+    ':', replaced by '_'.
+    """
+    return text.replace(",", "_").replace(":", "_")
+
+def identifier_for(metadata_dict):
+    """Return the canonical identifier of a source dict, its "key:value,"
+    pairs sorted by key.
+    """
+    return "".join([ "%s:%s," % pair for pair in sorted(metadata_dict.items()) ])
+
+def parse_value(text):
+    """Return a datapoint value: an integer for a simple datapoint, or
+    bytes for an extended one. Raise ValueError if `text` isn't a number.
+    """
+    try:
+        value = int(text)
+    except ValueError:
+        number = float(text)
+        if number != number or number in (float('inf'), float('-inf')):
+            raise ValueError("Not a finite number: %r" % text)
+        if not number.is_integer():
+            return text.encode('ascii')
+        value = int(number)
+    if 0 <= value <= MAX_UINT64:
+        return value
+    return text.encode('ascii')
+
+def parse_timestamp(text):
+    """Return nanoseconds since epoch for a timestamp in seconds."""
+    try:
+        return int(text) * 1000000000
+    except ValueError:
+        return int(float(text) * 1000000000)
+
+def parse_graphite(line):
+    """Parse "name value timestamp", return (name, value, timestamp)."""
+    name, value, timestamp = line.split()
+    return name, parse_value(value), parse_timestamp(timestamp)
+
+def parse_statsd(line):
+    """Parse "name:value|type[|@rate]", return (name, value, type, rate)."""
+    name, _, rest = line.rpartition(":")
+    fields = rest.split("|")
+    if not name or len(fields) < 2:
+        raise ValueError("Not a statsd line: %r" % line)
+    rate = 1.0
+    if len(fields) > 2 and fields[2].startswith("@"):
+        rate = float(fields[2][1:])
+        if not 0 < rate <= 1:
+            raise ValueError("Bad sample rate: %r" % line)
+    return name, float(fields[0]), fields[1], rate
+
+def parse_collectd(line):
+    """Parse 'PUTVAL identifier [option=value ...] time:value[:value...]',
+    return (name, timestamp or None for "N", [values]).
+    """
+    words = line.split()
+    if len(words) < 3 or words[0] != "PUTVAL":
+        raise ValueError("Not a PUTVAL line: %r" % line)
+    fields = words[-1].split(":")
+    timestamp = None if fields[0] == "N" else parse_timestamp(fields[0])
+    return words[1].strip('"'), timestamp, [ parse_value(value) for value in fields[1:] ]
+
+
+class IngestServer(object):
+
+    """
+    Parses metric lines and writes them through a Marquise handle. The
+    listeners hand it raw bytes with `feed`; it can also be fed directly,
+    which is how the tests and the load-test harness drive it.
+
+    It must only be used from the event loop's thread, which is also the
+    only thread that touches the Marquise handle.
+    """
+
+    def __init__(self, marquise, loop, flush_interval=10.0, batch_size=10000, max_series=1000000):
+        """Write to `marquise` from `loop`.
+
+        Arguments:
+        marquise -- the Marquise handle to write to.
+        loop -- the asyncio event loop to run on.
+        flush_interval -- the seconds between flushes of aggregated
+            statsd metrics.
+        batch_size -- the most datapoints to hold before writing them.
+        max_series -- the number of series whose addresses are
+            remembered. When there are more, they're all forgotten, and
+            source dicts are sent again as series are seen again. The
+            values of statsd gauges are kept apart and never forgotten,
+            as statsd does, so "+N" and "-N" lines stay correct.
+        """
+        self.marquise = marquise
+        self.loop = loop
+        self.batch_size = batch_size
+        self.max_series = max_series
+        self.aggregator = Aggregator(marquise, interval=flush_interval, start=False)
+        self.listeners = []
+
+        self.lines = dict([ (protocol, 0) for protocol in PROTOCOLS ])
+        self.bad_lines = 0
+        self.points = 0
+        self.sources = 0
+        self.errors = 0
+        self.last_error = None
+
+        # Keyed by metric name as received, so that a line for a known
+        # series costs one dict lookup; see `address`.
+        self._series = {}
+        self._timers = {}
+        # The current value of each statsd gauge by address, for "+N" and
+        # "-N" gauge lines, which change it rather than set it. Unlike the
+        # caches above it's never emptied, or the next delta would be
+        # applied to zero.
+        self._gauges = {}
+        self._simple = ([], [], [])
+        self._extended = ([], [], [])
+        self._flush_scheduled = False
+        self._closed = False
+        self._aggregator_timer = loop.call_later(flush_interval, self._flush_aggregator)
+
+    def _remember(self, cache, key, value):
+        """Add an entry to one of the series caches, emptying it first if
+        it's full. Intended for internal use.
+        """
+        if len(cache) >= self.max_series:
+            cache.clear()
+        cache[key] = value
+
+    def _send_source(self, metadata_dict):
+        """Send the source dict of a new series, return its address.
+        Intended for internal use.
+        """
+        address = self.marquise.hash_identifier(identifier_for(metadata_dict))
+        self.marquise.update_source(address, metadata_dict)
+        self.sources += 1
+        return address
+
+    def address(self, name, index=None):
+        """Return the address of the series for the metric `name`, or for
+        its `index`th value if it has several, sending the source dict if
+        the series is new.
+        """
+        key = name if index is None else (name, index)
+        address = self._series.get(key)
+        if address is None:
+            metadata_dict = {'metric': clean(name)}
+            if index is not None:
+                metadata_dict['index'] = str(index)
+            address = self._send_source(metadata_dict)
+            self._remember(self._series, key, address)
+        return address
+
+    def _timer_identifier(self, name):
+        """Return the identifier of the statsd timer `name`, sending the
+        source dicts of its statistics if it's new. Intended for internal
+        use.
+        """
+        identifier = self._timers.get(name)
+        if identifier is None:
+            identifier = identifier_for({'metric': clean(name)})
+            for timer_identifier in Aggregator.timer_identifiers(identifier):
+                self._send_source(dict([ pair.split(":", 1) for pair in timer_identifier.split(",") if pair ]))
+            self._remember(self._timers, name, identifier)
+        return identifier
+
+    def _feed_graphite(self, line):
+        """Queue the datapoint of one graphite line. Intended for internal use."""
+        name, value, timestamp = parse_graphite(line)
+        points = self._extended if isinstance(value, bytes) else self._simple
+        points[0].append(self.address(name))
+        points[1].append(timestamp)
+        points[2].append(value)
+
+    def _feed_statsd(self, line):
+        """Hand one statsd line to the aggregator. Intended for internal use."""
+        name, value, kind, rate = parse_statsd(line)
+        if kind == 'c':
+            self.aggregator.incr(self.address(name), int(round(value / rate)))
+        elif kind == 'g':
+            address = self.address(name)
+            if line.rpartition(":")[2][:1] in ("+", "-"):
+                value += self._gauges.get(address, 0)
+            value = int(round(value))
+            self.aggregator.gauge(address, value)
+            self._gauges[address] = value
+        elif kind in ('ms', 'h'):
+            self.aggregator.timing(self._timer_identifier(name), int(round(value)))
+        else:
+            raise ValueError("Unsupported statsd type: %r" % line)
+
+    def _feed_collectd(self, line):
+        """Queue the datapoints of one collectd PUTVAL line, one per
+        value. Intended for internal use.
+        """
+        name, timestamp, values = parse_collectd(line)
+        if timestamp is None:
+            timestamp = self.marquise.current_timestamp()
+        for i, value in enumerate(values):
+            points = self._extended if isinstance(value, bytes) else self._simple
+            points[0].append(self.address(name, i if len(values) > 1 else None))
+            points[1].append(timestamp)
+            points[2].append(value)
+
+    def feed(self, protocol, data):
+        """Parse newline-separated lines of `protocol` from the bytes in
+        `data` and queue their datapoints. Partial lines aren't handled
+        here; stream listeners hold them back.
+        """
+        feed_line = getattr(self, '_feed_' + protocol)
+        n_lines = 0
+        for line in data.decode('utf8', 'replace').splitlines():
+            if not line or line.isspace():
+                continue
+            n_lines += 1
+            try:
+                feed_line(line)
+            except (ValueError, TypeError):
+                self.bad_lines += 1
+            except RuntimeError as exc:
+                # Sending a new series' source dict failed. Keep going with
+                # the rest of the lines, the series is retried when next seen.
+                self.errors += 1
+                self.last_error = exc
+        self.lines[protocol] += n_lines
+        if len(self._simple[0]) + len(self._extended[0]) >= self.batch_size:
+            self.flush_points()
+        elif not self._flush_scheduled and (self._simple[0] or self._extended[0]):
+            # Everything parsed in this pass of the loop goes in one batch.
+            self._flush_scheduled = True
+            self.loop.call_soon(self.flush_points)
+
+    def flush_points(self):
+        """Write every queued datapoint, in one call per kind."""
+        self._flush_scheduled = False
+        for points, send_many in ((self._simple, self.marquise.send_simple_many), (self._extended, self.marquise.send_extended_many)):
+            if not points[0]:
+                continue
+            try:
+                self.points += send_many(*points)
+            except Exception as exc: # pylint: disable=broad-except
+                # Keep serving, the next batch may well succeed.
+                self.errors += 1
+                self.last_error = exc
+            for column in points:
+                del column[:]
+
+    def _flush_aggregator(self):
+        """Flush the statsd aggregates and schedule the next flush.
+        Intended for internal use.
+        """
+        try:
+            self.points += self.aggregator.flush()
+        except Exception as exc: # pylint: disable=broad-except
+            self.errors += 1
+            self.last_error = exc
+        if not self._closed:
+            self._aggregator_timer = self.loop.call_later(self.aggregator.interval, self._flush_aggregator)
+
+    def listen(self, spec):
+        """Start listening as described by `spec`, eg.
+        "statsd=udp://127.0.0.1:8125", "graphite=tcp://:2003" or
+        "collectd=unix:///run/collectd.sock". Return the bound address.
+        """
+        protocol, transport, address = parse_listen(spec)
+        if transport == 'udp':
+            listener = DatagramListener(self, protocol, address)
+            self.listeners.append(listener)
+            return listener.sock.getsockname()
+
+        def protocol_factory():
+            """Make a protocol instance for a new connection."""
+            return StreamProtocol(self, protocol)
+        if transport == 'tcp':
+            server = self.loop.run_until_complete(self.loop.create_server(protocol_factory, address[0], address[1], reuse_address=True))
+        else:
+            if os.path.exists(address):
+                os.unlink(address)
+            server = self.loop.run_until_complete(self.loop.create_unix_server(protocol_factory, address))
+        self.listeners.append(server)
+        return server.sockets[0].getsockname()
+
+    def close(self):
+        """Stop listening, write everything queued, flush the aggregates
+        and close the Marquise handle.
+        """
+        self._closed = True
+        self._aggregator_timer.cancel()
+        for listener in self.listeners:
+            listener.close()
+        self.flush_points()
+        self._flush_aggregator()
+        self.aggregator.close()
+
+    def stats(self):
+        """Return a dict of line, datapoint and source dict counters."""
+        return {
+            'lines':     dict(self.lines),
+            'bad_lines': self.bad_lines,
+            'points':    self.points,
+            'sources':   self.sources,
+            'errors':    self.errors,
+        }
+
+
+class DatagramListener(object):
+
+    """
+    Reads a UDP socket straight from the event loop's selector, draining
+    up to DATAGRAMS_PER_WAKEUP datagrams per wakeup, where an asyncio
+    DatagramProtocol would get one callback per datagram.
+    """
+
+    def __init__(self, server, protocol, address):
+        self.server = server
+        self.protocol = protocol
+        self.sock = socket.socket(socket.AF_INET6 if ":" in address[0] else socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 8 * 1024 * 1024)
+        self.sock.bind(address)
+        self.sock.setblocking(False)
+        self.buffer = bytearray(MAX_DATAGRAM_SIZE)
+        server.loop.add_reader(self.sock.fileno(), self._read)
+
+    def _read(self):
+        """Drain waiting datagrams. Intended for internal use."""
+        chunks = []
+        view = memoryview(self.buffer)
+        for _ in range(DATAGRAMS_PER_WAKEUP):
+            try:
+                size = self.sock.recv_into(self.buffer)
+            except socket.error as exc:
+                if exc.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    break
+                raise
+            chunks.append(view[:size].tobytes())
+        if chunks:
+            self.server.feed(self.protocol, b"\n".join(chunks))
+
+    def close(self):
+        """Stop reading and close the socket."""
+        self.server.loop.remove_reader(self.sock.fileno())
+        self.sock.close()
+
+
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
+
+if asyncio is not None:
+    class StreamProtocol(asyncio.Protocol):
+
+        """Splits a TCP or Unix stream into lines for an IngestServer."""
+
+        def __init__(self, server, protocol):
+            self.server = server
+            self.protocol = protocol
+            self.transport = None
+            self.partial = b""
+
+        def connection_made(self, transport):
+            """Keep the transport, to drop the connection if need be."""
+            self.transport = transport
+
+        def data_received(self, data):
+            """Feed every complete line, holding back a partial last line.
+            Drop the connection if the partial line is longer than
+            MAX_LINE_LENGTH.
+            """
+            data = self.partial + data
+            end = data.rfind(b"\n") + 1
+            self.partial = data[end:]
+            if end:
+                self.server.feed(self.protocol, data[:end])
+            if len(self.partial) > MAX_LINE_LENGTH:
+                self.server.bad_lines += 1
+                self.partial = b""
+                self.transport.close()
+
+        def eof_received(self):
+            """Feed the last line even if it wasn't terminated."""
+            if self.partial:
+                self.server.feed(self.protocol, self.partial)
+                self.partial = b""
+
+
+def parse_listen(spec):
+    """Return (protocol, transport, address) for a listen spec such as
+    "statsd=udp://127.0.0.1:8125". The address is a (host, port) tuple
+    for UDP and TCP, and a path for Unix sockets.
+    """
+    try:
+        protocol, url = spec.split("=", 1)
+        transport, location = url.split("://", 1)
+    except ValueError:
+        raise ValueError("Listen specs look like statsd=udp://127.0.0.1:8125, got %r" % spec)
+    if protocol not in PROTOCOLS:
+        raise ValueError("protocol must be one of %s, got %r" % (", ".join(PROTOCOLS), protocol))
+    if transport not in TRANSPORTS:
+        raise ValueError("transport must be one of %s, got %r" % (", ".join(TRANSPORTS), transport))
+    if transport == 'unix':
+        return protocol, transport, location
+    host, _, port = location.rpartition(":")
+    return protocol, transport, (host.strip("[]") or "0.0.0.0", int(port))
+
+
+def main(argv=None):
+    """Run the marquise-ingestd daemon."""
+    parser = argparse.ArgumentParser(prog="marquise-ingestd", description="Write statsd, graphite and collectd metrics to the Marquise spool.")
+    parser.add_argument("namespace", help="the Marquise namespace to write to")
+    parser.add_argument("--listen", action="append", metavar="PROTOCOL=TRANSPORT://ADDRESS", help="eg. statsd=udp://127.0.0.1:8125, graphite=tcp://:2003 or collectd=unix:///run/collectd.sock; may be repeated. Default: %s" % " ".join(DEFAULT_LISTEN))
+    parser.add_argument("--flush-interval", type=float, default=10.0, help="seconds between statsd flushes")
+    parser.add_argument("--batch-size", type=int, default=10000, help="the most datapoints to hold before writing")
+    parser.add_argument("--backend", choices=('cffi', 'native'), default='cffi')
+    args = parser.parse_args(argv)
+
+    if asyncio is None:
+        raise RuntimeError("marquise-ingestd needs asyncio, which is in Python 3.4 and later")
+
+    if args.backend == 'native':
+        from .native import NativeMarquise
+        marquise = NativeMarquise(args.namespace)
+    else:
+        from .marquise import Marquise
+        marquise = Marquise(args.namespace)
+
+    loop = asyncio.new_event_loop()
+    server = IngestServer(marquise, loop, flush_interval=args.flush_interval, batch_size=args.batch_size)
+    try:
+        for spec in args.listen or DEFAULT_LISTEN:
+            print("Listening for %s on %s" % (spec.split("=", 1)[0], server.listen(spec)))
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, loop.stop)
+        loop.run_forever()
+    finally:
+        server.close()
+        loop.close()
+    print("Wrote %(points)d datapoints and %(sources)d source dicts, %(bad_lines)d bad lines" % server.stats())
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,507 @@
+# pylint: disable=line-too-long
+# pylint: disable=bad-whitespace
+
+"""This module provides marquise-load, a bulk loader for backfilling
+historical data from flat files into the Marquise spool.
+
+Each input file is a CSV file with a header row, or a JSON Lines file of
+one object per row, with these columns or keys:
+
+- identifier or address -- the series, as an identifier string to hash
+  or as a 64-bit address.
+- timestamp -- in the unit given by --timestamp-unit, nanoseconds by
+  default.
+- value -- an integer from 0 to 2**64 - 1 is written as a simple
+  datapoint, anything else as an extended datapoint holding its text.
+- source (optional) -- the source dict, as a JSON object or a serialised
+  "key:value," string. Rows with an identifier and no source dict use
+  the identifier's own key:value pairs, if it has any.
+
+Rows with a timestamp or address outside 0 to 2**64 - 1 are skipped as
+bad rows.
+
+A source dict is sent the first time its series is seen in a run. CSV
+fields can be double-quoted, and can then hold commas and newlines.
+
+Files are read in chunks of rows, so memory use doesn't grow with the
+size of the input. The parent process parses each chunk and splits it by
+address between a pool of writer processes. Every writer owns its own
+Marquise handle, and so its own namespace (`namespace0` to `namespaceN`,
+as for MarquisePool), because libmarquise allows only one context per
+namespace. All of a series' datapoints are written by the same writer, in
+file order.
+
+With --checkpoint, the byte offset reached in each file is saved as
+chunks are fully written, and a rerun with the same checkpoint file picks
+up from there. Rows written after the last checkpoint may be written
+again.
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import csv
+import json
+import time
+import argparse
+import multiprocessing
+from array import array
+
+import six
+from six.moves import queue
+
+from .ingestd import parse_value, MAX_UINT64
+
+FORMATS = ('csv', 'jsonl')
+FORMAT_EXTENSIONS = {'.csv': 'csv', '.jsonl': 'jsonl', '.ndjson': 'jsonl', '.json': 'jsonl'}
+TIMESTAMP_UNITS = {'s': 1000000000, 'ms': 1000000, 'us': 1000, 'ns': 1}
+
+# Each writer holds at most this many chunks queued.
+QUEUE_DEPTH = 4
+
+def parse_source(source):
+    """Return a source dict given a dict, or a "key:value," string such
+    as an identifier. Raise ValueError for anything else.
+    """
+    if isinstance(source, dict):
+        return dict([ (str(key), str(value)) for key, value in source.items() ])
+    if not isinstance(source, six.string_types):
+        raise ValueError("Not a source dict: %r" % (source,))
+    pairs = [ pair.split(":", 1) for pair in source.split(",") if pair ]
+    if not pairs or any([ len(pair) != 2 for pair in pairs ]):
+        raise ValueError("Not a source dict: %r" % (source,))
+    return dict(pairs)
+
+def row_value(value):
+    """Return a datapoint value for a CSV field or JSON value: an integer
+    for a simple datapoint, or bytes for an extended one.
+    """
+    if isinstance(value, bool) or value is None:
+        raise ValueError("Not a datapoint value: %r" % (value,))
+    if isinstance(value, six.string_types):
+        try:
+            return parse_value(value)
+        except ValueError:
+            return value.encode('utf8')
+    return parse_value(repr(value))
+
+def row_timestamp(timestamp, scale):
+    """Return nanoseconds since epoch for a CSV field or JSON number in
+    units of `scale` nanoseconds.
+    """
+    if isinstance(timestamp, bool):
+        raise ValueError("Not a timestamp: %r" % (timestamp,))
+    if isinstance(timestamp, six.integer_types):
+        nanoseconds = timestamp * scale
+    else:
+        try:
+            nanoseconds = int(timestamp) * scale
+        except ValueError:
+            nanoseconds = int(float(timestamp) * scale)
+    if not 0 <= nanoseconds <= MAX_UINT64:
+        raise ValueError("Timestamp out of range: %r" % (timestamp,))
+    return nanoseconds
+
+def row_address(address):
+    """Return the address for a CSV field or JSON number."""
+    if isinstance(address, bool):
+        raise ValueError("Not an address: %r" % (address,))
+    address = int(address)
+    if not 0 <= address <= MAX_UINT64:
+        raise ValueError("Address out of range: %r" % (address,))
+    return address
+
+def csv_rows(lines, header):
+    """Yield a dict for each CSV row in `lines`, keyed by `header`."""
+    for fields in csv.reader(lines):
+        if fields:
+            yield dict(zip(header, fields))
+
+def jsonl_rows(lines):
+    """Yield the object on each non-blank line of `lines`."""
+    for line in lines:
+        if line.strip():
+            row = json.loads(line)
+            if not isinstance(row, dict):
+                raise ValueError("Not a JSON object: %r" % line)
+            yield row
+
+def read_chunks(path, offset, chunk_rows, quoted=False):
+    """Yield (lines, end_offset) for chunks of up to `chunk_rows` rows of
+    the file at `path` from byte `offset`, decoded from UTF-8.
+
+    A row is a line, or if `quoted`, as many lines as it takes to close
+    every double-quoted CSV field, so that a field holding a newline
+    isn't split between chunks.
+    """
+    with open(path, 'rb') as input_file:
+        input_file.seek(offset)
+        while True:
+            lines = []
+            for _ in range(chunk_rows):
+                line = input_file.readline()
+                if not line:
+                    break
+                lines.append(line.decode('utf8'))
+                # An escaped quote is doubled, so the quotes seen so far
+                # only pair up once the row is complete.
+                quotes = line.count(b'"') if quoted else 0
+                while quotes % 2:
+                    line = input_file.readline()
+                    if not line:
+                        break
+                    lines.append(line.decode('utf8'))
+                    quotes += line.count(b'"')
+            if not lines:
+                return
+            yield lines, input_file.tell()
+
+class Partition(object):
+
+    """The datapoints and source dicts of one chunk bound for one writer."""
+
+    __slots__ = ('simple', 'extended', 'sources')
+
+    def __init__(self):
+        self.simple = (array('Q'), array('Q'), array('Q'))
+        self.extended = ([], [], [])
+        self.sources = []
+
+
+def write_partitions(index, namespace, backend, spool_dir, tasks, acks):
+    """Writer process main loop: write each (chunk_id, Partition) from
+    `tasks` until None, acknowledging each on `acks` with (chunk_id,
+    n_points, n_sources, index). On failure, including failing to open
+    the handle, ('error', namespace, message) is sent instead and the
+    writer stops.
+    """
+    marquise = None
+    try:
+        if backend == 'native':
+            from .native import NativeMarquise
+            marquise = NativeMarquise(namespace, spool_dir=spool_dir)
+        else:
+            from .marquise import Marquise
+            marquise = Marquise(namespace)
+        for chunk_id, partition in iter(tasks.get, None):
+            if partition.sources:
+                failures = marquise.update_sources(partition.sources)
+                if failures:
+                    raise failures[next(iter(failures))]
+            n_points = 0
+            if partition.simple[0]:
+                n_points += marquise.send_simple_many(*partition.simple)
+            if partition.extended[0]:
+                n_points += marquise.send_extended_many(*partition.extended)
+            acks.put((chunk_id, n_points, len(partition.sources), index))
+    except Exception as exc: # pylint: disable=broad-except
+        acks.put(('error', namespace, "%s: %s" % (exc.__class__.__name__, exc)))
+    finally:
+        if marquise is not None:
+            marquise.close()
+
+
+class Loader(object):
+
+    """
+    Loads CSV and JSON Lines files into the spool through a pool of
+    writer processes; see the module documentation.
+    """
+
+    def __init__(self, namespace, workers=4, backend='cffi', timestamp_unit='ns', chunk_rows=10000, checkpoint=None, spool_dir=None, max_series=1000000):
+        """Prepare to load into `workers` namespaces prefixed `namespace`.
+
+        Arguments:
+        namespace -- the prefix for each writer's namespace.
+        workers -- the number of writer processes.
+        backend -- 'cffi' or 'native', as for Marquise.
+        timestamp_unit -- the unit of timestamps in the input, one of
+            TIMESTAMP_UNITS.
+        chunk_rows -- the rows read and handed out at a time.
+        checkpoint -- a path to save progress to and resume from, or None.
+        spool_dir -- the spool directory for the native backend.
+        max_series -- the number of series whose addresses are
+            remembered. When there are more, they're all forgotten, and
+            source dicts are sent again as series are seen again.
+        """
+        if workers < 1:
+            raise ValueError("workers must be positive, got %r" % workers)
+        if timestamp_unit not in TIMESTAMP_UNITS:
+            raise ValueError("timestamp_unit must be one of %s, got %r" % (", ".join(sorted(TIMESTAMP_UNITS)), timestamp_unit))
+        if backend == 'native':
+            from .native import NativeMarquise
+            self.hash_identifier = NativeMarquise.hash_identifier
+        elif backend == 'cffi':
+            from .marquise import Marquise
+            self.hash_identifier = Marquise.hash_identifier
+        else:
+            raise ValueError("backend must be 'cffi' or 'native', got %r" % backend)
+        self.namespace = namespace
+        self.workers = workers
+        self.backend = backend
+        self.scale = TIMESTAMP_UNITS[timestamp_unit]
+        self.chunk_rows = chunk_rows
+        self.checkpoint = checkpoint
+        self.spool_dir = spool_dir
+        self.max_series = max_series
+
+        self.rows = 0
+        self.bad_rows = 0
+        self.points = 0
+        self.sources = 0
+        self.bytes_read = 0
+        self.first_errors = []
+
+        self._series = {}
+        self._offsets = {}
+        if checkpoint is not None and os.path.exists(checkpoint):
+            with open(checkpoint) as checkpoint_file:
+                self._offsets = json.load(checkpoint_file)['offsets']
+
+    def _address(self, row, partition_of):
+        """Return the address for a row, queueing its source dict on the
+        partition it belongs to if the series is new. Intended for
+        internal use.
+        """
+        identifier = row.get('identifier')
+        key = identifier if identifier else row_address(row['address'])
+        address = self._series.get(key)
+        if address is None:
+            address = self.hash_identifier(identifier) if identifier else key
+            source = row.get('source')
+            if source:
+                source = parse_source(source)
+            elif identifier:
+                # An identifier that isn't in "key:value," form is still
+                # hashed, it just has no source dict to send.
+                try:
+                    source = parse_source(identifier)
+                except ValueError:
+                    source = None
+            if source:
+                partition_of(address).sources.append((address, source))
+            if len(self._series) >= self.max_series:
+                self._series.clear()
+            self._series[key] = address
+        return address
+
+    def _partition(self, rows, path):
+        """Split `rows` into one Partition per writer. Intended for
+        internal use.
+        """
+        partitions = [ Partition() for _ in range(self.workers) ]
+        workers = self.workers
+        def partition_of(address):
+            """Return the partition that `address` is written by."""
+            return partitions[(address >> 1) % workers]
+        scale = self.scale
+        address_of = self._address
+        rows = iter(rows)
+        while True:
+            try:
+                row = next(rows)
+                self.rows += 1
+                timestamp = row_timestamp(row['timestamp'], scale)
+                value = row_value(row['value'])
+                address = address_of(row, partition_of)
+            except StopIteration:
+                return partitions
+            except (ValueError, TypeError, KeyError) as exc:
+                self.bad_rows += 1
+                if len(self.first_errors) < 10:
+                    self.first_errors.append("%s: %s: %s" % (path, exc.__class__.__name__, exc))
+                continue
+            columns = partition_of(address).extended if isinstance(value, bytes) else partition_of(address).simple
+            columns[0].append(address)
+            columns[1].append(timestamp)
+            columns[2].append(value)
+
+    def _save_checkpoint(self):
+        """Write the offsets reached to the checkpoint file, atomically.
+        Intended for internal use.
+        """
+        temporary = self.checkpoint + ".tmp"
+        with open(temporary, 'w') as checkpoint_file:
+            json.dump({'offsets': self._offsets}, checkpoint_file, indent=2, sort_keys=True)
+        os.rename(temporary, self.checkpoint)
+
+    def load(self, paths, input_format=None, progress=None, progress_interval=10.0):
+        """Load every file in `paths`, return the stats dict.
+
+        Arguments:
+        paths -- the files to load, in order.
+        input_format -- one of FORMATS, or None to go by each file's
+            extension.
+        progress -- a function called with the stats dict every
+            `progress_interval` seconds, or None.
+
+        Raises RuntimeError if a writer fails. Everything acknowledged
+        before then is in the checkpoint.
+        """
+        formats = []
+        for path in paths:
+            path_format = input_format or FORMAT_EXTENSIONS.get(os.path.splitext(path)[1].lower())
+            if path_format not in FORMATS:
+                raise ValueError("Can't tell the format of %s, give it with --format" % path)
+            formats.append(path_format)
+
+        tasks = [ multiprocessing.Queue(QUEUE_DEPTH) for _ in range(self.workers) ]
+        acks = multiprocessing.Queue()
+        writers = [ multiprocessing.Process(target=write_partitions, args=(i, "%s%d" % (self.namespace, i), self.backend, self.spool_dir, tasks[i], acks)) for i in range(self.workers) ]
+        for writer in writers:
+            writer.daemon = True
+            writer.start()
+
+        # Chunks handed out, in order: [chunk_id, writers yet to finish it, path, end offset]
+        pending = []
+        # Chunks handed to each writer and not yet acknowledged.
+        outstanding = [0] * self.workers
+        state = {'chunk_id': 0, 'saved': time.time(), 'reported': time.time()}
+        start = time.time()
+
+        def check_writers(indices):
+            """Raise RuntimeError if any of the writers at `indices` has
+            exited, with its error if it sent one.
+            """
+            for i in indices:
+                if writers[i].is_alive():
+                    continue
+                # A writer's acknowledgements are all in the queue by the
+                # time it has exited, so look for its error there.
+                try:
+                    while True:
+                        ack = acks.get(False)
+                        if ack[0] == 'error':
+                            raise RuntimeError("Writer for namespace %s failed: %s" % (ack[1], ack[2]))
+                except queue.Empty:
+                    pass
+                raise RuntimeError("Writer for namespace %s%d exited with datapoints still queued" % (self.namespace, i))
+
+        def collect(block):
+            """Take acknowledgements, then advance the checkpoint past the
+            leading chunks every writer has finished.
+            """
+            while pending:
+                try:
+                    ack = acks.get(block, 1.0)
+                except queue.Empty:
+                    check_writers([ i for i in range(self.workers) if outstanding[i] ])
+                    if block:
+                        continue
+                    break
+                if ack[0] == 'error':
+                    raise RuntimeError("Writer for namespace %s failed: %s" % (ack[1], ack[2]))
+                chunk_id, n_points, n_sources, index = ack
+                self.points += n_points
+                self.sources += n_sources
+                outstanding[index] -= 1
+                pending[chunk_id - pending[0][0]][1] -= 1
+                block = block and any([ chunk[1] for chunk in pending ])
+            while pending and pending[0][1] == 0:
+                _, _, path, offset = pending.pop(0)
+                self._offsets[path] = offset
+            now = time.time()
+            if self.checkpoint is not None and (now - state['saved'] >= 1.0 or not pending):
+                self._save_checkpoint()
+                state['saved'] = now
+            if progress is not None and now - state['reported'] >= progress_interval:
+                progress(self.stats(now - start))
+                state['reported'] = now
+
+        def hand_out(i, item):
+            """Queue `item` for writer `i`, collecting acknowledgements
+            while its queue is full so that a failed writer is noticed.
+            """
+            while True:
+                try:
+                    tasks[i].put(item, True, 1.0)
+                    break
+                except queue.Full:
+                    collect(False)
+                    check_writers([i])
+            if item is not None:
+                outstanding[i] += 1
+
+        try:
+            for path, path_format in zip(paths, formats):
+                key = os.path.abspath(path)
+                offset = self._offsets.get(key, 0)
+                header = None
+                if path_format == 'csv':
+                    header_lines, header_end = next(read_chunks(path, 0, 1, True), ([], 0))
+                    header = [ column.strip() for column in next(csv.reader(header_lines), []) ]
+                    offset = max(offset, header_end)
+                for lines, end_offset in read_chunks(path, offset, self.chunk_rows, path_format == 'csv'):
+                    self.bytes_read += end_offset - offset
+                    offset = end_offset
+                    rows = csv_rows(lines, header) if path_format == 'csv' else jsonl_rows(lines)
+                    partitions = self._partition(rows, path)
+                    chunk_id = state['chunk_id']
+                    state['chunk_id'] += 1
+                    pending.append([chunk_id, self.workers, key, end_offset])
+                    for i, partition in enumerate(partitions):
+                        hand_out(i, (chunk_id, partition))
+                    collect(False)
+            for i in range(self.workers):
+                hand_out(i, None)
+            collect(True)
+        except BaseException:
+            for writer in writers:
+                writer.terminate()
+            raise
+        finally:
+            for writer in writers:
+                writer.join()
+        if progress is not None:
+            progress(self.stats(time.time() - start))
+        return self.stats(time.time() - start)
+
+    def stats(self, seconds=None):
+        """Return a dict of the rows read and datapoints and source dicts
+        written, with the rows per second if `seconds` is given.
+        """
+        stats = {
+            'rows':       self.rows,
+            'bad_rows':   self.bad_rows,
+            'points':     self.points,
+            'sources':    self.sources,
+            'bytes_read': self.bytes_read,
+        }
+        if seconds:
+            stats['rows_per_sec'] = self.rows / seconds
+        return stats
+
+
+def print_progress(stats):
+    """Print a line of progress to stderr."""
+    print("%(rows)d rows (%(bad_rows)d bad), %(points)d datapoints, %(sources)d source dicts, %(rows_per_sec).0f rows/sec" % dict(stats, rows_per_sec=stats.get('rows_per_sec', 0)), file=sys.stderr)
+
+
+def main(argv=None):
+    """Run the marquise-load command-line tool."""
+    parser = argparse.ArgumentParser(prog="marquise-load", description="Backfill datapoints from CSV or JSON Lines files into the Marquise spool.")
+    parser.add_argument("namespace", help="the prefix for each writer's namespace")
+    parser.add_argument("paths", nargs="+", metavar="FILE")
+    parser.add_argument("--format", choices=FORMATS, help="the input format, by default from each file's extension")
+    parser.add_argument("--workers", type=int, default=4, help="the number of writer processes")
+    parser.add_argument("--backend", choices=('cffi', 'native'), default='cffi')
+    parser.add_argument("--timestamp-unit", choices=sorted(TIMESTAMP_UNITS), default='ns')
+    parser.add_argument("--chunk-rows", type=int, default=10000, help="the rows read and handed out at a time")
+    parser.add_argument("--checkpoint", metavar="PATH", help="save progress to PATH, and resume from it if it exists")
+    parser.add_argument("--progress", type=float, default=10.0, metavar="SECONDS", help="seconds between progress reports")
+    args = parser.parse_args(argv)
+
+    loader = Loader(args.namespace, workers=args.workers, backend=args.backend, timestamp_unit=args.timestamp_unit, chunk_rows=args.chunk_rows, checkpoint=args.checkpoint)
+    try:
+        loader.load(args.paths, args.format, print_progress, args.progress)
+    except RuntimeError as exc:
+        print(exc, file=sys.stderr)
+        return 1
+    finally:
+        for error in loader.first_errors:
+            print("Skipped a bad row in %s" % error, file=sys.stderr)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,76 @@
+# pylint: disable=line-too-long
+# pylint: disable=bad-whitespace
+
+"""This module provides a small bounded LRU mapping, used to keep caches of
+per-address and per-identifier state from growing without limit.
+"""
+
+from collections import OrderedDict
+
+class LRUCache(object):
+
+    """
+    A dict-like mapping holding at most `maxsize` entries, evicting the
+    least recently used entry when full. Lookups through `get` are counted
+    as hits or misses, and evictions are counted too; see `stats`.
+    """
+
+    def __init__(self, maxsize):
+        """Create an empty cache.
+
+        Arguments:
+        maxsize -- the maximum number of entries to hold, must be positive.
+        """
+        if maxsize < 1:
+            raise ValueError("maxsize must be positive, got %r" % maxsize)
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        """Return the value for `key` and mark it as recently used, or
+        `default` if it isn't cached.
+        """
+        try:
+            value = self._entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        self._entries[key] = value
+        self.hits += 1
+        return value
+
+    def __setitem__(self, key, value):
+        entries = self._entries
+        if key in entries:
+            del entries[key]
+        elif len(entries) >= self.maxsize:
+            entries.popitem(last=False)
+            self.evictions += 1
+        entries[key] = value
+
+    def pop(self, key, default=None):
+        """Remove `key` from the cache, returning its value or `default`."""
+        return self._entries.pop(key, default)
+
+    def clear(self):
+        """Empty the cache. The statistics are left alone."""
+        self._entries.clear()
+
+    def stats(self):
+        """Return a dict of the cache's hit, miss and eviction counts."""
+        return {
+            'hits':      self.hits,
+            'misses':    self.misses,
+            'evictions': self.evictions,
+            'size':      len(self._entries),
+            'maxsize':   self.maxsize,
+        }
@@ -5,9 +5,19 @@
 libmarquise.
 """
 
+import os
 import time
 import errno
-from .marquise_cffi import FFI, cprint, cstring, len_cstring, is_cnull, C_LIBMARQUISE
+import weakref
+from contextlib import contextmanager
+from .oslo_strutils import safe_encode
+from .lru import LRUCache
+from .errors import BatchWriteError
+from .native import NativeMarquise, fsync_path
+from .clock import time_ns
+from .stats import WriteStats, WRITE_METHODS
+from .trace import Tracer, print_hook
+from .marquise_cffi import FFI, cprint, cstring, is_cnull, uint64_buffer, pack_bytestrings, C_LIBMARQUISE
 
 # This keeps pylint happy
 # pylint: disable=no-member
@@ -19,8 +29,46 @@ MARQUISE_SEND_EXTENDED = C_LIBMARQUISE.marquise_send_extended
 MARQUISE_NEW_SOURCE = C_LIBMARQUISE.marquise_new_source
 MARQUISE_UPDATE_SOURCE = C_LIBMARQUISE.marquise_update_source
 MARQUISE_FREE_SOURCE = C_LIBMARQUISE.marquise_free_source
+PYMARQUISE_HASH_IDENTIFIERS = C_LIBMARQUISE.pymarquise_hash_identifiers
+PYMARQUISE_SEND_SIMPLE_MANY = C_LIBMARQUISE.pymarquise_send_simple_many
+PYMARQUISE_CHECK_EXTENTS = C_LIBMARQUISE.pymarquise_check_extents
+PYMARQUISE_SEND_EXTENDED_MANY = C_LIBMARQUISE.pymarquise_send_extended_many
 # pylint: enable=no-member
 
+
+BACKENDS = ('cffi', 'native')
+
+# Handles that need a fresh context in a forked child, see Marquise.after_fork.
+LIVE_HANDLES = weakref.WeakSet()
+
+def _after_fork_in_child():
+    """Give every live handle its own context in a newly forked child."""
+    for handle in list(LIVE_HANDLES):
+        handle.after_fork()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+@contextmanager
+def spool_dir_environment(spool_dir):
+    """Set $MARQUISE_SPOOL_DIR to `spool_dir` for the block, and restore it
+    after, as libmarquise only reads its spool directory from there. Does
+    nothing if `spool_dir` is None.
+    """
+    if spool_dir is None:
+        yield
+        return
+    saved = os.environ.get("MARQUISE_SPOOL_DIR")
+    os.environ["MARQUISE_SPOOL_DIR"] = spool_dir
+    try:
+        yield
+    finally:
+        if saved is None:
+            del os.environ["MARQUISE_SPOOL_DIR"]
+        else:
+            os.environ["MARQUISE_SPOOL_DIR"] = saved
+
+
 class Marquise(object):
 
     """
@@ -29,46 +77,253 @@ class Marquise(object):
     metadata about datapoints.
     """
 
-    def __init__(self, namespace, debug=False):
+    def __new__(cls, namespace, debug=False, source_cache=None, backend='cffi', stats=False, tracer=None, clock=None, spool_dir=None):
+        """Return a NativeMarquise instead for the 'native' backend."""
+        if backend not in BACKENDS:
+            raise ValueError("backend must be one of %s, got %r" % (", ".join(BACKENDS), backend))
+        if backend == 'native':
+            return NativeMarquise(namespace, debug=debug, source_cache=source_cache, spool_dir=spool_dir, stats=stats, tracer=tracer, clock=clock)
+        return object.__new__(cls)
+
+    def __init__(self, namespace, debug=False, source_cache=None, backend='cffi', stats=False, tracer=None, clock=None, spool_dir=None):
         """Establish a marquise context for the provided namespace,
         getting spool filenames.
 
         Arguments:
         namespace -- must be lowercase alphanumeric ([a-z0-9]+).
-        debug -- if debug is True, debugging output will be printed.
+        debug -- if debug is True, debugging output will be printed. This
+            is shorthand for a `tracer` with the print_hook.
+        source_cache -- if set, `update_source` remembers a digest of the
+            last source dict sent for each address and skips resending it
+            unchanged. Either the maximum number of addresses to remember,
+            or a mapping-like object with `get` and item assignment, such
+            as an LRUCache.
+        backend -- 'cffi' (the default) writes through libmarquise, and
+            'native' returns a NativeMarquise, which writes the same spool
+            files from Python without libmarquise.
+        stats -- if True, count and time every write, see `stats`.
+        tracer -- a Tracer to report every write to as a structured
+            event. It can be set or cleared later through the `tracer`
+            attribute.
+        clock -- the Clock that stamps datapoints sent without a
+            timestamp, such as a shared CoarseClock, by default the
+            system clock. The handle doesn't close it.
+        spool_dir -- the spool directory, by default $MARQUISE_SPOOL_DIR
+            or /var/spool/marquise.
         """
         self.debug_enabled = debug
+        if debug and tracer is None:
+            tracer = Tracer([print_hook])
+        self.tracer = tracer
+        if isinstance(source_cache, int):
+            source_cache = LRUCache(source_cache) if source_cache > 0 else None
+        self.source_cache = source_cache
+        self.clock = clock
+        self.spool_dir = spool_dir
+        if clock is not None:
+            self.current_timestamp = clock.now
+        self.namespace = namespace
         self.namespace_c = cstring(namespace)
-        self.marquise_ctx = MARQUISE_INIT(self.namespace_c)
+        self.marquise_ctx = None
+        self.__forked = False
+        self.write_stats = None
+        if stats:
+            self.write_stats = WriteStats(WRITE_METHODS, errno_of=lambda exc: getattr(exc, 'errno', None) or FFI.errno)
+            self.write_stats.instrument(self)
+        self.__open()
+        LIVE_HANDLES.add(self)
+
+    def __open(self):
+        """Initialise a new marquise context for this handle's namespace.
+        Intended for internal use.
+        """
+        with spool_dir_environment(self.spool_dir):
+            self.marquise_ctx = MARQUISE_INIT(self.namespace_c)
         if is_cnull(self.marquise_ctx):
+            self.marquise_ctx = None
             if FFI.errno == errno.EINVAL:
-                raise ValueError("Invalid namespace: %s" % namespace)
+                raise ValueError("Invalid namespace: %s" % self.namespace)
             raise RuntimeError("Something went wrong, got NULL instead of a marquise_ctx. build_spool_path() failed, or malloc failed. errno is %d" % FFI.errno)
 
+        self.pid = os.getpid()
+        self.__forked = False
+        self.__synced_paths = set()
         self.spool_path_points   = cprint(self.marquise_ctx.spool_path_points)
         self.spool_path_contents = cprint(self.marquise_ctx.spool_path_contents)
-        # There may be useful in future, but not right now. I can't decide
-        # what a nice access method would be, maybe as attrs on Marquise?
-        #self.bytes_written_points   = self.marquise_ctx.bytes_written_points
-        #self.bytes_written_contents = self.marquise_ctx.bytes_written_contents
+        # When the current spool files were opened, for age-based rotation.
+        self.spool_opened = time.time()
+
+    def __reopen(self, message):
+        """Open this process' own context if the handle was forked and
+        hasn't written since, otherwise raise ValueError with `message`.
+        Intended for internal use.
+        """
+        if not self.__forked:
+            raise ValueError(message)
+        self.__debug("Opening a new context for pid %d, forked from pid %d" % (os.getpid(), self.pid))
+        self.__open()
+
+    @property
+    def bytes_written_points(self):
+        """Bytes written to the current points spool file, or None if the
+        handle is closed.
+        """
+        if self.marquise_ctx is None:
+            return 0 if self.__forked else None
+        return self.marquise_ctx.bytes_written_points
+
+    @property
+    def bytes_written_contents(self):
+        """Bytes written to the current contents spool file, or None if
+        the handle is closed.
+        """
+        if self.marquise_ctx is None:
+            return 0 if self.__forked else None
+        return self.marquise_ctx.bytes_written_contents
+
+    def stats(self):
+        """Return a dict snapshot of this handle's write stats.
+
+        It always holds `bytes_written_points` and `bytes_written_contents`.
+        If the handle was created with stats=True, `methods` maps each
+        write method to its counters: calls, datapoints written, calls
+        rejected for bad input, failures by errno, and `latency` and
+        `c_latency` histograms of the whole call and of the libmarquise
+        call within it.
+        """
+        snapshot = {
+            'bytes_written_points':   self.bytes_written_points,
+            'bytes_written_contents': self.bytes_written_contents,
+        }
+        if self.write_stats is not None:
+            snapshot['methods'] = self.write_stats.snapshot()
+        return snapshot
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def flush(self, durable=False):
+        """Make everything written so far safe, short of closing the handle.
+
+        libmarquise appends each write to the spool file before it
+        returns, so nothing is held back in this process and there's
+        nothing more to push out. If `durable`, both spool files are also
+        fsynced, along with their directories the first time, so that
+        what's been written survives a power failure as well as a crash.
+        """
+        if self.marquise_ctx is None:
+            if self.__forked:
+                return
+            raise ValueError("Attempted to flush a closed Marquise handle.")
+        if not durable:
+            return
+        # libmarquise may have moved on to new files since we opened.
+        for path in (cprint(self.marquise_ctx.spool_path_points), cprint(self.marquise_ctx.spool_path_contents)):
+            fsync_path(path, directory=path not in self.__synced_paths)
+            self.__synced_paths.add(path)
+
+    @contextmanager
+    def session(self, durable=False):
+        """Return a context manager that groups writes, flushing once when
+        the block ends instead of after every write:
+
+            with marq.session(durable=True):
+                for address, timestamp, value in points:
+                    marq.send_simple(address, timestamp, value)
+
+        The flush is skipped if the block raises, though whatever it
+        wrote has still been written.
+        """
+        if self.marquise_ctx is None and not self.__forked:
+            raise ValueError("Attempted to use a closed Marquise handle.")
+        yield self
+        self.flush(durable)
+
+    def consume(self, items, chunk_size=10000, update_sources=True, progress=None, progress_interval=10.0):
+        """Write every datapoint in `items`, an iterable of
+        (address, timestamp, value) tuples or dicts, in chunks with the
+        batch send methods, and return the stats dict. The iterable is read
+        lazily, so a generator of any length is written in bounded memory.
+
+        Addresses may be given as identifiers or source dicts, and
+        timestamps as None. This is a Pipeline with no stages; see
+        `marquise.pipeline.Pipeline` for the arguments, and for stages
+        that filter, dedupe or aggregate on the way.
+        """
+        from .pipeline import Pipeline
+        if self.marquise_ctx is None and not self.__forked:
+            raise ValueError("Attempted to write to a closed Marquise handle.")
+        return Pipeline(self, chunk_size, update_sources).run(items, progress, progress_interval)
+
+    def after_fork(self):
+        """Let go of the parent's marquise context after a fork, so the
+        child never writes through the parent's context and spool files.
+        The child's own context is opened on its first write, so children
+        that never write through the handle leave no spool files behind.
+        Until then, `spool_path_points` and `spool_path_contents` are None.
+
+        This is called automatically in the child where Python supports
+        os.register_at_fork, otherwise call it yourself in the child (eg.
+        from a post-fork hook). It does nothing in the process that opened
+        the handle, or if the handle is closed.
+        """
+        if self.marquise_ctx is None or self.pid == os.getpid():
+            return
+        # The parent's context belongs to the parent. Shutting it down here
+        # would flush the parent's buffered writes a second time, so just
+        # let go of our copy of it.
+        self.__debug("Forked from pid %d, pid %d will open a new context when it first writes" % (self.pid, os.getpid()))
+        self.marquise_ctx = None
+        self.__forked = True
+        self.spool_path_points = None
+        self.spool_path_contents = None
+        self.spool_opened = None
+
+    def rotate(self):
+        """Shut down the marquise context and open a new one for the same
+        namespace, so that the spool files written so far are finished
+        and can be shipped.
+
+        The new context starts with `bytes_written_points` and
+        `bytes_written_contents` at zero, and libmarquise forgets which
+        source dicts it has sent, so they're sent again unless this
+        handle has a `source_cache`.
+        """
+        if self.marquise_ctx is None:
+            if self.__forked:
+                return
+            raise ValueError("Attempted to rotate a closed Marquise handle.")
+        self.__debug("Rotating Marquise handle spooling to %s and %s" % (self.spool_path_points, self.spool_path_contents))
+        MARQUISE_SHUTDOWN(self.marquise_ctx)
+        self.marquise_ctx = None
+        self.__open()
 
     def __str__(self):
         """Return a human-readable description of the current Marquise context."""
         return "<Marquise handle spooling to %s and %s>" % (self.spool_path_points, self.spool_path_contents)
 
     def __debug(self, msg):
-        """Print `msg` if debugging is enabled on this instance. Intended for internal use."""
-        if self.debug_enabled:
-            print("DEBUG: %s" % msg)
+        """Emit `msg` as a debug event if tracing is enabled on this
+        instance. Only for messages off the write path, which are
+        formatted whether tracing is enabled or not. Intended for
+        internal use.
+        """
+        if self.tracer is not None:
+            self.tracer.emit('debug', message=msg)
 
     def close(self):
         """Close the Marquise context, ensuring data is flushed and
         spool files are closed.
 
-        This should always be closed explicitly, as there's no
-        guarantees that it will happen when the instance is deleted.
+        This should always be closed explicitly, or by using the handle
+        as a context manager, as there's no guarantees that it will happen
+        when the instance is deleted.
         """
         if self.marquise_ctx is None:
+            self.__forked = False
             self.__debug("Marquise handle is already closed, will do nothing.")
             # Multiple close() calls are okay.
             return
@@ -89,12 +344,39 @@ class Marquise(object):
         The output is an integer, which is used as the `address` of
         datapoints belonging to the given `identifier` string.
         """
-        return MARQUISE_HASH_IDENTIFIER(cstring(identifier), len(identifier) )
+        # Hash the encoded bytes, the length of a non-ASCII identifier in
+        # characters is shorter than its length in bytes.
+        encoded = safe_encode(identifier, 'utf8')
+        return MARQUISE_HASH_IDENTIFIER(FFI.from_buffer(encoded), len(encoded))
+
+    @staticmethod
+    def hash_identifiers(identifiers):
+        """Return a list of the addresses for an iterable of
+        `identifier` strings, as for `hash_identifier`.
+
+        The identifiers are encoded and packed into a single buffer, then
+        hashed in one call into C.
+        """
+        packed, c_lengths = pack_bytestrings(identifiers)
+        c_addresses = FFI.new("uint64_t[]", len(c_lengths))
+        PYMARQUISE_HASH_IDENTIFIERS(FFI.from_buffer(packed), c_lengths, c_addresses, len(c_lengths))
+        return list(c_addresses)
+
+    @staticmethod
+    def source_digest(metadata_dict):
+        """Return a 64-bit digest of a source dict, as used by the
+        `source_cache`. The digest doesn't depend on the order of the keys.
+        """
+        serialized = "".join(sorted([ "%s:%s," % (key, "" if value is None else value) for key, value in metadata_dict.items() ]))
+        return Marquise.hash_identifier(serialized)
 
     @staticmethod
     def current_timestamp():
-        """Return the current timestamp, nanoseconds since epoch."""
-        return int(time.time() * 1000000000)
+        """Return the current timestamp, nanoseconds since epoch.
+
+        On a handle with a `clock`, this is the clock's `now`.
+        """
+        return time_ns()
 
 
     def send_simple(self, address, timestamp, value):
@@ -115,9 +397,7 @@ class Marquise(object):
         Pymarquise generate one for you.
         """
         if self.marquise_ctx is None:
-            raise ValueError("Attempted to write to a closed Marquise handle.")
-
-        self.__debug("Supplied address: %s" % address)
+            self.__reopen("Attempted to write to a closed Marquise handle.")
 
         if value is None:
             raise TypeError("Can't store None as a value.")
@@ -131,33 +411,167 @@ class Marquise(object):
         c_timestamp = FFI.cast("uint64_t", timestamp)
         c_value =     FFI.cast("uint64_t", value)
 
-        success = MARQUISE_SEND_SIMPLE(self.marquise_ctx, c_address, c_timestamp, c_value)
+        if self.write_stats is None:
+            success = MARQUISE_SEND_SIMPLE(self.marquise_ctx, c_address, c_timestamp, c_value)
+        else:
+            success = self.write_stats.time_c_call('send_simple', MARQUISE_SEND_SIMPLE, self.marquise_ctx, c_address, c_timestamp, c_value)
         if success != 0:
-            self.__debug("send_simple returned %d, raising exception" % success)
-            raise RuntimeError("send_simple was unsuccessful, errno is %d" % FFI.errno)
-        self.__debug("send_simple returned %d" % success)
+            errno_value = FFI.errno
+            if self.tracer is not None:
+                self.tracer.emit('send_simple_failed', address=address, timestamp=timestamp, value=value, errno=errno_value)
+            raise RuntimeError("send_simple was unsuccessful, errno is %d" % errno_value)
+        if self.tracer is not None and self.tracer.sampled():
+            self.tracer.emit('send_simple', address=address, timestamp=timestamp, value=value)
 
         return True
 
 
+    def __timestamp_buffer(self, timestamps, n_points):
+        """Return a tuple of (cdata, pointer, default timestamp) for the
+        batch send helpers. Intended for internal use.
+        """
+        if timestamps is None:
+            return None, FFI.NULL, self.current_timestamp()
+        c_timestamps, n_timestamps = uint64_buffer(timestamps)
+        if n_timestamps != n_points:
+            raise ValueError("Got %d addresses but %d timestamps" % (n_points, n_timestamps))
+        return c_timestamps, FFI.cast("uint64_t *", c_timestamps), 0
+
+
+    def send_simple_many(self, addresses, timestamps, values):
+        """Queue many simple datapoints in one call, return the number sent.
+
+        Arguments:
+        addresses -- sequence of uint64_t addresses.
+        timestamps -- sequence of uint64_t timestamps, or None to stamp
+            every datapoint with the current time.
+        values -- sequence of uint64_t values.
+
+        The sequences are parallel and must be the same length. Contiguous
+        buffers of 64-bit integers, such as array('Q') or numpy uint64
+        arrays, are handed to libmarquise without copying; other sequences
+        are copied once into C arrays. The datapoints are then written from
+        a loop in C.
+
+        If a write fails, BatchWriteError is raised with the index of the
+        failed datapoint; everything before it has been queued.
+        """
+        if self.marquise_ctx is None:
+            self.__reopen("Attempted to write to a closed Marquise handle.")
+
+        c_addresses, n_points = uint64_buffer(addresses)
+        c_values, n_values = uint64_buffer(values)
+        if n_values != n_points:
+            raise ValueError("Got %d addresses but %d values" % (n_points, n_values))
+
+        # Keep hold of the timestamp buffer until the call returns, the
+        # pointer cast from it doesn't keep it alive.
+        c_timestamps, timestamps_ptr, default_timestamp = self.__timestamp_buffer(timestamps, n_points)
+
+        args = (self.marquise_ctx, FFI.cast("uint64_t *", c_addresses), timestamps_ptr, default_timestamp, FFI.cast("uint64_t *", c_values), n_points)
+        if self.write_stats is None:
+            sent = PYMARQUISE_SEND_SIMPLE_MANY(*args)
+        else:
+            sent = self.write_stats.time_c_call('send_simple_many', PYMARQUISE_SEND_SIMPLE_MANY, *args)
+        if sent != n_points:
+            errno_value = FFI.errno
+            if self.tracer is not None:
+                self.tracer.emit('send_simple_many_failed', n_points=n_points, index=sent, errno=errno_value)
+            raise BatchWriteError("send_simple_many was unsuccessful at index %d, errno is %d" % (sent, errno_value), sent, errno_value)
+        if self.tracer is not None and self.tracer.sampled():
+            self.tracer.emit('send_simple_many', n_points=n_points)
+
+        return sent
+
+
+    def send_extended_many(self, addresses, timestamps, values, offsets=None, lengths=None):
+        """Queue many extended datapoints in one call, return the number sent.
+
+        Arguments:
+        addresses -- sequence of uint64_t addresses.
+        timestamps -- sequence of uint64_t timestamps, or None to stamp
+            every datapoint with the current time.
+        values -- either a sequence of bytestrings (text is encoded as
+            UTF-8), or if `lengths` is supplied, a single bytes-like
+            buffer holding all the values.
+        offsets -- optional sequence of uint64_t byte offsets of each value
+            in `values`. If omitted the values are packed end-to-end.
+        lengths -- sequence of uint64_t byte lengths of each value in
+            `values`, required when `values` is a single buffer.
+
+        A sequence of values is packed into one buffer up front; a packed
+        buffer is sliced in place without copying. The datapoints are then
+        written from a loop in C.
+
+        If a write fails, BatchWriteError is raised with the index of the
+        failed datapoint; everything before it has been queued.
+        """
+        if self.marquise_ctx is None:
+            self.__reopen("Attempted to write to a closed Marquise handle.")
+
+        c_addresses, n_points = uint64_buffer(addresses)
+
+        if lengths is None:
+            if offsets is not None:
+                raise ValueError("offsets can only be used with a packed buffer and lengths")
+            # pack_bytestrings raises TypeError for None or other non-string values.
+            packed, c_lengths = pack_bytestrings(values)
+            n_lengths = len(c_lengths)
+        else:
+            packed = values
+            c_lengths, n_lengths = uint64_buffer(lengths)
+        if n_lengths != n_points:
+            raise ValueError("Got %d addresses but %d values" % (n_points, n_lengths))
+
+        if offsets is None:
+            c_offsets = None
+            offsets_ptr = FFI.NULL
+        else:
+            c_offsets, n_offsets = uint64_buffer(offsets)
+            if n_offsets != n_points:
+                raise ValueError("Got %d addresses but %d offsets" % (n_points, n_offsets))
+            offsets_ptr = FFI.cast("uint64_t *", c_offsets)
+
+        c_buffer = FFI.from_buffer(packed)
+        lengths_ptr = FFI.cast("uint64_t *", c_lengths)
+        bad_extent = PYMARQUISE_CHECK_EXTENTS(offsets_ptr, lengths_ptr, n_points, len(c_buffer))
+        if bad_extent != n_points:
+            raise ValueError("Value at index %d lies outside the %d byte buffer" % (bad_extent, len(c_buffer)))
+
+        c_timestamps, timestamps_ptr, default_timestamp = self.__timestamp_buffer(timestamps, n_points)
+
+        args = (self.marquise_ctx, FFI.cast("uint64_t *", c_addresses), timestamps_ptr, default_timestamp, c_buffer, offsets_ptr, lengths_ptr, n_points)
+        if self.write_stats is None:
+            sent = PYMARQUISE_SEND_EXTENDED_MANY(*args)
+        else:
+            sent = self.write_stats.time_c_call('send_extended_many', PYMARQUISE_SEND_EXTENDED_MANY, *args)
+        if sent != n_points:
+            errno_value = FFI.errno
+            if self.tracer is not None:
+                self.tracer.emit('send_extended_many_failed', n_points=n_points, n_bytes=len(c_buffer), index=sent, errno=errno_value)
+            raise BatchWriteError("send_extended_many was unsuccessful at index %d, errno is %d" % (sent, errno_value), sent, errno_value)
+        if self.tracer is not None and self.tracer.sampled():
+            self.tracer.emit('send_extended_many', n_points=n_points, n_bytes=len(c_buffer))
+
+        return sent
+
+
     def send_extended(self, address, timestamp, value):
         """Queue an extended datapoint (ie. a string), return True/False for success.
 
         Arguments:
         address -- uint64_t representing a unique metric.
         timestamp -- uint64_t representing number of nanoseconds (10^-9) since epoch.
-        value -- string value being stored.
+        value -- string value being stored. bytes, bytearray and
+            memoryview values are sent as-is without copying; anything
+            else is str()'d and encoded as UTF-8.
         """
         if self.marquise_ctx is None:
-            raise ValueError("Attempted to write to a closed Marquise handle.")
-
-        self.__debug("Supplied address: %s" % address)
+            self.__reopen("Attempted to write to a closed Marquise handle.")
 
         if value is None:
             raise TypeError("Can't store None as a value.")
 
-        value = str(value)
-
         if timestamp is None:
             timestamp = self.current_timestamp()
 
@@ -165,32 +579,99 @@ class Marquise(object):
         # FFI will take care of converting them to the right endianness. I think.
         c_address =   FFI.cast("uint64_t", address)
         c_timestamp = FFI.cast("uint64_t", timestamp)
-        # c_value needs to be a byte array with a length in bytes
-        c_value =     cstring(value)
-        c_length =    FFI.cast("size_t", len_cstring(value))
-        self.__debug("Sending extended value '%s' with length of %d" % (value, c_length))
 
-        success = MARQUISE_SEND_EXTENDED(self.marquise_ctx, c_address, c_timestamp, c_value, c_length)
+        # c_value needs to be a byte array with a length in bytes. Binary
+        # values are already bytes, so lend their buffer to C directly.
+        # Text gets encoded exactly once.
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            c_value =  FFI.from_buffer(value)
+            c_length = FFI.cast("size_t", len(c_value))
+        else:
+            value =    str(value)
+            encoded =  safe_encode(value, 'utf8')
+            c_value =  FFI.new("char[]", encoded)
+            c_length = FFI.cast("size_t", len(encoded))
+
+        if self.write_stats is None:
+            success = MARQUISE_SEND_EXTENDED(self.marquise_ctx, c_address, c_timestamp, c_value, c_length)
+        else:
+            success = self.write_stats.time_c_call('send_extended', MARQUISE_SEND_EXTENDED, self.marquise_ctx, c_address, c_timestamp, c_value, c_length)
         if success != 0:
-            self.__debug("send_extended returned %d, raising exception" % success)
-            raise RuntimeError("send_extended was unsuccessful, errno is %d" % FFI.errno)
-        self.__debug("send_extended returned %d" % success)
+            errno_value = FFI.errno
+            if self.tracer is not None:
+                self.tracer.emit('send_extended_failed', address=address, timestamp=timestamp, length=int(c_length), errno=errno_value)
+            raise RuntimeError("send_extended was unsuccessful, errno is %d" % errno_value)
+        if self.tracer is not None and self.tracer.sampled():
+            self.tracer.emit('send_extended', address=address, timestamp=timestamp, length=int(c_length))
 
         return True
 
 
-    def update_source(self, address, metadata_dict):
+    def update_source(self, address, metadata_dict, force=False):
         """Pack the `metadata_dict` for an `address` into a data structure and ship it to the spool file.
 
         Arguments:
         address -- the address for which this metadata_dict applies.
         metadata_dict -- a Python dict of arbitrary string key-value pairs.
+        force -- if True, send the `metadata_dict` even if the
+            `source_cache` says it's unchanged since it was last sent.
+
+        If this handle has a `source_cache` and the `metadata_dict` is the
+        same as the last one successfully sent for `address`, this returns
+        True straight away without writing anything.
         """
         if self.marquise_ctx is None:
-            raise ValueError("Attempted to write to a closed Marquise handle.")
+            self.__reopen("Attempted to write to a closed Marquise handle.")
+
+        return self.__update_source(address, metadata_dict, force, lambda key: cstring(str(key)), 'update_source')
+
 
-        self.__debug("Supplied address: %s" % address)
+    def update_sources(self, sources, force=False):
+        """Ship the source dicts for many addresses, return a dict of the
+        addresses that failed.
 
+        Arguments:
+        sources -- a mapping of address to metadata_dict, or an iterable
+            of (address, metadata_dict) pairs.
+        force -- as for `update_source`.
+
+        Each source dict is handled as by `update_source`, except that the
+        C strings for keys are built once and reused across the batch. A
+        failure doesn't stop the batch; the returned dict maps each address
+        that failed to the exception it raised, and is empty if all went
+        well.
+        """
+        if self.marquise_ctx is None:
+            self.__reopen("Attempted to write to a closed Marquise handle.")
+
+        if hasattr(sources, 'items'):
+            sources = sources.items()
+
+        interned_fields = {}
+        def field_cstring(key):
+            """Return the C string for `key`, building it on first use."""
+            c_field = interned_fields.get(key)
+            if c_field is None:
+                c_field = interned_fields[key] = cstring(str(key))
+            return c_field
+
+        failures = {}
+        for address, metadata_dict in sources:
+            try:
+                self.__update_source(address, metadata_dict, force, field_cstring, 'update_sources')
+            except (TypeError, ValueError, RuntimeError) as exc:
+                failures[address] = exc
+        if self.tracer is not None and self.tracer.sampled():
+            self.tracer.emit('update_sources', n_failures=len(failures))
+
+        return failures
+
+
+    def __update_source(self, address, metadata_dict, force, field_cstring, method_name):
+        """Validate and send one source dict, with `field_cstring` used to
+        make C strings of the keys, and libmarquise calls timed under
+        `method_name`. Intended for internal use.
+        """
         # Sanity check the input, everything must be UTF8 strings (not
         # yet confirmed), no Nonetypes or anything stupid like that.
         #
@@ -199,22 +680,30 @@ class Marquise(object):
         if any([ x is None for x in metadata_dict.keys() ]):
             raise TypeError("One of your metadata_dict keys is a Nonetype")
 
-        # Values are allowed to be None, coerce to empty strings.
-        metadata_dict = dict([ (x[0],"" if x[1] is None else x[1]) for x in metadata_dict.items() ])
+        if self.source_cache is not None:
+            try:
+                digest = self.source_digest(metadata_dict)
+            except Exception as exc:
+                raise TypeError("One of your metadata_dict keys or values couldn't be stringified, %s" % exc)
+            if not force and self.source_cache.get(address) == digest:
+                if self.tracer is not None and self.tracer.sampled():
+                    self.tracer.emit('update_source_unchanged', address=address)
+                return True
 
         # Cast each string to a C-string. This may have unusual results if your
         # keys/vals aren't particularly stringy, such as Python classes,
         # Exceptions, etc. They will get str()'d, and they may look stupid.
+        # Values are allowed to be None, coerce to empty strings.
         # pylint: disable=multiple-statements
-        try:                     c_fields = [ cstring(str(x)) for x in metadata_dict.keys() ]
+        try:                     c_fields = [ field_cstring(x) for x in metadata_dict.keys() ]
         except Exception as exc: raise TypeError("One of your metadata_dict keys couldn't be cast to a Cstring, %s" % exc)
 
-        try:                     c_values = [ cstring(str(x)) for x in metadata_dict.values() ]
+        try:                     c_values = [ cstring("" if x is None else str(x)) for x in metadata_dict.values() ]
         except Exception as exc: raise TypeError("One of your metadata_dict values couldn't be cast to a Cstring, %s" % exc)
         # pylint: enable=multiple-statements
 
         # Get our source_dict data structure
-        source_dict = MARQUISE_NEW_SOURCE(c_fields, c_values, len(metadata_dict))
+        source_dict = MARQUISE_NEW_SOURCE(c_fields, c_values, len(c_fields))
         if is_cnull(source_dict):
             raise ValueError("errno is set to EINVAL on invalid input, our errno is %d" % FFI.errno)
 
@@ -223,15 +712,24 @@ class Marquise(object):
         # fine, but that causes memory leaks. The explosion still
         # occurs, but we cleanup after (before?) ourselves.
         try:
-            success = MARQUISE_UPDATE_SOURCE(self.marquise_ctx, address, source_dict)
+            if self.write_stats is None:
+                success = MARQUISE_UPDATE_SOURCE(self.marquise_ctx, address, source_dict)
+            else:
+                success = self.write_stats.time_c_call(method_name, MARQUISE_UPDATE_SOURCE, self.marquise_ctx, address, source_dict)
         except TypeError as exc:
             MARQUISE_FREE_SOURCE(source_dict)
             raise
 
-        self.__debug("marquise_update_source returned %d" % success)
         if success != 0:
             MARQUISE_FREE_SOURCE(source_dict)
-            raise RuntimeError("marquise_update_source was unsuccessful, errno is %d" % FFI.errno)
+            errno_value = FFI.errno
+            if self.tracer is not None:
+                self.tracer.emit('update_source_failed', address=address, errno=errno_value)
+            raise RuntimeError("marquise_update_source was unsuccessful, errno is %d" % errno_value)
 
         MARQUISE_FREE_SOURCE(source_dict)
+        if self.tracer is not None and self.tracer.sampled():
+            self.tracer.emit('update_source', address=address, n_fields=len(c_fields))
+        if self.source_cache is not None:
+            self.source_cache[address] = digest
         return True
@@ -4,14 +4,24 @@
 """This module holds all the CFFI stuff, so that the binding shim can be
 handled separately from the interface code. The shim compiles to a .so library,
 and the interface stays as a pure Python library, importing the shim.
+
+The shim itself is built ahead of time by setup.py from build_cffi.py, so
+importing this doesn't need to parse headers or run a C compiler.
 """
 
-import os.path
+import sys
 
 from .oslo_strutils import safe_encode, safe_decode
 
-from cffi import FFI as FFI_CONSTRUCTOR
-FFI = FFI_CONSTRUCTOR()
+# pylint: disable=no-name-in-module,import-error
+from ._marquise_cffi import ffi as FFI, lib as C_LIBMARQUISE
+# pylint: enable=no-name-in-module,import-error
+
+# Buffer formats that C can read as uint64_t in place: unsigned, and in
+# this machine's byte order. 'L' is only 64 bits on some platforms, so the
+# item size is checked too.
+UINT64_FORMATS = set(['Q', '@Q', '=Q', 'L', '@L', '=L'])
+UINT64_FORMATS.update(['<Q', '<L'] if sys.byteorder == 'little' else ['>Q', '!Q', '>L', '!L'])
 
 def cprint(ffi_string):
     """Return a UTF-8 Python string for an FFI bytestring."""
@@ -29,39 +39,33 @@ def is_cnull(maybe_null):
     """Return True if `maybe_null` is a null pointer, otherwise return False."""
     return maybe_null == FFI.NULL
 
-
-# This kinda beats dragging the header file in here manually, assuming you can
-# clean it up suitably.  Assume that you've symlinked to marquise.h from here.
-def get_libmarquise_header():
-    """Read the libmarquise header to extract definitions."""
-    # Header file is packaged in the same place as the rest of the
-    # module.
-    header_path = os.path.join(os.path.dirname(__file__), "marquise.h")
-    with open(header_path) as header:
-        libmarquise_header_lines = header.readlines()
-
-    libmarquise_header_lines = [ line for line in libmarquise_header_lines if not line.startswith('#include ') and not line.startswith('#define ') ]
-    libmarquise_header_lines = [ line for line in libmarquise_header_lines if not line.startswith('#include ') ]
-    # We can't #include glib so FFI doesn't know what a GTree is. Leave it for
-    # later and let the C compiler resolve it when we call FFI.verify()
-    libmarquise_header_lines = [ line.replace("GTree *sd_hashes;", "...;") for line in libmarquise_header_lines ]
-    return ''.join(libmarquise_header_lines)
-
-
-# Get all our cdefs from the headers.
-FFI.cdef(get_libmarquise_header())
-
-
-# The GLib headers are in different locations on different distros, which is
-# annoying. glib.h seems to be consistent between Debian and Fedora, but
-# glibconfig.h moves.
-distro_include_dirs = [ './', '/usr/include/glib-2.0' ]
-glibconfig_paths = ('/usr/lib64/glib-2.0/include', '/usr/lib/x86_64-linux-gnu/glib-2.0/include')
-distro_include_dirs += [ path for path in glibconfig_paths if os.path.isfile(os.path.join(path, 'glibconfig.h')) ]
-
-# Throw libmarquise at CFFI, let it do the hard work. This gives us
-# API-level access instead of ABI access, and is generally preferred.
-C_LIBMARQUISE = FFI.verify("""#include "marquise.h" """,
-                           include_dirs=distro_include_dirs,
-                           libraries=['marquise'],
-                           modulename='marquise_cffi')
+def uint64_buffer(sequence):
+    """Return a tuple of (cdata, length) holding `sequence` as 64-bit words.
+
+    Contiguous buffer-protocol objects of unsigned 64-bit integers in native
+    byte order (eg. array('Q') or a numpy uint64 array) are shared with C
+    without copying. Anything else, including signed or byteswapped
+    buffers, is copied into a fresh uint64_t[] value by value. Cast the cdata to `uint64_t *` at the call
+    site, and keep it referenced until the call returns.
+    """
+    try:
+        view = memoryview(sequence)
+    except TypeError:
+        view = None
+    if view is not None and view.ndim == 1 and view.itemsize == 8 and view.format in UINT64_FORMATS and view.c_contiguous:
+        return FFI.from_buffer(sequence), len(view)
+
+    words = FFI.new('uint64_t[]', list(sequence))
+    return words, len(words)
+
+def pack_bytestrings(values):
+    """Return a tuple of (buffer, lengths) packing a sequence of values
+    end-to-end into a single bytestring.
+
+    Bytes-like values are packed as-is, text is encoded as UTF-8 exactly
+    once. `lengths` is a uint64_t array of the byte length of each value.
+    """
+    encoded = [ value if isinstance(value, (bytes, bytearray, memoryview)) else safe_encode(value, 'utf8') for value in values ]
+    # nbytes, as len() of a memoryview counts items, which needn't be bytes.
+    lengths = FFI.new('uint64_t[]', [ value.nbytes if isinstance(value, memoryview) else len(value) for value in encoded ])
+    return b''.join(encoded), lengths
@@ -0,0 +1,587 @@
+# pylint: disable=line-too-long
+# pylint: disable=bad-whitespace
+
+"""This module provides a pure-Python Marquise backend that writes
+libmarquise's spool files itself, for hosts without libmarquise and for
+interpreters where every FFI call is expensive.
+
+It doesn't import the CFFI shim, so it works without libmarquise installed.
+"""
+
+import os
+import re
+import sys
+import time
+import struct
+import tempfile
+import weakref
+from array import array
+from contextlib import contextmanager
+
+from .oslo_strutils import safe_encode
+from .lru import LRUCache
+from .errors import BatchWriteError
+from .stats import WriteStats, WRITE_METHODS
+from .trace import Tracer, print_hook
+from .clock import time_ns
+
+# These match marquise.h.
+MARQUISE_SPOOL_DIR = "/var/spool/marquise"
+MAX_SPOOL_FILE_SIZE = 1024*1024
+
+VALID_NAMESPACE = re.compile(r'^[a-z0-9]+$')
+
+# Spool frames are little-endian 64-bit words. A simple datapoint is
+# (address, timestamp, value) with the address' LSB clear; an extended
+# datapoint is (address, timestamp, length) with the LSB set, followed by
+# `length` bytes of value. A source dict is (address, length) followed by
+# the "key:value," serialisation.
+SIMPLE_FRAME = struct.Struct("<QQQ")
+EXTENDED_HEADER = struct.Struct("<QQQ")
+SOURCE_HEADER = struct.Struct("<QQ")
+
+MASK64 = 0xffffffffffffffff
+
+# Handles whose buffered spool files mustn't be flushed by a forked child,
+# see NativeMarquise.after_fork.
+LIVE_HANDLES = weakref.WeakSet()
+
+def _after_fork_in_child():
+    """Let go of every live handle's spool files in a newly forked child."""
+    for handle in list(LIVE_HANDLES):
+        handle.after_fork()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+def _rotl(value, bits):
+    """Rotate a 64-bit word left by `bits`."""
+    return ((value << bits) | (value >> (64 - bits))) & MASK64
+
+def siphash24(data, k0=0, k1=0):
+    """Return the SipHash-2-4 of the bytestring `data` with the 128-bit key
+    (`k0`, `k1`), by default all-zeroes as used by marquise_hash_identifier.
+    """
+    v0 = k0 ^ 0x736f6d6570736575
+    v1 = k1 ^ 0x646f72616e646f6d
+    v2 = k0 ^ 0x6c7967656e657261
+    v3 = k1 ^ 0x7465646279746573
+
+    def sipround(v0, v1, v2, v3):
+        """One SipRound over the state."""
+        v0 = (v0 + v1) & MASK64; v1 = _rotl(v1, 13) ^ v0; v0 = _rotl(v0, 32)
+        v2 = (v2 + v3) & MASK64; v3 = _rotl(v3, 16) ^ v2
+        v0 = (v0 + v3) & MASK64; v3 = _rotl(v3, 21) ^ v0
+        v2 = (v2 + v1) & MASK64; v1 = _rotl(v1, 17) ^ v2; v2 = _rotl(v2, 32)
+        return v0, v1, v2, v3
+
+    n_words = len(data) // 8
+    tail = bytearray(data[n_words * 8:]) + bytearray(8 - len(data) % 8)
+    last = ((len(data) & 0xff) << 56) | struct.unpack("<Q", bytes(tail))[0]
+    for word in struct.unpack_from("<%dQ" % n_words, data) + (last,):
+        v3 ^= word
+        v0, v1, v2, v3 = sipround(v0, v1, v2, v3)
+        v0, v1, v2, v3 = sipround(v0, v1, v2, v3)
+        v0 ^= word
+
+    v2 ^= 0xff
+    for _ in range(4):
+        v0, v1, v2, v3 = sipround(v0, v1, v2, v3)
+    return v0 ^ v1 ^ v2 ^ v3
+
+
+def fsync_path(path, directory=False):
+    """fsync the file at `path`, and if `directory`, the directory holding
+    it too, so that a new file's directory entry is durable as well.
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    if directory:
+        fsync_path(os.path.dirname(path))
+
+
+class SpoolFile(object):
+
+    """
+    One append-only spool file, in the same place libmarquise would put it
+    (SPOOL_DIR/kind/namespace/new/), rotated to a fresh file once it has
+    grown to MAX_SPOOL_FILE_SIZE. Writes are buffered, so nothing is
+    guaranteed to be on disk until `flush` or `close`.
+    """
+
+    def __init__(self, spool_dir, kind, namespace, buffer_size):
+        self.directory = os.path.join(spool_dir, kind, namespace, "new")
+        self.buffer_size = buffer_size
+        self.path = None
+        self.file = None
+        self.opened = None
+        self.bytes_written = 0
+        self._open()
+
+    def _open(self):
+        """Open a new, uniquely-named spool file. Intended for internal use."""
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                if not os.path.isdir(self.directory):
+                    raise
+        fd, self.path = tempfile.mkstemp(dir=self.directory, prefix="")
+        self.file = os.fdopen(fd, 'ab', self.buffer_size)
+        self.opened = time.time()
+        self.bytes_written = 0
+        self.synced = False
+
+    def rotate(self):
+        """Close the current spool file and start a new one."""
+        if self.file is None:
+            return
+        self.file.close()
+        self._open()
+
+    def abandon(self):
+        """Let go of the spool file without flushing what's buffered, as
+        in a forked child, where the buffer is the parent's to write. The
+        next write opens a new file.
+        """
+        if self.file is not None:
+            # Point the inherited descriptor at /dev/null, so the buffer
+            # goes nowhere when the file object is collected, and the
+            # descriptor can't be reused for another file before then.
+            devnull = os.open(os.devnull, os.O_WRONLY)
+            try:
+                os.dup2(devnull, self.file.fileno())
+            finally:
+                os.close(devnull)
+            self.file = None
+        self.path = None
+        self.opened = None
+        self.bytes_written = 0
+
+    def write(self, blob, frame_size=None):
+        """Append `blob`, a run of frames, rotating the file between frames
+        wherever libmarquise would.
+
+        If `frame_size` is given every frame is that size, otherwise the
+        whole `blob` is treated as a single frame.
+        """
+        if self.file is None:
+            self._open()
+        frame_size = frame_size or len(blob)
+        offset = 0
+        while offset < len(blob):
+            if self.bytes_written >= MAX_SPOOL_FILE_SIZE:
+                self.rotate()
+            n_frames = max(1, -(-(MAX_SPOOL_FILE_SIZE - self.bytes_written) // frame_size))
+            piece = blob[offset:offset + n_frames * frame_size]
+            self.file.write(piece)
+            self.bytes_written += len(piece)
+            offset += len(piece)
+
+    def flush(self, durable=False):
+        """Push buffered frames to the kernel, and if `durable`, to disk."""
+        if self.file is None:
+            return
+        self.file.flush()
+        if durable:
+            os.fsync(self.file.fileno())
+            if not self.synced:
+                fsync_path(self.directory)
+                self.synced = True
+
+    def close(self):
+        """Flush and close the spool file."""
+        if self.file is not None:
+            self.file.close()
+
+
+class NativeMarquise(object):
+
+    """
+    A Marquise handle that encodes libmarquise's spool frames in Python
+    and appends them to the spool files itself, batching many datapoints
+    into each write() call. It has the same interface as Marquise, and
+    the spool files it writes are byte-for-byte what libmarquise writes.
+
+    Unlike libmarquise, writes are buffered in memory until `flush` or
+    `close`, so a crash can lose up to `buffer_size` bytes per file.
+    """
+
+    def __init__(self, namespace, debug=False, source_cache=None, spool_dir=None, buffer_size=1024*1024, stats=False, tracer=None, clock=None):
+        """Open spool files for the provided namespace.
+
+        Arguments:
+        namespace -- must be lowercase alphanumeric ([a-z0-9]+).
+        debug -- if debug is True, debugging output will be printed.
+        source_cache -- as for Marquise.
+        spool_dir -- where to spool to, by default $MARQUISE_SPOOL_DIR or
+            /var/spool/marquise like libmarquise.
+        buffer_size -- bytes of writes to buffer per spool file.
+        stats -- as for Marquise. There's no C call, so `c_latency` stays
+            empty.
+        tracer -- as for Marquise.
+        clock -- as for Marquise.
+        """
+        if not VALID_NAMESPACE.match(namespace):
+            raise ValueError("Invalid namespace: %s" % namespace)
+        self.debug_enabled = debug
+        if debug and tracer is None:
+            tracer = Tracer([print_hook])
+        self.tracer = tracer
+        if isinstance(source_cache, int):
+            source_cache = LRUCache(source_cache) if source_cache > 0 else None
+        self.source_cache = source_cache
+        self.clock = clock
+        if clock is not None:
+            self.current_timestamp = clock.now
+        self.namespace = namespace
+        if spool_dir is None:
+            spool_dir = os.environ.get("MARQUISE_SPOOL_DIR", MARQUISE_SPOOL_DIR)
+        try:
+            self.points = SpoolFile(spool_dir, "points", namespace, buffer_size)
+            self.contents = SpoolFile(spool_dir, "contents", namespace, buffer_size)
+        except (IOError, OSError) as exc:
+            raise RuntimeError("Couldn't create spool files in %s, errno is %d" % (spool_dir, exc.errno))
+        # Like libmarquise's sd_hashes, the hash of the last source dict
+        # written for each address, so unchanged ones aren't written again.
+        self.source_hashes = {}
+        self.closed = False
+        self.pid = os.getpid()
+        self.write_stats = None
+        if stats:
+            self.write_stats = WriteStats(WRITE_METHODS)
+            self.write_stats.instrument(self)
+        LIVE_HANDLES.add(self)
+
+    @property
+    def spool_path_points(self):
+        """The path of the current points spool file."""
+        return self.points.path
+
+    @property
+    def spool_path_contents(self):
+        """The path of the current contents spool file."""
+        return self.contents.path
+
+    @property
+    def spool_opened(self):
+        """When the current points spool file was opened, or None."""
+        return self.points.opened
+
+    @property
+    def bytes_written_points(self):
+        """Bytes written to the current points spool file."""
+        return self.points.bytes_written
+
+    @property
+    def bytes_written_contents(self):
+        """Bytes written to the current contents spool file."""
+        return self.contents.bytes_written
+
+    def stats(self):
+        """Return a dict snapshot of this handle's write stats, see Marquise.stats."""
+        snapshot = {
+            'bytes_written_points':   self.bytes_written_points,
+            'bytes_written_contents': self.bytes_written_contents,
+        }
+        if self.write_stats is not None:
+            snapshot['methods'] = self.write_stats.snapshot()
+        return snapshot
+
+    def __str__(self):
+        """Return a human-readable description of the current handle."""
+        return "<NativeMarquise handle spooling to %s and %s>" % (self.spool_path_points, self.spool_path_contents)
+
+    def __debug(self, msg):
+        """Emit `msg` as a debug event if tracing is enabled on this
+        instance. Intended for internal use.
+        """
+        if self.tracer is not None:
+            self.tracer.emit('debug', message=msg)
+
+    def __check_open(self):
+        """Raise ValueError if the handle is closed. Intended for internal use."""
+        if self.closed:
+            raise ValueError("Attempted to write to a closed Marquise handle.")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def flush(self, durable=False):
+        """Push all buffered writes to the spool files, and if `durable`,
+        fsync them, see `Marquise.flush`.
+        """
+        if self.closed:
+            raise ValueError("Attempted to flush a closed Marquise handle.")
+        self.points.flush(durable)
+        self.contents.flush(durable)
+
+    @contextmanager
+    def session(self, durable=False):
+        """Group writes, see `Marquise.session`."""
+        self.__check_open()
+        yield self
+        self.flush(durable)
+
+    def consume(self, items, chunk_size=10000, update_sources=True, progress=None, progress_interval=10.0):
+        """Write every datapoint in `items` in chunks, see `Marquise.consume`."""
+        from .pipeline import Pipeline
+        self.__check_open()
+        return Pipeline(self, chunk_size, update_sources).run(items, progress, progress_interval)
+
+    def after_fork(self):
+        """Let go of the parent's spool files after a fork, without
+        flushing the parent's buffered writes into them, see
+        `Marquise.after_fork`. The child's own spool files are opened on
+        its first write.
+        """
+        if self.closed or self.pid == os.getpid():
+            return
+        self.__debug("Forked from pid %d, pid %d will open new spool files when it first writes" % (self.pid, os.getpid()))
+        self.points.abandon()
+        self.contents.abandon()
+        self.source_hashes.clear()
+        self.pid = os.getpid()
+
+    def rotate(self):
+        """Close the spool files and start new ones, see `Marquise.rotate`."""
+        self.__check_open()
+        self.__debug("Rotating Marquise handle spooling to %s and %s" % (self.spool_path_points, self.spool_path_contents))
+        self.points.rotate()
+        self.contents.rotate()
+        self.source_hashes.clear()
+
+    def close(self):
+        """Flush and close the spool files. Multiple close() calls are okay."""
+        if self.closed:
+            self.__debug("Marquise handle is already closed, will do nothing.")
+            return
+        self.__debug("Closing Marquise handle spooling to %s and %s" % (self.spool_path_points, self.spool_path_contents))
+        self.closed = True
+        self.points.close()
+        self.contents.close()
+
+    @staticmethod
+    def hash_identifier(identifier):
+        """Return the siphash-2-4 of the `identifier`, using a static
+        all-zeroes key, exactly as Marquise.hash_identifier does.
+        """
+        return siphash24(safe_encode(identifier, 'utf8'))
+
+    @staticmethod
+    def hash_identifiers(identifiers):
+        """Return a list of the addresses for an iterable of identifiers."""
+        return [ siphash24(safe_encode(identifier, 'utf8')) for identifier in identifiers ]
+
+    @staticmethod
+    def source_digest(metadata_dict):
+        """Return a 64-bit digest of a source dict, as Marquise.source_digest does."""
+        serialized = "".join(sorted([ "%s:%s," % (key, "" if value is None else value) for key, value in metadata_dict.items() ]))
+        return NativeMarquise.hash_identifier(serialized)
+
+    @staticmethod
+    def current_timestamp():
+        """Return the current timestamp, see Marquise.current_timestamp."""
+        return time_ns()
+
+    def send_simple(self, address, timestamp, value):
+        """Queue a simple datapoint, see Marquise.send_simple."""
+        self.__check_open()
+        if value is None:
+            raise TypeError("Can't store None as a value.")
+        if timestamp is None:
+            timestamp = self.current_timestamp()
+        try:
+            frame = SIMPLE_FRAME.pack(address & ~1, timestamp, value)
+        except struct.error as exc:
+            raise TypeError("Couldn't pack simple datapoint, %s" % exc)
+        try:
+            self.points.write(frame)
+        except (IOError, OSError) as exc:
+            if self.tracer is not None:
+                self.tracer.emit('send_simple_failed', address=address, timestamp=timestamp, value=value, errno=exc.errno)
+            raise RuntimeError("send_simple was unsuccessful, errno is %d" % exc.errno)
+        if self.tracer is not None and self.tracer.sampled():
+            self.tracer.emit('send_simple', address=address, timestamp=timestamp, value=value)
+        return True
+
+    def send_simple_many(self, addresses, timestamps, values):
+        """Queue many simple datapoints with as few writes as possible,
+        return the number sent. See Marquise.send_simple_many.
+        """
+        self.__check_open()
+        addresses = array('Q', addresses)
+        values = array('Q', values)
+        if len(values) != len(addresses):
+            raise ValueError("Got %d addresses but %d values" % (len(addresses), len(values)))
+        if timestamps is None:
+            timestamps = array('Q', [self.current_timestamp()]) * len(addresses)
+        else:
+            timestamps = array('Q', timestamps)
+            if len(timestamps) != len(addresses):
+                raise ValueError("Got %d addresses but %d timestamps" % (len(addresses), len(timestamps)))
+
+        words = array('Q', [0]) * (3 * len(addresses))
+        words[0::3] = array('Q', [ address & ~1 for address in addresses ])
+        words[1::3] = timestamps
+        words[2::3] = values
+        if sys.byteorder != 'little':
+            words.byteswap()
+        try:
+            self.points.write(words.tobytes(), SIMPLE_FRAME.size)
+        except (IOError, OSError) as exc:
+            # A buffered write can't tell how much of it made it out, so
+            # nothing is counted as sent.
+            if self.tracer is not None:
+                self.tracer.emit('send_simple_many_failed', n_points=len(addresses), index=0, errno=exc.errno)
+            raise BatchWriteError("send_simple_many was unsuccessful at index 0, errno is %d" % exc.errno, 0, exc.errno)
+        if self.tracer is not None and self.tracer.sampled():
+            self.tracer.emit('send_simple_many', n_points=len(addresses))
+        return len(addresses)
+
+    def __extended_frame(self, address, timestamp, value):
+        """Return the spool frame for an extended datapoint. Intended for
+        internal use.
+        """
+        if value is None:
+            raise TypeError("Can't store None as a value.")
+        if isinstance(value, memoryview):
+            # len() of a view counts items, which needn't be bytes.
+            value = value.tobytes()
+        elif not isinstance(value, (bytes, bytearray)):
+            value = safe_encode(str(value), 'utf8')
+        if timestamp is None:
+            timestamp = self.current_timestamp()
+        try:
+            header = EXTENDED_HEADER.pack(address | 1, timestamp, len(value))
+        except struct.error as exc:
+            raise TypeError("Couldn't pack extended datapoint, %s" % exc)
+        return header + bytes(value)
+
+    def send_extended(self, address, timestamp, value):
+        """Queue an extended datapoint, see Marquise.send_extended."""
+        self.__check_open()
+        frame = self.__extended_frame(address, timestamp, value)
+        try:
+            self.points.write(frame)
+        except (IOError, OSError) as exc:
+            if self.tracer is not None:
+                self.tracer.emit('send_extended_failed', address=address, timestamp=timestamp, length=len(frame) - EXTENDED_HEADER.size, errno=exc.errno)
+            raise RuntimeError("send_extended was unsuccessful, errno is %d" % exc.errno)
+        if self.tracer is not None and self.tracer.sampled():
+            self.tracer.emit('send_extended', address=address, timestamp=timestamp, length=len(frame) - EXTENDED_HEADER.size)
+        return True
+
+    def send_extended_many(self, addresses, timestamps, values, offsets=None, lengths=None):
+        """Queue many extended datapoints, return the number sent. See
+        Marquise.send_extended_many.
+        """
+        self.__check_open()
+        addresses = list(addresses)
+        if lengths is not None:
+            lengths = list(lengths)
+            if offsets is None:
+                offsets = []
+                offset = 0
+                for length in lengths:
+                    offsets.append(offset)
+                    offset += length
+            view = memoryview(values).cast('B')
+            if any([ offset + length > len(view) for offset, length in zip(offsets, lengths) ]):
+                raise ValueError("A value lies outside the %d byte buffer" % len(view))
+            values = [ view[offset:offset + length] for offset, length in zip(offsets, lengths) ]
+        elif offsets is not None:
+            raise ValueError("offsets can only be used with a packed buffer and lengths")
+        values = list(values)
+        if len(values) != len(addresses):
+            raise ValueError("Got %d addresses but %d values" % (len(addresses), len(values)))
+        if timestamps is None:
+            timestamps = [self.current_timestamp()] * len(addresses)
+        timestamps = list(timestamps)
+        if len(timestamps) != len(addresses):
+            raise ValueError("Got %d addresses but %d timestamps" % (len(addresses), len(timestamps)))
+
+        # Build every frame before writing any, so bad input fails cleanly.
+        # They're written one at a time so the file can rotate between
+        # them, but the writes are buffered.
+        frames = [ self.__extended_frame(*point) for point in zip(addresses, timestamps, values) ]
+        for i, frame in enumerate(frames):
+            try:
+                self.points.write(frame)
+            except (IOError, OSError) as exc:
+                if self.tracer is not None:
+                    self.tracer.emit('send_extended_many_failed', n_points=len(frames), index=i, errno=exc.errno)
+                raise BatchWriteError("send_extended_many was unsuccessful at index %d, errno is %d" % (i, exc.errno), i, exc.errno)
+        if self.tracer is not None and self.tracer.sampled():
+            self.tracer.emit('send_extended_many', n_points=len(frames))
+        return len(frames)
+
+    def update_source(self, address, metadata_dict, force=False):
+        """Ship a source dict to the contents spool, see Marquise.update_source."""
+        self.__check_open()
+        return self.__update_source(address, metadata_dict, force)
+
+    def __update_source(self, address, metadata_dict, force):
+        """Validate and write one source dict. Intended for internal use."""
+        if any([ x is None for x in metadata_dict.keys() ]):
+            raise TypeError("One of your metadata_dict keys is a Nonetype")
+
+        try:
+            fields = [ str(x) for x in metadata_dict.keys() ]
+            values = [ "" if x is None else str(x) for x in metadata_dict.values() ]
+        except Exception as exc:
+            raise TypeError("One of your metadata_dict keys or values couldn't be stringified, %s" % exc)
+        if any([ "," in x or ":" in x for x in fields + values ]):
+            raise ValueError("The ',' and ':' characters aren't allowed in metadata_dict keys or values")
+
+        if self.source_cache is not None:
+            digest = self.source_digest(metadata_dict)
+            if not force and self.source_cache.get(address) == digest:
+                if self.tracer is not None and self.tracer.sampled():
+                    self.tracer.emit('update_source_unchanged', address=address)
+                return True
+
+        serialized = safe_encode("".join([ "%s:%s," % pair for pair in zip(fields, values) ]), 'utf8')
+        try:
+            header = SOURCE_HEADER.pack(address, len(serialized))
+        except struct.error as exc:
+            raise TypeError("Couldn't pack source dict, %s" % exc)
+
+        source_hash = siphash24(serialized)
+        if self.source_hashes.get(address) != source_hash:
+            try:
+                self.contents.write(header + serialized)
+            except (IOError, OSError) as exc:
+                if self.tracer is not None:
+                    self.tracer.emit('update_source_failed', address=address, errno=exc.errno)
+                raise RuntimeError("marquise_update_source was unsuccessful, errno is %d" % exc.errno)
+            self.source_hashes[address] = source_hash
+
+        if self.source_cache is not None:
+            self.source_cache[address] = digest
+        if self.tracer is not None and self.tracer.sampled():
+            self.tracer.emit('update_source', address=address, n_fields=len(fields))
+        return True
+
+    def update_sources(self, sources, force=False):
+        """Ship the source dicts for many addresses, return a dict of the
+        addresses that failed. See Marquise.update_sources.
+        """
+        self.__check_open()
+        if hasattr(sources, 'items'):
+            sources = sources.items()
+        failures = {}
+        for address, metadata_dict in sources:
+            try:
+                self.__update_source(address, metadata_dict, force)
+            except (TypeError, ValueError, RuntimeError) as exc:
+                failures[address] = exc
+        if self.tracer is not None and self.tracer.sampled():
+            self.tracer.emit('update_sources', n_failures=len(failures))
+        return failures
@@ -0,0 +1,332 @@
+# pylint: disable=line-too-long
+# pylint: disable=bad-whitespace
+
+"""This module provides a lazy pipeline from any iterable of datapoints to
+a Marquise handle: the datapoints are mapped to addresses, passed through
+filter, dedupe and aggregate stages, and written in chunks with the batch
+send methods, so memory use doesn't grow with the size of the input.
+"""
+
+import time
+from array import array
+
+import six
+
+from .lru import LRUCache
+from .dedupe import LastValueTable, DedupeFilter
+from .identifier import SourceIdentifier
+
+AGGREGATIONS = ('sum', 'last', 'min', 'max')
+
+class Pipeline(object):
+
+    """
+    Streams datapoints from an iterable into a Marquise handle, or any of
+    its wrappers such as a DedupeFilter or SpoolPolicy.
+
+    Each datapoint is an (address, timestamp, value) tuple, or a dict with
+    the same keys. The address can instead be an identifier string, a
+    SourceIdentifier or a source dict, given in place of the address in a
+    tuple or under 'identifier' or 'source' in a dict. These are hashed
+    once and remembered, in an LRU cache of `cache_size` entries, and
+    their source dict is sent the first time they're seen. An identifier
+    string is hashed exactly as given, as `hash_identifier` would; if it's
+    made of "key:value," pairs, they're sent as its source dict. A None or
+    missing timestamp is filled in from the handle's clock. Integer values
+    are written as simple datapoints, and anything else as extended ones.
+
+    After mapping to addresses, the datapoints pass through the stages
+    added with `filter`, `dedupe` and `aggregate`, in the order they were
+    added, each seeing one datapoint at a time. Then they're gathered into
+    chunks of `chunk_size`, one for simple and one for extended
+    datapoints, each written with one batch send call when full, so the
+    two kinds aren't written in step with each other.
+
+    Nothing is read from the iterable until `run` is called, and only a
+    chunk's worth is held at once, plus whatever the stages remember:
+    `dedupe` keeps 36 to 72 bytes per address, and `aggregate` one value
+    per address in the current window.
+    """
+
+    def __init__(self, marquise, chunk_size=10000, update_sources=True, cache_size=100000):
+        """Create a pipeline writing to `marquise`.
+
+        Arguments:
+        marquise -- the Marquise handle to write to.
+        chunk_size -- the most datapoints of each kind written at once.
+        update_sources -- if False, identifiers and source dicts are only
+            hashed, and their source dicts aren't sent.
+        cache_size -- the number of identifiers and source dicts whose
+            addresses are remembered.
+        """
+        if chunk_size < 1:
+            raise ValueError("chunk_size must be positive, got %r" % chunk_size)
+        self.marquise = marquise
+        self.chunk_size = chunk_size
+        self.update_sources = update_sources
+        self.addresses = LRUCache(cache_size)
+        self.stages = []
+
+        self.read = 0
+        self.sources = 0
+        self.filtered = 0
+        self.suppressed = 0
+        self.aggregated = 0
+        self.written = 0
+        self.batches = 0
+
+    def __str__(self):
+        """Return a human-readable description of the pipeline."""
+        return "<Pipeline of %d stages writing to %s>" % (len(self.stages), self.marquise)
+
+    def filter(self, predicate):
+        """Add a stage that drops the datapoints for which `predicate`,
+        called with each (address, timestamp, value) tuple, returns false.
+        Return the pipeline.
+        """
+        self.stages.append(lambda points: self._filter(points, predicate))
+        return self
+
+    def dedupe(self, heartbeat=600, capacity=1024):
+        """Add a stage that drops datapoints repeating the last value seen
+        for their address, as a DedupeFilter does. Return the pipeline.
+
+        Arguments:
+        heartbeat -- the most seconds, by datapoint timestamp, an
+            unchanging series goes between datapoints.
+        capacity -- the number of addresses to make room for up front.
+        """
+        if heartbeat <= 0:
+            raise ValueError("heartbeat must be positive, got %r" % heartbeat)
+        self.stages.append(lambda points: self._dedupe(points, int(heartbeat * 1000000000), capacity))
+        return self
+
+    def aggregate(self, window, how='sum'):
+        """Add a stage that folds the simple datapoints for each address
+        into one per `window` seconds, by datapoint timestamp, stamped
+        with the start of the window. Return the pipeline.
+
+        Arguments:
+        window -- the seconds each window covers.
+        how -- one of AGGREGATIONS, how the values in a window are folded.
+
+        A window's datapoints are written once a datapoint from a later
+        window arrives, so the input should be roughly in time order;
+        datapoints arriving for a window already written are folded into
+        the current one. Extended datapoints pass straight through.
+        """
+        if how not in AGGREGATIONS:
+            raise ValueError("how must be one of %s, got %r" % (", ".join(AGGREGATIONS), how))
+        if window <= 0:
+            raise ValueError("window must be positive, got %r" % window)
+        self.stages.append(lambda points: self._aggregate(points, int(window * 1000000000), how))
+        return self
+
+    def _address(self, key):
+        """Return the address for an identifier string, SourceIdentifier
+        or source dict, sending its source dict the first time it's seen.
+        Intended for internal use.
+        """
+        if isinstance(key, SourceIdentifier):
+            cache_key = key.encoded
+        elif isinstance(key, dict):
+            cache_key = frozenset(key.items())
+        else:
+            cache_key = key
+        address = self.addresses.get(cache_key)
+        if address is not None:
+            return address
+
+        if isinstance(key, SourceIdentifier):
+            source = key
+        elif isinstance(key, dict):
+            source = SourceIdentifier(key)
+        else:
+            # A string is hashed as given, like everywhere else. Its source
+            # dict, if it parses as one, never changes the address.
+            address = self.addresses[cache_key] = self.marquise.hash_identifier(key)
+            if self.update_sources:
+                try:
+                    metadata = SourceIdentifier.parse(key).metadata
+                except ValueError:
+                    return address
+                self.marquise.update_source(address, metadata)
+                self.sources += 1
+            return address
+        address = source.address
+        if self.update_sources:
+            source.update_source(self.marquise)
+            self.sources += 1
+        self.addresses[cache_key] = address
+        return address
+
+    def _map_addresses(self, items):
+        """Yield an (address, timestamp, value) tuple for every datapoint
+        in `items`. Intended for internal use.
+        """
+        current_timestamp = self.marquise.current_timestamp
+        integer_types = six.integer_types
+        for item in items:
+            self.read += 1
+            if isinstance(item, dict):
+                key = item.get('address')
+                if key is None:
+                    key = item.get('identifier')
+                if key is None:
+                    key = item.get('source')
+                if key is None:
+                    raise ValueError("Datapoint has no address, identifier or source: %r" % (item,))
+                timestamp = item.get('timestamp')
+                value = item['value']
+            else:
+                key, timestamp, value = item
+            if not isinstance(key, integer_types):
+                key = self._address(key)
+            if timestamp is None:
+                timestamp = current_timestamp()
+            yield key, timestamp, value
+
+    def _filter(self, points, predicate):
+        """Filter stage, see `filter`. Intended for internal use."""
+        for point in points:
+            if predicate(point):
+                yield point
+            else:
+                self.filtered += 1
+
+    def _dedupe(self, points, heartbeat_ns, capacity):
+        """Dedupe stage, see `dedupe`. Intended for internal use."""
+        last_values = LastValueTable(capacity)
+        integer_types = six.integer_types
+        value_key = DedupeFilter._value_key # pylint: disable=protected-access
+        for point in points:
+            address, timestamp, value = point
+            if isinstance(value, integer_types):
+                key = address & ~1
+                compared = value
+            else:
+                key = address | 1
+                compared = value_key(value)
+            last = last_values.get(key)
+            if last is not None and last[0] == compared and timestamp - last[1] < heartbeat_ns:
+                self.suppressed += 1
+                continue
+            last_values.set(key, compared, timestamp)
+            yield point
+
+    def _aggregate(self, points, window_ns, how):
+        """Aggregate stage, see `aggregate`. Intended for internal use."""
+        pending = {}
+        current = None
+        integer_types = six.integer_types
+        for point in points:
+            address, timestamp, value = point
+            if not isinstance(value, integer_types):
+                yield point
+                continue
+            start = timestamp - timestamp % window_ns
+            if current is None:
+                current = start
+            elif start > current:
+                for pending_address, pending_value in pending.items():
+                    yield pending_address, current, pending_value
+                pending.clear()
+                current = start
+            address &= ~1
+            last = pending.get(address)
+            if last is None:
+                pending[address] = value
+                continue
+            self.aggregated += 1
+            if how == 'sum':
+                pending[address] = last + value
+            elif how == 'last':
+                pending[address] = value
+            elif how == 'min':
+                pending[address] = min(last, value)
+            else:
+                pending[address] = max(last, value)
+        for pending_address, pending_value in pending.items():
+            yield pending_address, current, pending_value
+
+    def _chunks(self, points):
+        """Yield (method name, addresses, timestamps, values) for every
+        chunk of simple or extended datapoints. Intended for internal use.
+        """
+        chunk_size = self.chunk_size
+        integer_types = six.integer_types
+        simple = (array('Q'), array('Q'), array('Q'))
+        extended = ([], [], [])
+        for address, timestamp, value in points:
+            if isinstance(value, integer_types):
+                chunk = simple
+                try:
+                    simple[2].append(value)
+                except OverflowError as exc:
+                    raise TypeError("Couldn't pack simple datapoint, %s" % exc)
+            else:
+                chunk = extended
+                extended[2].append(value)
+            chunk[0].append(address)
+            chunk[1].append(timestamp)
+            if len(chunk[0]) >= chunk_size:
+                if chunk is simple:
+                    yield ('send_simple_many',) + simple
+                    simple = (array('Q'), array('Q'), array('Q'))
+                else:
+                    yield ('send_extended_many',) + extended
+                    extended = ([], [], [])
+        if simple[0]:
+            yield ('send_simple_many',) + simple
+        if extended[0]:
+            yield ('send_extended_many',) + extended
+
+    def run(self, items, progress=None, progress_interval=10.0):
+        """Write every datapoint in `items` through the pipeline, and
+        return the stats dict.
+
+        Arguments:
+        items -- an iterable of datapoint tuples or dicts, read lazily.
+        progress -- a function called with the stats dict every
+            `progress_interval` seconds, or None.
+        progress_interval -- the seconds between calls to `progress`.
+
+        An exception from a stage or write stops the run where it is;
+        chunks written before it stay written. BatchWriteError is raised
+        as the handle raised it, with an index into the failed chunk.
+        """
+        points = self._map_addresses(items)
+        for stage in self.stages:
+            points = stage(points)
+
+        start = reported = time.time()
+        for method_name, addresses, timestamps, values in self._chunks(points):
+            self.written += getattr(self.marquise, method_name)(addresses, timestamps, values)
+            self.batches += 1
+            if progress is not None:
+                now = time.time()
+                if now - reported >= progress_interval:
+                    reported = now
+                    progress(self.stats(now - start))
+        stats = self.stats(time.time() - start)
+        if progress is not None:
+            progress(stats)
+        return stats
+
+    def stats(self, seconds=None):
+        """Return a dict of the datapoints read, dropped by each stage and
+        written, the source dicts sent and batch send calls made, with the
+        datapoints read per second if `seconds` is given.
+        """
+        stats = {
+            'read':       self.read,
+            'sources':    self.sources,
+            'filtered':   self.filtered,
+            'suppressed': self.suppressed,
+            'aggregated': self.aggregated,
+            'written':    self.written,
+            'batches':    self.batches,
+        }
+        if seconds:
+            stats['points_per_sec'] = self.read / seconds
+        return stats
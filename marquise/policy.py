@@ -0,0 +1,333 @@
+# pylint: disable=line-too-long
+# pylint: disable=bad-whitespace
+
+"""This module provides a spool policy in front of a Marquise handle,
+which rotates the handle's spool files at size and age thresholds, and
+sheds low-priority datapoints as the spool backlog grows or the disk
+fills, rather than writing until libmarquise fails.
+"""
+
+import os
+import time
+import threading
+
+from .lru import LRUCache
+from .errors import BatchWriteError
+from .dedupe import GOLDEN, MASK64
+from .native import MARQUISE_SPOOL_DIR
+from .spool import backlog_size
+
+# The number of addresses whose shedding credit is remembered.
+CREDIT_ADDRESSES = 100000
+
+class SpoolPolicy(object):
+
+    """
+    Wraps a Marquise handle, watching its spool and shedding writes under
+    pressure.
+
+    - Rotation: once the handle has written `rotate_bytes` to its current
+      spool files, or they were opened `rotate_seconds` ago, the handle is
+      rotated (see `Marquise.rotate`) on the next write.
+    - Shedding: a background thread checks the spool backlog (every spool
+      file waiting in the spool directory, of every namespace) and the
+      free disk space every `check_interval` seconds. Between
+      `backlog_high_water` and `backlog_limit` bytes of backlog, a
+      falling share of the datapoints for unprotected addresses is
+      written, thinned evenly within each address. At `backlog_limit`,
+      or with less than `min_free_bytes` free, none are. A failed write
+      also sheds everything until the next check, the next successful
+      write, or `check_interval` seconds, whichever comes first.
+
+    Datapoints for addresses in `protected` are never shed, and source
+    dicts always pass straight through. Shed datapoints aren't written:
+    `send_simple` and `send_extended` return False for them, and the
+    batch methods return how many were written. `backpressure` is the
+    share being shed, from 0.0 to 1.0, for callers that can slow down
+    instead.
+
+    Like a Marquise handle, it isn't safe to share between threads
+    without a lock.
+    """
+
+    def __init__(self, marquise, spool_dir=None, rotate_bytes=None, rotate_seconds=None, backlog_high_water=256*1024*1024, backlog_limit=1024*1024*1024, min_free_bytes=256*1024*1024, protected=(), check_interval=5.0, start=True):
+        """Wrap `marquise`, a Marquise handle, and start watching the spool.
+
+        Arguments:
+        marquise -- the Marquise handle to write to.
+        spool_dir -- the spool directory the handle writes to, by default
+            $MARQUISE_SPOOL_DIR or /var/spool/marquise.
+        rotate_bytes -- rotate once the handle's current spool files hold
+            this many bytes between them, or None.
+        rotate_seconds -- rotate once the handle's current spool files
+            are this many seconds old, or None.
+        backlog_high_water -- the backlog in bytes where shedding starts.
+        backlog_limit -- the backlog in bytes where everything that can
+            be shed is.
+        min_free_bytes -- shed everything that can be when the spool's
+            filesystem has less free space than this.
+        protected -- a container of addresses never to shed.
+        check_interval -- the seconds between checks of the spool.
+        start -- if False, the spool isn't checked in the background
+            until `start` is called, though `check` can still be called.
+        """
+        if not 0 <= backlog_high_water < backlog_limit:
+            raise ValueError("backlog_high_water must be below backlog_limit, got %r and %r" % (backlog_high_water, backlog_limit))
+        if check_interval <= 0:
+            raise ValueError("check_interval must be positive, got %r" % check_interval)
+        self.marquise = marquise
+        self.spool_dir = spool_dir or os.environ.get("MARQUISE_SPOOL_DIR", MARQUISE_SPOOL_DIR)
+        self.rotate_bytes = rotate_bytes
+        self.rotate_seconds = rotate_seconds
+        self.backlog_high_water = backlog_high_water
+        self.backlog_limit = backlog_limit
+        self.min_free_bytes = min_free_bytes
+        self.protected = protected
+        self.check_interval = check_interval
+
+        self.keep_ratio = 1.0
+        self.backlog_bytes = None
+        self.free_bytes = None
+        self.written = 0
+        self.shed = 0
+        self.rotations = 0
+        self.write_failures = 0
+        self.last_error = None
+
+        self._credits = LRUCache(CREDIT_ADDRESSES)
+        self._failed_until = None
+        self._opened = time.time()
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="Marquise spool policy")
+        self._thread.daemon = True
+        if start:
+            self.start()
+
+    def __str__(self):
+        """Return a human-readable description of the policy."""
+        return "<SpoolPolicy shedding %.0f%% in front of %s>" % (self.backpressure * 100, self.marquise)
+
+    def start(self):
+        """Start checking the spool in the background, if it wasn't started
+        on creation.
+        """
+        self._thread.start()
+
+    @property
+    def backpressure(self):
+        """The share of unprotected datapoints being shed, from 0.0 to 1.0."""
+        return 1.0 - self._keep_ratio()
+
+    def _keep_ratio(self):
+        """Return the share of unprotected datapoints to write, which is
+        none for a while after a failed write. Intended for internal use.
+        """
+        if self._failed_until is not None:
+            if time.time() < self._failed_until:
+                return 0.0
+            self._failed_until = None
+        return self.keep_ratio
+
+    def check(self):
+        """Measure the spool backlog and free space, and set how much to
+        shed from them.
+        """
+        backlog = backlog_size(self.spool_dir)
+        statvfs = os.statvfs(self.spool_dir)
+        free = statvfs.f_bavail * statvfs.f_frsize
+        if backlog >= self.backlog_limit or free < self.min_free_bytes:
+            keep_ratio = 0.0
+        elif backlog > self.backlog_high_water:
+            keep_ratio = float(self.backlog_limit - backlog) / (self.backlog_limit - self.backlog_high_water)
+        else:
+            keep_ratio = 1.0
+        self.backlog_bytes = backlog
+        self.free_bytes = free
+        self.keep_ratio = keep_ratio
+        self._failed_until = None
+
+    def _run(self):
+        """Checker thread main loop. Intended for internal use."""
+        while not self._stop_event.wait(self.check_interval):
+            try:
+                self.check()
+            except OSError as exc:
+                # The spool directory may be missing until first written.
+                self.last_error = exc
+
+    def _keep(self, address):
+        """Return True if a datapoint for `address` should be written.
+        Intended for internal use.
+        """
+        keep_ratio = self._keep_ratio()
+        if keep_ratio >= 1.0 or address in self.protected:
+            return True
+        # Keep an even keep_ratio share of each address' datapoints, not a
+        # random one. Each address starts from its own fraction of a
+        # credit, so that addresses seen only once are kept in proportion.
+        credit = self._credits.get(address)
+        if credit is None:
+            credit = float(((address >> 1) * GOLDEN) & MASK64) / (MASK64 + 1)
+        credit += keep_ratio
+        if credit >= 1.0:
+            self._credits[address] = credit - 1.0
+            return True
+        self._credits[address] = credit
+        self.shed += 1
+        return False
+
+    def _maybe_rotate(self):
+        """Rotate the handle if it's due. Intended for internal use."""
+        if self.rotate_bytes is not None and self.marquise.bytes_written_points + self.marquise.bytes_written_contents >= self.rotate_bytes:
+            self.rotate()
+        elif self.rotate_seconds is not None:
+            # Handles record when their spool files were opened, which
+            # also catches rotations the policy didn't make.
+            opened = getattr(self.marquise, 'spool_opened', self._opened)
+            if opened is not None and time.time() - opened >= self.rotate_seconds:
+                self.rotate()
+
+    def _failed(self, exc):
+        """Shed everything unprotected for a while after a failed write,
+        see the class documentation. Intended for internal use.
+        """
+        self.write_failures += 1
+        self.last_error = exc
+        self._failed_until = time.time() + self.check_interval
+
+    def _succeeded(self, n_points):
+        """Count a successful write, and stop shedding for a failed one.
+        Intended for internal use.
+        """
+        self.written += n_points
+        self._failed_until = None
+        self._maybe_rotate()
+
+    def rotate(self):
+        """Rotate the wrapped handle now."""
+        self.marquise.rotate()
+        self.rotations += 1
+        self._opened = time.time()
+
+    def send_simple(self, address, timestamp, value):
+        """Queue a simple datapoint unless it's shed, see
+        `Marquise.send_simple`. Return False if it was shed.
+        """
+        if not self._keep(address):
+            return False
+        try:
+            result = self.marquise.send_simple(address, timestamp, value)
+        except RuntimeError as exc:
+            self._failed(exc)
+            raise
+        self._succeeded(1)
+        return result
+
+    def send_extended(self, address, timestamp, value):
+        """Queue an extended datapoint unless it's shed, see
+        `Marquise.send_extended`. Return False if it was shed.
+        """
+        if not self._keep(address):
+            return False
+        try:
+            result = self.marquise.send_extended(address, timestamp, value)
+        except RuntimeError as exc:
+            self._failed(exc)
+            raise
+        self._succeeded(1)
+        return result
+
+    def _send_many(self, method_name, addresses, timestamps, values):
+        """Send the datapoints that aren't shed with the wrapped handle's
+        `method_name` in one call, return the number written. Intended
+        for internal use.
+        """
+        send_many = getattr(self.marquise, method_name)
+        if self._keep_ratio() >= 1.0:
+            kept = None
+        else:
+            addresses = list(addresses)
+            kept = [ i for i, address in enumerate(addresses) if self._keep(address) ]
+            if len(kept) == len(addresses):
+                kept = None
+            else:
+                if timestamps is not None:
+                    timestamps = list(timestamps)
+                    timestamps = [ timestamps[i] for i in kept ]
+                values = list(values)
+                addresses = [ addresses[i] for i in kept ]
+                values = [ values[i] for i in kept ]
+                if not kept:
+                    return 0
+        try:
+            sent = send_many(addresses, timestamps, values)
+        except BatchWriteError as exc:
+            self._failed(exc)
+            self.written += exc.index
+            if kept is None:
+                raise
+            index = kept[exc.index] if exc.index < len(kept) else len(kept)
+            raise BatchWriteError("%s was unsuccessful at index %d, errno is %d" % (method_name, index, exc.errno), index, exc.errno)
+        except RuntimeError as exc:
+            self._failed(exc)
+            raise
+        self._succeeded(sent)
+        return sent
+
+    def send_simple_many(self, addresses, timestamps, values):
+        """Queue the simple datapoints that aren't shed in one call, return
+        the number written. See `Marquise.send_simple_many`.
+        """
+        return self._send_many('send_simple_many', addresses, timestamps, values)
+
+    def send_extended_many(self, addresses, timestamps, values):
+        """Queue the extended datapoints that aren't shed in one call,
+        return the number written. See `Marquise.send_extended_many`.
+
+        Unlike Marquise's, this only takes a sequence of values, not a
+        packed buffer.
+        """
+        return self._send_many('send_extended_many', addresses, timestamps, values)
+
+    def update_source(self, address, metadata_dict, force=False):
+        """Ship a source dict, see `Marquise.update_source`."""
+        return self.marquise.update_source(address, metadata_dict, force)
+
+    def update_sources(self, sources, force=False):
+        """Ship many source dicts, see `Marquise.update_sources`."""
+        return self.marquise.update_sources(sources, force)
+
+    def hash_identifier(self, identifier):
+        """See `Marquise.hash_identifier`."""
+        return self.marquise.hash_identifier(identifier)
+
+    def hash_identifiers(self, identifiers):
+        """See `Marquise.hash_identifiers`."""
+        return self.marquise.hash_identifiers(identifiers)
+
+    def current_timestamp(self):
+        """See `Marquise.current_timestamp`."""
+        return self.marquise.current_timestamp()
+
+    def close(self):
+        """Stop checking the spool and close the wrapped Marquise handle.
+        Multiple close() calls are okay.
+        """
+        self._stop_event.set()
+        if self._thread.ident is not None:
+            self._thread.join()
+        self.marquise.close()
+
+    def stats(self):
+        """Return a dict of the datapoints written and shed, rotations,
+        failed writes, and the last backlog and free space measured.
+        """
+        return {
+            'written':        self.written,
+            'shed':           self.shed,
+            'backpressure':   self.backpressure,
+            'rotations':      self.rotations,
+            'write_failures': self.write_failures,
+            'backlog_bytes':  self.backlog_bytes,
+            'free_bytes':     self.free_bytes,
+        }
@@ -0,0 +1,113 @@
+# pylint: disable=line-too-long
+# pylint: disable=bad-whitespace
+
+"""This module provides a pool of Marquise handles that can be shared between
+threads, so that writers don't all contend on a single marquise_ctx.
+"""
+
+import threading
+from contextlib import contextmanager
+
+from .marquise import Marquise
+
+ROUTES = ('thread', 'address')
+
+class MarquisePool(object):
+
+    """
+    Owns `size` Marquise handles, one per derived namespace
+    (`namespace0` to `namespaceN`), and routes each write to one of them.
+
+    With the 'thread' route every thread is given its own handle in turn,
+    and with the 'address' route the handle is chosen by address, so all
+    the writes for an address go through the same handle. Each handle has
+    its own lock, so threads writing through different handles never wait
+    on each other; CFFI releases the GIL during the libmarquise call, so
+    their spool writes proceed in parallel.
+    """
+
+    def __init__(self, namespace, size, route='thread', debug=False, **kwargs):
+        """Establish `size` marquise contexts.
+
+        Arguments:
+        namespace -- the prefix for each handle's namespace, which must be
+            lowercase alphanumeric ([a-z0-9]+).
+        size -- the number of handles in the pool.
+        route -- 'thread' or 'address', see the class documentation.
+        debug -- as for Marquise.
+        Any other keyword arguments are passed on to each Marquise.
+        """
+        if route not in ROUTES:
+            raise ValueError("route must be one of %s, got %r" % (", ".join(ROUTES), route))
+        if size < 1:
+            raise ValueError("size must be positive, got %r" % size)
+
+        self.namespace = namespace
+        self.route = route
+        self.handles = []
+        try:
+            for i in range(size):
+                self.handles.append(Marquise("%s%d" % (namespace, i), debug=debug, **kwargs))
+        except Exception:
+            self.close()
+            raise
+        self._locks = [ threading.Lock() for _ in self.handles ]
+        self._local = threading.local()
+        self._next_index = 0
+        self._next_index_lock = threading.Lock()
+
+    def __str__(self):
+        """Return a human-readable description of the pool."""
+        return "<MarquisePool of %d handles for namespace %s, routed by %s>" % (len(self.handles), self.namespace, self.route)
+
+    def __len__(self):
+        return len(self.handles)
+
+    def _route(self, address):
+        """Return the index of the handle to use for `address` from the
+        current thread. Intended for internal use.
+        """
+        if self.route == 'address':
+            if address is None:
+                raise ValueError("An address is needed to pick a handle from a pool routed by address")
+            return address % len(self.handles)
+        try:
+            return self._local.index
+        except AttributeError:
+            with self._next_index_lock:
+                index = self._local.index = self._next_index % len(self.handles)
+                self._next_index += 1
+            return index
+
+    @contextmanager
+    def handle(self, address=None):
+        """Return a context manager that holds the lock on a handle chosen
+        for `address` (which can be None for the 'thread' route), yielding
+        the Marquise handle. Use this for the batch methods.
+        """
+        index = self._route(address)
+        with self._locks[index]:
+            yield self.handles[index]
+
+    def send_simple(self, address, timestamp, value):
+        """Queue a simple datapoint, see `Marquise.send_simple`."""
+        index = self._route(address)
+        with self._locks[index]:
+            return self.handles[index].send_simple(address, timestamp, value)
+
+    def send_extended(self, address, timestamp, value):
+        """Queue an extended datapoint, see `Marquise.send_extended`."""
+        index = self._route(address)
+        with self._locks[index]:
+            return self.handles[index].send_extended(address, timestamp, value)
+
+    def update_source(self, address, metadata_dict, force=False):
+        """Ship a source dict, see `Marquise.update_source`."""
+        index = self._route(address)
+        with self._locks[index]:
+            return self.handles[index].update_source(address, metadata_dict, force)
+
+    def close(self):
+        """Close every handle in the pool. Multiple close() calls are okay."""
+        for handle in self.handles:
+            handle.close()
@@ -0,0 +1,170 @@
+# pylint: disable=line-too-long
+# pylint: disable=bad-whitespace
+
+"""This module provides a shared-memory ring buffer of simple datapoints, so
+that a fleet of forked worker processes can hand their writes to a single
+process that owns the Marquise handle.
+"""
+
+import mmap
+import struct
+import multiprocessing
+from array import array
+
+from .errors import BatchWriteError
+from .marquise import Marquise
+
+# The header holds the capacity in records, then the count of records ever
+# written (head), ever read (tail), and dropped because the ring was full.
+HEADER = struct.Struct("@QQQQ")
+HEADER_SIZE = 64
+CAPACITY_OFFSET = 0
+HEAD_OFFSET = 8
+TAIL_OFFSET = 16
+DROPPED_OFFSET = 24
+
+# Each record is an (address, timestamp, value) simple datapoint.
+RECORD = struct.Struct("@QQQ")
+RECORD_SIZE = RECORD.size
+WORD = struct.Struct("@Q")
+
+class SharedRingBuffer(object):
+
+    """
+    A fixed-size ring of simple datapoints in anonymous shared memory.
+
+    Create it in the parent before forking the workers; each worker then
+    calls `send_simple`, which copies the datapoint into the ring without
+    touching libmarquise, and the owning process calls `drain` (or `serve`)
+    to write everything in the ring through its Marquise handle in one
+    batch. Extended datapoints and source dicts aren't fixed-size, so they
+    can't go through the ring.
+
+    When the ring is full, new datapoints are dropped and counted.
+    """
+
+    def __init__(self, capacity=65536, lock=None):
+        """Allocate a ring of `capacity` datapoints.
+
+        Arguments:
+        capacity -- the number of datapoints the ring holds.
+        lock -- a lock shared by every process using the ring, by default
+            a new multiprocessing.Lock.
+        """
+        if capacity < 1:
+            raise ValueError("capacity must be positive, got %r" % capacity)
+        self.capacity = capacity
+        self.lock = lock if lock is not None else multiprocessing.Lock()
+        self.buffer = mmap.mmap(-1, HEADER_SIZE + capacity * RECORD_SIZE)
+        HEADER.pack_into(self.buffer, 0, capacity, 0, 0, 0)
+
+    def __str__(self):
+        """Return a human-readable description of the ring."""
+        return "<SharedRingBuffer holding %d of %d datapoints>" % (len(self), self.capacity)
+
+    def __len__(self):
+        with self.lock:
+            _, head, tail, _ = HEADER.unpack_from(self.buffer, 0)
+        return head - tail
+
+    @property
+    def dropped(self):
+        """The number of datapoints dropped because the ring was full."""
+        return WORD.unpack_from(self.buffer, DROPPED_OFFSET)[0]
+
+    def send_simple(self, address, timestamp, value):
+        """Copy a simple datapoint into the ring, return True if it fit or
+        False if it was dropped. See `Marquise.send_simple`.
+
+        A None `timestamp` is filled in with the current time.
+        """
+        if value is None:
+            raise TypeError("Can't store None as a value.")
+        if timestamp is None:
+            timestamp = Marquise.current_timestamp()
+        record = RECORD.pack(address, timestamp, value)
+        buf = self.buffer
+        with self.lock:
+            _, head, tail, dropped = HEADER.unpack_from(buf, 0)
+            if head - tail >= self.capacity:
+                WORD.pack_into(buf, DROPPED_OFFSET, dropped + 1)
+                return False
+            offset = HEADER_SIZE + (head % self.capacity) * RECORD_SIZE
+            buf[offset:offset + RECORD_SIZE] = record
+            WORD.pack_into(buf, HEAD_OFFSET, head + 1)
+        return True
+
+    def _read(self, max_records):
+        """Return (tail, records) for up to `max_records` datapoints (all
+        of them if None) from the tail of the ring, leaving them in it.
+        Intended for internal use.
+        """
+        buf = self.buffer
+        with self.lock:
+            _, head, tail, _ = HEADER.unpack_from(buf, 0)
+            count = head - tail
+            if max_records is not None:
+                count = min(count, max_records)
+            start = tail % self.capacity
+            first = min(count, self.capacity - start)
+            offset = HEADER_SIZE + start * RECORD_SIZE
+            records = buf[offset:offset + first * RECORD_SIZE]
+            if first < count:
+                records += buf[HEADER_SIZE:HEADER_SIZE + (count - first) * RECORD_SIZE]
+        return tail, records
+
+    def _advance(self, tail, count):
+        """Remove `count` datapoints read from `tail` from the ring.
+        Intended for internal use.
+        """
+        with self.lock:
+            WORD.pack_into(self.buffer, TAIL_OFFSET, tail + count)
+
+    def take(self, max_records=None):
+        """Remove up to `max_records` datapoints (default all of them) from
+        the ring, returning a tuple of (addresses, timestamps, values)
+        arrays.
+        """
+        tail, records = self._read(max_records)
+        self._advance(tail, len(records) // RECORD_SIZE)
+        words = array('Q')
+        words.frombytes(records)
+        return words[0::3], words[1::3], words[2::3]
+
+    def drain(self, marquise, max_records=None):
+        """Write up to `max_records` datapoints (default all of them) from
+        the ring through `marquise` with `send_simple_many`, return the
+        number written.
+
+        Datapoints are only removed from the ring once they're written: if
+        the write fails, whatever wasn't written stays in the ring for the
+        next drain, and the error is raised. Only one process may drain
+        the ring.
+        """
+        tail, records = self._read(max_records)
+        if not records:
+            return 0
+        words = array('Q')
+        words.frombytes(records)
+        try:
+            sent = marquise.send_simple_many(words[0::3], words[1::3], words[2::3])
+        except BatchWriteError as exc:
+            self._advance(tail, exc.index)
+            raise
+        self._advance(tail, sent)
+        return sent
+
+    def serve(self, marquise, stop_event, interval=0.1):
+        """Drain the ring into `marquise` every `interval` seconds until
+        `stop_event` is set, then drain it one last time.
+        """
+        while not stop_event.is_set():
+            if not self.drain(marquise):
+                stop_event.wait(interval)
+        self.drain(marquise)
+
+    def close(self):
+        """Release the shared memory. Only do this once every process is
+        finished with the ring.
+        """
+        self.buffer.close()
@@ -0,0 +1,295 @@
+# pylint: disable=line-too-long
+# pylint: disable=bad-whitespace
+
+"""This module reads libmarquise spool files back, for inspecting a spool
+backlog and replaying it into another namespace.
+
+Spool files are memory-mapped and decoded lazily, one frame at a time, so
+a multi-GB backlog never has to be read into memory. It doesn't need the
+CFFI shim, except to replay through a Marquise handle.
+
+It's also a command-line tool, see `python -m marquise.spool --help`.
+"""
+
+import os
+import sys
+import glob
+import mmap
+import argparse
+from array import array
+from contextlib import contextmanager
+
+from .oslo_strutils import safe_decode
+from .native import NativeMarquise, MARQUISE_SPOOL_DIR, SIMPLE_FRAME, EXTENDED_HEADER, SOURCE_HEADER
+
+KINDS = ('points', 'contents')
+
+# The dtype of the NumPy structured arrays returned by points_array.
+POINT_DTYPE = [('address', '<u8'), ('timestamp', '<u8'), ('value', '<u8')]
+
+def spool_paths(kind, namespace=None, spool_dir=None):
+    """Return the paths of the `kind` ('points' or 'contents') spool files
+    waiting in `spool_dir`, oldest first.
+
+    Arguments:
+    kind -- 'points' or 'contents'.
+    namespace -- only return files for this namespace, by default all of them.
+    spool_dir -- by default $MARQUISE_SPOOL_DIR or /var/spool/marquise.
+    """
+    if kind not in KINDS:
+        raise ValueError("kind must be one of %s, got %r" % (", ".join(KINDS), kind))
+    if spool_dir is None:
+        spool_dir = os.environ.get("MARQUISE_SPOOL_DIR", MARQUISE_SPOOL_DIR)
+    pattern = os.path.join(spool_dir, kind, namespace or "*", "new", "*")
+    return sorted([ path for path in glob.glob(pattern) if os.path.isfile(path) ], key=os.path.getmtime)
+
+def backlog_size(spool_dir=None):
+    """Return the total size in bytes of the spool files of every kind and
+    namespace waiting in `spool_dir`, by default $MARQUISE_SPOOL_DIR or
+    /var/spool/marquise.
+    """
+    if spool_dir is None:
+        spool_dir = os.environ.get("MARQUISE_SPOOL_DIR", MARQUISE_SPOOL_DIR)
+    total = 0
+    for kind in KINDS:
+        for path in glob.glob(os.path.join(spool_dir, kind, "*", "new", "*")):
+            try:
+                total += os.path.getsize(path)
+            except OSError:
+                # Shipped and removed since the glob.
+                pass
+    return total
+
+@contextmanager
+def mapped(path):
+    """Return a context manager yielding a read-only mmap of the file at
+    `path`, or an empty bytestring for an empty file, which can't be mapped.
+    """
+    with open(path, 'rb') as spool_file:
+        if os.fstat(spool_file.fileno()).st_size == 0:
+            yield b''
+            return
+        buf = mmap.mmap(spool_file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            yield buf
+        finally:
+            buf.close()
+
+def frame_runs(buf):
+    """Yield the frames in a points spool buffer, grouping consecutive
+    simple datapoints. Each item is a tuple of (offset, count) for a run
+    of `count` simple frames starting at `offset`, or (offset, None) for
+    an extended frame.
+
+    A partly-written frame at the end of the buffer is ignored.
+    """
+    unpack_from = EXTENDED_HEADER.unpack_from
+    frame_size = SIMPLE_FRAME.size
+    end = len(buf)
+    offset = 0
+    run_start = 0
+    while offset + frame_size <= end:
+        address, _, length = unpack_from(buf, offset)
+        if not address & 1:
+            offset += frame_size
+            continue
+        if offset + frame_size + length > end:
+            break
+        if offset > run_start:
+            yield run_start, (offset - run_start) // frame_size
+        yield offset, None
+        offset += frame_size + length
+        run_start = offset
+    if offset > run_start:
+        yield run_start, (offset - run_start) // frame_size
+
+def iter_points(path):
+    """Yield the datapoints in the points spool file at `path` as
+    (address, timestamp, value) tuples.
+
+    Simple values are integers and extended values are bytestrings.
+    Addresses are as spooled, so those of extended datapoints have the
+    least significant bit set.
+    """
+    unpack_from = EXTENDED_HEADER.unpack_from
+    frame_size = SIMPLE_FRAME.size
+    with mapped(path) as buf:
+        end = len(buf)
+        offset = 0
+        while offset + frame_size <= end:
+            address, timestamp, word = unpack_from(buf, offset)
+            offset += frame_size
+            if not address & 1:
+                yield address, timestamp, word
+                continue
+            if offset + word > end:
+                break
+            yield address, timestamp, buf[offset:offset + word]
+            offset += word
+
+def iter_sources(path):
+    """Yield the source dicts in the contents spool file at `path` as
+    (address, metadata_dict) tuples.
+    """
+    unpack_from = SOURCE_HEADER.unpack_from
+    header_size = SOURCE_HEADER.size
+    with mapped(path) as buf:
+        end = len(buf)
+        offset = 0
+        while offset + header_size <= end:
+            address, length = unpack_from(buf, offset)
+            offset += header_size
+            if offset + length > end:
+                break
+            serialized = safe_decode(buf[offset:offset + length], 'utf8')
+            offset += length
+            yield address, dict([ pair.split(":", 1) for pair in serialized.split(",") if pair ])
+
+def points_array(path):
+    """Return the simple datapoints in the points spool file at `path` as
+    a NumPy structured array with 'address', 'timestamp' and 'value'
+    fields. Extended datapoints are left out, use `iter_points` for them.
+
+    A file holding only simple datapoints is returned as a read-only view
+    of the mapped file, without copying. The file stays mapped until the
+    array is garbage collected.
+
+    This needs NumPy, which isn't otherwise required.
+    """
+    import numpy
+    dtype = numpy.dtype(POINT_DTYPE)
+    with open(path, 'rb') as spool_file:
+        size = os.fstat(spool_file.fileno()).st_size
+        if size == 0:
+            return numpy.zeros(0, dtype=dtype)
+        buf = mmap.mmap(spool_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    # Extended frames can only start where simple frames end, so if every
+    # frame-aligned address is even the whole file is simple frames.
+    if size % dtype.itemsize == 0:
+        points = numpy.frombuffer(buf, dtype=dtype)
+        if not (points['address'] & 1).any():
+            return points
+
+    runs = [ numpy.frombuffer(buf, dtype=dtype, count=count, offset=offset) for offset, count in frame_runs(buf) if count is not None ]
+    return numpy.concatenate(runs) if runs else numpy.zeros(0, dtype=dtype)
+
+def count_points(path):
+    """Return a tuple of the number of (simple, extended) datapoints in
+    the points spool file at `path`.
+    """
+    simple = extended = 0
+    with mapped(path) as buf:
+        for _, count in frame_runs(buf):
+            if count is None:
+                extended += 1
+            else:
+                simple += count
+    return simple, extended
+
+def replay(marquise, points_paths=(), contents_paths=(), batch_size=10000):
+    """Write everything in the given spool files through `marquise`, a
+    Marquise handle, return a tuple of the number of (datapoints, source
+    dicts) replayed.
+
+    Consecutive simple datapoints are sent in batches of up to
+    `batch_size` with `send_simple_many`, straight from the mapped file.
+    """
+    n_points = 0
+    for path in points_paths:
+        with mapped(path) as buf:
+            for offset, count in frame_runs(buf):
+                if count is None:
+                    address, timestamp, length = EXTENDED_HEADER.unpack_from(buf, offset)
+                    start = offset + EXTENDED_HEADER.size
+                    marquise.send_extended(address, timestamp, buf[start:start + length])
+                    n_points += 1
+                    continue
+                frame_size = SIMPLE_FRAME.size
+                for batch_start in range(0, count, batch_size):
+                    words = array('Q')
+                    batch_offset = offset + batch_start * frame_size
+                    words.frombytes(buf[batch_offset:batch_offset + min(batch_size, count - batch_start) * frame_size])
+                    if sys.byteorder != 'little':
+                        words.byteswap()
+                    n_points += marquise.send_simple_many(words[0::3], words[1::3], words[2::3])
+
+    n_sources = 0
+    for path in contents_paths:
+        for address, metadata_dict in iter_sources(path):
+            marquise.update_source(address, metadata_dict, force=True)
+            n_sources += 1
+    return n_points, n_sources
+
+
+def inspect_command(args):
+    """Print the datapoints or source dicts in the spool."""
+    shown = 0
+    for path in spool_paths(args.kind, args.namespace, args.spool_dir):
+        print("# %s" % path)
+        items = iter_points(path) if args.kind == 'points' else iter_sources(path)
+        for item in items:
+            if args.limit is not None and shown >= args.limit:
+                return 0
+            print("%d\t%s" % (item[0], "\t".join([ repr(x) if isinstance(x, (bytes, bytearray, dict)) else str(x) for x in item[1:] ])))
+            shown += 1
+    return 0
+
+def count_command(args):
+    """Print the datapoint counts and sizes of the points spool files."""
+    total_simple = total_extended = total_bytes = 0
+    for path in spool_paths('points', args.namespace, args.spool_dir):
+        simple, extended = count_points(path)
+        size = os.path.getsize(path)
+        print("%s\t%d simple\t%d extended\t%d bytes" % (path, simple, extended, size))
+        total_simple += simple
+        total_extended += extended
+        total_bytes += size
+    print("total\t%d simple\t%d extended\t%d bytes" % (total_simple, total_extended, total_bytes))
+    return 0
+
+def replay_command(args):
+    """Replay the spool into another namespace."""
+    # Never replay the files we're about to write.
+    skip = os.sep + args.to_namespace + os.sep
+    points_paths = [ path for path in spool_paths('points', args.namespace, args.spool_dir) if skip not in path ]
+    contents_paths = [ path for path in spool_paths('contents', args.namespace, args.spool_dir) if skip not in path ]
+    if args.backend == 'native':
+        marquise = NativeMarquise(args.to_namespace, spool_dir=args.spool_dir)
+    else:
+        from .marquise import Marquise
+        marquise = Marquise(args.to_namespace, spool_dir=args.spool_dir)
+    try:
+        n_points, n_sources = replay(marquise, points_paths, contents_paths, args.batch_size)
+    finally:
+        marquise.close()
+    print("Replayed %d datapoints and %d source dicts into %s" % (n_points, n_sources, args.to_namespace))
+    return 0
+
+def main(argv=None):
+    """Run the marquise-spool command-line tool."""
+    parser = argparse.ArgumentParser(prog="marquise-spool", description="Inspect, count and replay libmarquise spool files.")
+    parser.add_argument("--spool-dir", help="the spool directory, by default $MARQUISE_SPOOL_DIR or %s" % MARQUISE_SPOOL_DIR)
+    parser.add_argument("--namespace", help="only read this namespace's spool files")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    inspect_parser = subparsers.add_parser("inspect", help="print datapoints or source dicts")
+    inspect_parser.add_argument("--kind", choices=KINDS, default='points')
+    inspect_parser.add_argument("--limit", type=int, help="stop after this many")
+    inspect_parser.set_defaults(func=inspect_command)
+
+    count_parser = subparsers.add_parser("count", help="count datapoints in each points spool file")
+    count_parser.set_defaults(func=count_command)
+
+    replay_parser = subparsers.add_parser("replay", help="write the spool through a Marquise handle for another namespace")
+    replay_parser.add_argument("to_namespace")
+    replay_parser.add_argument("--backend", choices=('cffi', 'native'), default='cffi')
+    replay_parser.add_argument("--batch-size", type=int, default=10000)
+    replay_parser.set_defaults(func=replay_command)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,211 @@
+# pylint: disable=line-too-long
+# pylint: disable=bad-whitespace
+
+"""This module provides write-path instrumentation for Marquise handles:
+call and failure counters and log-bucketed latency histograms, cheap
+enough to leave on in production.
+"""
+
+import time
+import threading
+
+try:
+    clock_ns = time.perf_counter_ns
+except AttributeError:
+    def clock_ns():
+        """Return a monotonic-ish clock reading in nanoseconds."""
+        return int(getattr(time, 'perf_counter', time.time)() * 1000000000)
+
+# The methods counted and timed on a handle created with stats=True.
+WRITE_METHODS = ('send_simple', 'send_simple_many', 'send_extended', 'send_extended_many', 'update_source', 'update_sources')
+
+# Bucket i counts latencies of 2**(i-1) to 2**i - 1 nanoseconds, so 64
+# buckets cover anything a uint64_t can hold.
+N_BUCKETS = 64
+
+class LatencyHistogram(object):
+
+    """
+    A histogram of latencies in nanoseconds, bucketed by powers of two.
+    Recording only bumps preallocated counters, nothing is allocated.
+    """
+
+    def __init__(self):
+        self.buckets = [0] * N_BUCKETS
+        self.count = 0
+        self.total_ns = 0
+
+    def record(self, elapsed_ns):
+        """Count one latency of `elapsed_ns` nanoseconds."""
+        self.buckets[min(elapsed_ns.bit_length(), N_BUCKETS - 1)] += 1
+        self.count += 1
+        self.total_ns += elapsed_ns
+
+    def percentile(self, percent):
+        """Return an upper bound in nanoseconds on the `percent`th
+        percentile latency, or 0 if nothing has been recorded.
+        """
+        threshold = self.count * percent / 100.0
+        seen = 0
+        for i, bucket in enumerate(self.buckets):
+            seen += bucket
+            if bucket and seen >= threshold:
+                return (1 << i) - 1
+        return 0
+
+    def snapshot(self):
+        """Return a dict of the count, mean, percentiles and the non-empty
+        buckets, as a list of (upper bound in ns, count) pairs.
+        """
+        return {
+            'count':    self.count,
+            'mean_ns':  self.total_ns // self.count if self.count else 0,
+            'p50_ns':   self.percentile(50),
+            'p99_ns':   self.percentile(99),
+            'buckets':  [ ((1 << i) - 1, bucket) for i, bucket in enumerate(self.buckets) if bucket ],
+        }
+
+
+class MethodStats(object):
+
+    """Counters and histograms for one write method."""
+
+    def __init__(self):
+        self.calls = 0
+        self.datapoints = 0
+        self.rejected = 0
+        self.failures = {}
+        self.latency = LatencyHistogram()
+        self.c_latency = LatencyHistogram()
+
+    def snapshot(self):
+        """Return a dict of the counters and histogram snapshots."""
+        return {
+            'calls':      self.calls,
+            'datapoints': self.datapoints,
+            'rejected':   self.rejected,
+            'failures':   dict(self.failures),
+            'latency':    self.latency.snapshot(),
+            'c_latency':  self.c_latency.snapshot(),
+        }
+
+
+class WriteStats(object):
+
+    """
+    Instrumentation for the write methods of a Marquise handle.
+
+    For each method it counts calls, datapoints written, calls rejected
+    for bad input (TypeError or ValueError), and failed writes by errno.
+    It keeps two latency histograms: `latency` for the whole call, and
+    `c_latency` for the libmarquise call inside it, which is where the
+    spool I/O happens. The difference between them is time spent in
+    Python and marshalling arguments for C.
+    """
+
+    def __init__(self, methods, errno_of=None):
+        """Create empty stats for the named `methods`.
+
+        Arguments:
+        methods -- the names of the methods to instrument.
+        errno_of -- a function returning the errno of a failed write's
+            exception, by default its `errno` attribute.
+        """
+        self.methods = dict([ (name, MethodStats()) for name in methods ])
+        self.errno_of = errno_of or (lambda exc: getattr(exc, 'errno', None))
+
+    def wrap(self, name, method):
+        """Return `method` wrapped to record its stats under `name`."""
+        method_stats = self.methods[name]
+        latency = method_stats.latency
+        errno_of = self.errno_of
+        def instrumented(*args, **kwargs):
+            """Call the wrapped method, recording its stats."""
+            start = clock_ns()
+            try:
+                result = method(*args, **kwargs)
+            except (TypeError, ValueError):
+                method_stats.rejected += 1
+                raise
+            except Exception as exc:
+                errno_value = errno_of(exc)
+                method_stats.failures[errno_value] = method_stats.failures.get(errno_value, 0) + 1
+                raise
+            finally:
+                latency.record(clock_ns() - start)
+                method_stats.calls += 1
+            if isinstance(result, int):
+                method_stats.datapoints += result
+            return result
+        instrumented.__doc__ = method.__doc__
+        return instrumented
+
+    def instrument(self, handle):
+        """Replace the instrumented methods of `handle` with wrappers, on
+        that instance only. Uninstrumented handles pay nothing.
+        """
+        for name in self.methods:
+            setattr(handle, name, self.wrap(name, getattr(handle, name)))
+
+    def time_c_call(self, name, function, *args):
+        """Call the C `function` with `args`, recording its latency in the
+        `c_latency` histogram of method `name`, and return its result.
+        """
+        start = clock_ns()
+        try:
+            return function(*args)
+        finally:
+            self.methods[name].c_latency.record(clock_ns() - start)
+
+    def snapshot(self):
+        """Return a dict of every method's stats snapshot."""
+        return dict([ (name, method_stats.snapshot()) for name, method_stats in self.methods.items() ])
+
+
+class StatsReporter(object):
+
+    """
+    Calls `callback` with `source.stats()` every `interval` seconds from a
+    background thread, to feed a handle's stats into a monitoring system.
+    Works with anything that has a `stats` method, such as Marquise and
+    AsyncMarquise.
+    """
+
+    def __init__(self, source, callback, interval=60.0, start=True):
+        """Arrange for `callback(source.stats())` to be called regularly.
+
+        Arguments:
+        source -- the object to take stats snapshots of.
+        callback -- called with each snapshot. Exceptions it raises are
+            ignored, so a broken callback can't stop the reports.
+        interval -- the seconds between reports.
+        start -- if False, reporting doesn't begin until `start` is called.
+        """
+        if interval <= 0:
+            raise ValueError("interval must be positive, got %r" % interval)
+        self.source = source
+        self.callback = callback
+        self.interval = interval
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="Marquise stats reporter")
+        self._thread.daemon = True
+        if start:
+            self.start()
+
+    def start(self):
+        """Start reporting, if it wasn't started on creation."""
+        self._thread.start()
+
+    def _run(self):
+        """Reporter thread main loop. Intended for internal use."""
+        while not self._stop_event.wait(self.interval):
+            try:
+                self.callback(self.source.stats())
+            except Exception: # pylint: disable=broad-except
+                pass
+
+    def stop(self):
+        """Stop reporting and wait for the reporter thread to finish."""
+        self._stop_event.set()
+        if self._thread.ident is not None:
+            self._thread.join()
@@ -0,0 +1,67 @@
+# pylint: disable=line-too-long
+# pylint: disable=bad-whitespace
+
+"""This module provides tracing hooks for Marquise handles.
+
+A handle with a Tracer reports each write as a structured event, a name
+and a dict of fields, to every hook on the tracer. Handles without one
+check a single attribute per write and do nothing else, so tracing costs
+nothing until it's turned on.
+"""
+
+from __future__ import print_function
+
+
+def print_hook(event, fields):
+    """A hook that prints events, as `debug=True` used to."""
+    if event == 'debug':
+        print("DEBUG: %s" % fields['message'])
+    else:
+        print("DEBUG: %s %s" % (event, " ".join([ "%s=%r" % pair for pair in sorted(fields.items()) ])))
+
+
+class Tracer(object):
+
+    """
+    Hands trace events from a Marquise handle to hooks.
+
+    Each hook is called as `hook(event, fields)`, where `event` names what
+    happened (eg. 'send_simple') and `fields` is a dict describing it.
+    Successful writes are sampled, 1 in every `sample_every`; failures and
+    debug messages are always emitted.
+    """
+
+    def __init__(self, hooks=None, sample_every=1):
+        """Create a tracer.
+
+        Arguments:
+        hooks -- a sequence of callables to hand events to.
+        sample_every -- emit an event for 1 in every `sample_every`
+            successful writes.
+        """
+        if sample_every < 1:
+            raise ValueError("sample_every must be positive, got %r" % sample_every)
+        self.hooks = list(hooks or [])
+        self.sample_every = sample_every
+        self._countdown = 1
+
+    def add_hook(self, hook):
+        """Start handing events to `hook`."""
+        self.hooks.append(hook)
+
+    def remove_hook(self, hook):
+        """Stop handing events to `hook`."""
+        self.hooks.remove(hook)
+
+    def sampled(self):
+        """Return True if the current write should be traced."""
+        self._countdown -= 1
+        if self._countdown:
+            return False
+        self._countdown = self.sample_every
+        return True
+
+    def emit(self, event, **fields):
+        """Hand an event to every hook."""
+        for hook in self.hooks:
+            hook(event, fields)
@@ -1,13 +1,8 @@
 from setuptools import setup
 
-import marquise.marquise
-extension = marquise.marquise.FFI.verifier.get_extension()
-
-# These notes suggest that there's not yet any "correct" way to do packageable
-# CFFI interfaces. For now I'm splitting the CFFI stuff from the python
-# interface stuff, and it seems to do the job okay, though dealing with
-# packages and modules is a flailfest at best for me.
-# https://bitbucket.org/cffi/cffi/issue/109/enable-sane-packaging-for-cffi
+# The CFFI shim is built out-of-line from marquise/build_cffi.py at install
+# time, so importing marquise never has to parse headers or run a compiler,
+# and works from a read-only site-packages.
 
 setup(
     name="marquise",
@@ -23,6 +18,23 @@ setup(
         "marquise",
     ],
     package_data={"marquise" : ["marquise.h"]},
-    ext_modules = [extension],
-    include_package_data=True
+    # array('Q'), memoryview.c_contiguous and bytes/array round trips
+    # through frombytes/tobytes all need Python 3.3.
+    python_requires=">=3.3",
+    classifiers=[
+        "Programming Language :: Python :: 3",
+        "Programming Language :: Python :: 3.3",
+        "Programming Language :: Python :: 3.4",
+    ],
+    setup_requires=["cffi>=1.0.0"],
+    install_requires=["cffi>=1.0.0", "six"],
+    cffi_modules=["marquise/build_cffi.py:FFI_BUILDER"],
+    include_package_data=True,
+    entry_points={
+        "console_scripts": [
+            "marquise-spool = marquise.spool:main",
+            "marquise-ingestd = marquise.ingestd:main",
+            "marquise-load = marquise.load:main",
+        ],
+    },
 )
@@ -0,0 +1,277 @@
+/* A stand-in for libmarquise, for benchmarking pymarquise without disk I/O.
+ *
+ * It implements the API in marquise.h, so a shim built against the real
+ * library can be pointed at this one with LD_LIBRARY_PATH. Where the
+ * writes go depends on $PYMARQUISE_STUB_SINK:
+ *
+ *   null (the default) -- frames are counted in bytes_written_* and thrown
+ *       away, so only Python and FFI marshalling costs are left.
+ *   file -- frames are appended to the spool files under
+ *       $MARQUISE_SPOOL_DIR, through stdio buffers. Point that at a tmpfs
+ *       to take the disk out of the picture but keep the syscalls.
+ *
+ * It doesn't need glib: the context is laid out like marquise_ctx, with
+ * the sd_hashes pointer used for the stub's own state.
+ */
+
+#include <ctype.h>
+#include <errno.h>
+#include <stdint.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <sys/stat.h>
+#include <unistd.h>
+
+#define MARQUISE_SPOOL_DIR "/var/spool/marquise"
+
+typedef struct {
+	FILE *points;
+	FILE *contents;
+} stub_sink;
+
+typedef struct {
+	char *marquise_namespace;
+	char *spool_path_points;
+	char *spool_path_contents;
+	size_t bytes_written_points;
+	size_t bytes_written_contents;
+	stub_sink *sink;
+} marquise_ctx;
+
+typedef struct {
+	char **fields;
+	char **values;
+	size_t n_tags;
+} marquise_source;
+
+int marquise_shutdown(marquise_ctx *ctx);
+
+/* SipHash-2-4 with an all-zeroes key, as libmarquise uses. */
+#define ROTL(x, b) (uint64_t)(((x) << (b)) | ((x) >> (64 - (b))))
+#define SIPROUND do { \
+	v0 += v1; v1 = ROTL(v1, 13); v1 ^= v0; v0 = ROTL(v0, 32); \
+	v2 += v3; v3 = ROTL(v3, 16); v3 ^= v2; \
+	v0 += v3; v3 = ROTL(v3, 21); v3 ^= v0; \
+	v2 += v1; v1 = ROTL(v1, 17); v1 ^= v2; v2 = ROTL(v2, 32); \
+} while (0)
+
+static uint64_t read_le64(const unsigned char *p, size_t n)
+{
+	uint64_t word = 0;
+	size_t i;
+	for (i = 0; i < n; i++)
+		word |= (uint64_t)p[i] << (8 * i);
+	return word;
+}
+
+uint64_t marquise_hash_identifier(const unsigned char *id, size_t id_len)
+{
+	uint64_t v0 = 0x736f6d6570736575ULL;
+	uint64_t v1 = 0x646f72616e646f6dULL;
+	uint64_t v2 = 0x6c7967656e657261ULL;
+	uint64_t v3 = 0x7465646279746573ULL;
+	uint64_t word;
+	size_t offset;
+
+	for (offset = 0; offset + 8 <= id_len; offset += 8) {
+		word = read_le64(id + offset, 8);
+		v3 ^= word;
+		SIPROUND;
+		SIPROUND;
+		v0 ^= word;
+	}
+	word = read_le64(id + offset, id_len - offset) | ((uint64_t)id_len << 56);
+	v3 ^= word;
+	SIPROUND;
+	SIPROUND;
+	v0 ^= word;
+
+	v2 ^= 0xff;
+	SIPROUND;
+	SIPROUND;
+	SIPROUND;
+	SIPROUND;
+	return v0 ^ v1 ^ v2 ^ v3;
+}
+
+static int sink_to_file(void)
+{
+	const char *sink = getenv("PYMARQUISE_STUB_SINK");
+	return sink != NULL && strcmp(sink, "file") == 0;
+}
+
+static int make_dirs(char *path)
+{
+	char *slash;
+	for (slash = strchr(path + 1, '/'); slash != NULL; slash = strchr(slash + 1, '/')) {
+		*slash = '\0';
+		if (mkdir(path, 0755) != 0 && errno != EEXIST) {
+			*slash = '/';
+			return -1;
+		}
+		*slash = '/';
+	}
+	if (mkdir(path, 0755) != 0 && errno != EEXIST)
+		return -1;
+	return 0;
+}
+
+/* Returns a new spool file path, creating the file, or NULL on failure. */
+static char *build_spool_path(const char *marquise_namespace, const char *kind)
+{
+	const char *spool_dir = getenv("MARQUISE_SPOOL_DIR");
+	size_t len;
+	char *path;
+	int fd;
+
+	if (spool_dir == NULL)
+		spool_dir = MARQUISE_SPOOL_DIR;
+	len = strlen(spool_dir) + strlen(kind) + strlen(marquise_namespace) + 16;
+	path = malloc(len);
+	if (path == NULL)
+		return NULL;
+	snprintf(path, len, "%s/%s/%s/new", spool_dir, kind, marquise_namespace);
+	if (make_dirs(path) != 0) {
+		free(path);
+		return NULL;
+	}
+	strcat(path, "/XXXXXX");
+	fd = mkstemp(path);
+	if (fd < 0) {
+		free(path);
+		return NULL;
+	}
+	close(fd);
+	return path;
+}
+
+marquise_ctx *marquise_init(char *marquise_namespace)
+{
+	marquise_ctx *ctx;
+	const char *c;
+
+	for (c = marquise_namespace; *c; c++) {
+		if (!(islower((unsigned char)*c) || isdigit((unsigned char)*c))) {
+			errno = EINVAL;
+			return NULL;
+		}
+	}
+
+	ctx = calloc(1, sizeof(*ctx));
+	if (ctx == NULL)
+		return NULL;
+	ctx->marquise_namespace = strdup(marquise_namespace);
+	ctx->spool_path_points = build_spool_path(marquise_namespace, "points");
+	ctx->spool_path_contents = build_spool_path(marquise_namespace, "contents");
+	ctx->sink = calloc(1, sizeof(*ctx->sink));
+	if (ctx->spool_path_points == NULL || ctx->spool_path_contents == NULL || ctx->sink == NULL)
+		goto fail;
+	if (sink_to_file()) {
+		ctx->sink->points = fopen(ctx->spool_path_points, "ab");
+		ctx->sink->contents = fopen(ctx->spool_path_contents, "ab");
+		if (ctx->sink->points == NULL || ctx->sink->contents == NULL)
+			goto fail;
+	}
+	return ctx;
+
+fail:
+	marquise_shutdown(ctx);
+	return NULL;
+}
+
+static int sink_write(FILE *file, size_t *bytes_written, const void *header, size_t header_len, const void *body, size_t body_len)
+{
+	if (file != NULL) {
+		if (fwrite(header, 1, header_len, file) != header_len)
+			return -1;
+		if (body_len && fwrite(body, 1, body_len, file) != body_len)
+			return -1;
+	}
+	*bytes_written += header_len + body_len;
+	return 0;
+}
+
+int marquise_send_simple(marquise_ctx *ctx, uint64_t address, uint64_t timestamp, uint64_t value)
+{
+	uint64_t frame[3] = { address & ~1ULL, timestamp, value };
+	return sink_write(ctx->sink->points, &ctx->bytes_written_points, frame, sizeof(frame), NULL, 0);
+}
+
+int marquise_send_extended(marquise_ctx *ctx, uint64_t address, uint64_t timestamp, char *value, size_t value_len)
+{
+	uint64_t header[3] = { address | 1ULL, timestamp, value_len };
+	return sink_write(ctx->sink->points, &ctx->bytes_written_points, header, sizeof(header), value, value_len);
+}
+
+marquise_source *marquise_new_source(char **fields, char **values, size_t n_tags)
+{
+	marquise_source *source;
+	size_t i;
+
+	for (i = 0; i < n_tags; i++) {
+		if (strpbrk(fields[i], ",:") != NULL || strpbrk(values[i], ",:") != NULL) {
+			errno = EINVAL;
+			return NULL;
+		}
+	}
+	source = malloc(sizeof(*source));
+	if (source == NULL)
+		return NULL;
+	source->fields = malloc(n_tags * sizeof(char *));
+	source->values = malloc(n_tags * sizeof(char *));
+	source->n_tags = n_tags;
+	for (i = 0; i < n_tags; i++) {
+		source->fields[i] = strdup(fields[i]);
+		source->values[i] = strdup(values[i]);
+	}
+	return source;
+}
+
+void marquise_free_source(marquise_source *source)
+{
+	size_t i;
+	for (i = 0; i < source->n_tags; i++) {
+		free(source->fields[i]);
+		free(source->values[i]);
+	}
+	free(source->fields);
+	free(source->values);
+	free(source);
+}
+
+int marquise_update_source(marquise_ctx *ctx, uint64_t address, marquise_source *source)
+{
+	uint64_t header[2] = { address, 0 };
+	char *serialized, *p;
+	size_t i;
+	int ret;
+
+	for (i = 0; i < source->n_tags; i++)
+		header[1] += strlen(source->fields[i]) + strlen(source->values[i]) + 2;
+	serialized = malloc(header[1] + 1);
+	if (serialized == NULL)
+		return -1;
+	p = serialized;
+	for (i = 0; i < source->n_tags; i++)
+		p += sprintf(p, "%s:%s,", source->fields[i], source->values[i]);
+	ret = sink_write(ctx->sink->contents, &ctx->bytes_written_contents, header, sizeof(header), serialized, header[1]);
+	free(serialized);
+	return ret;
+}
+
+int marquise_shutdown(marquise_ctx *ctx)
+{
+	if (ctx->sink != NULL) {
+		if (ctx->sink->points != NULL)
+			fclose(ctx->sink->points);
+		if (ctx->sink->contents != NULL)
+			fclose(ctx->sink->contents);
+		free(ctx->sink);
+	}
+	free(ctx->spool_path_points);
+	free(ctx->spool_path_contents);
+	free(ctx->marquise_namespace);
+	free(ctx);
+	return 0;
+}
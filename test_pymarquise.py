@@ -8,8 +8,37 @@
 
 import sys
 import os
+from array import array
 import pytest
-from marquise import Marquise
+import time
+import shutil
+import tempfile
+import threading
+import ctypes
+from marquise import Marquise, BatchWriteError, NativeMarquise
+from marquise.cache import AddressCache
+from marquise.async_marquise import AsyncMarquise
+from marquise.pool import MarquisePool
+from marquise.ring import SharedRingBuffer
+from marquise.native import siphash24
+from marquise import spool
+from marquise.stats import StatsReporter
+from marquise.trace import Tracer
+from marquise.aggregator import Aggregator, TimerSeries, MAX_TIMER_SAMPLES
+from marquise.dedupe import DedupeFilter, LastValueTable
+from marquise.index import SourceIndex
+from marquise.policy import SpoolPolicy
+from marquise.identifier import SourceIdentifier
+from marquise.clock import Clock, CoarseClock
+from marquise.pipeline import Pipeline
+from marquise import ingestd
+from marquise.load import Loader
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+from marquise.marquise_cffi import FFI, cprint, uint64_buffer
 
 # This keeps pylint happy
 # pylint: disable=no-member
@@ -54,6 +83,33 @@ def test_hash_identifier():
     """Ensure that we can call hash_identifier and get the right answer back."""
     assert Marquise.hash_identifier(TEST_IDENTIFIER) == 7602883380529707052
 
+def test_hash_identifier_non_ascii():
+    """Ensure that the whole of a non-ASCII identifier gets hashed."""
+    assert Marquise.hash_identifier(u"metric:caf\u00e9a,") != Marquise.hash_identifier(u"metric:caf\u00e9b,")
+    assert Marquise.hash_identifier(u"metric:caf\u00e9,") == Marquise.hash_identifier(u"metric:caf\u00e9,".encode('utf8'))
+
+def test_hash_identifiers():
+    """Ensure that bulk hashing agrees with hash_identifier."""
+    identifiers = [TEST_IDENTIFIER, TEST_SOURCE1, u"metric:caf\u00e9,", ""]
+    assert Marquise.hash_identifiers(identifiers) == [ Marquise.hash_identifier(x) for x in identifiers ]
+    assert Marquise.hash_identifiers([]) == []
+    with RAISES(TypeError):
+        Marquise.hash_identifiers([None])
+
+def test_address_cache():
+    """Exercise AddressCache lookups, statistics and eviction."""
+    cache = AddressCache(maxsize=2)
+    assert cache.hash_identifier(TEST_IDENTIFIER) == 7602883380529707052
+    assert cache.hash_identifier(TEST_IDENTIFIER) == 7602883380529707052
+    assert cache.stats() == {'hits': 1, 'misses': 1, 'evictions': 0, 'size': 1, 'maxsize': 2}
+    # Bulk lookups only hash what's missing, and evict the oldest entries
+    addresses = cache.hash_identifiers([TEST_IDENTIFIER, TEST_SOURCE1, "foo:bar,"])
+    assert addresses == Marquise.hash_identifiers([TEST_IDENTIFIER, TEST_SOURCE1, "foo:bar,"])
+    assert cache.stats() == {'hits': 2, 'misses': 3, 'evictions': 1, 'size': 2, 'maxsize': 2}
+    assert TEST_IDENTIFIER not in cache
+    with RAISES(ValueError):
+        AddressCache(maxsize=0)
+
 def test_bogus_namespace():
     """Ensure that invalid namespaces are not accepted."""
     with RAISES(ValueError):
@@ -120,6 +176,60 @@ def test_send_simple_write_failure():
     marq.close()
 
 
+def test_send_simple_many():
+    """Exercise send_simple_many with good and bad input."""
+    marq = Marquise(TEST_GOOD_NAMESPACE, debug=DEBUG)
+    # Plain lists get copied, uint64 arrays are passed through as buffers
+    assert marq.send_simple_many([TEST_GOOD_ADDRESS]*3, [1234567890, 1234567891, 1234567892], [1, 2, 3]) == 3
+    assert marq.send_simple_many(array('Q', [TEST_GOOD_ADDRESS]*3), array('Q', [1, 2, 3]), array('Q', [4, 5, 6])) == 3
+    # None timestamps get the current time
+    assert marq.send_simple_many([TEST_GOOD_ADDRESS]*2, None, [42, 43]) == 2
+    # An empty batch is fine
+    assert marq.send_simple_many([], None, []) == 0
+    # Mismatched lengths
+    with RAISES(ValueError):
+        marq.send_simple_many([TEST_GOOD_ADDRESS]*2, None, [42])
+    with RAISES(ValueError):
+        marq.send_simple_many([TEST_GOOD_ADDRESS]*2, [1234567890], [42, 43])
+    # Non-numeric values
+    with RAISES(TypeError):
+        marq.send_simple_many([TEST_GOOD_ADDRESS], None, ["pantsu"])
+    # None as a value
+    with RAISES(TypeError):
+        marq.send_simple_many([TEST_GOOD_ADDRESS], None, [None])
+    marq.close()
+    with RAISES(ValueError):
+        marq.send_simple_many([TEST_GOOD_ADDRESS], None, [42])
+
+
+def test_uint64_buffer():
+    """Ensure only native-order unsigned buffers are passed to C in place."""
+    def words(sequence):
+        """Return what C sees for `sequence`."""
+        cdata, length = uint64_buffer(sequence)
+        return list(FFI.cast("uint64_t *", cdata)[0:length])
+    native = array('Q', [1, 2**63])
+    assert words(native) == [1, 2**63]
+    assert FFI.cast("uint64_t *", uint64_buffer(native)[0]) == FFI.cast("uint64_t *", FFI.from_buffer(native))
+    swapped = (ctypes.c_uint64.__ctype_be__ if sys.byteorder == 'little' else ctypes.c_uint64.__ctype_le__) * 2
+    assert words(swapped(1, 2**63)) == [1, 2**63]
+    assert words(array('q', [1, 2])) == [1, 2]
+    with RAISES(OverflowError):
+        uint64_buffer(array('q', [-1]))
+
+
+def test_send_simple_many_write_failure():
+    """Ensure that send_simple_many reports where the batch failed."""
+    marq = Marquise(TEST_GOOD_NAMESPACE, debug=DEBUG)
+    os.chmod(marq.spool_path_points, 0o400)
+    with RAISES(BatchWriteError) as excinfo:
+        marq.send_simple_many([TEST_GOOD_ADDRESS]*3, None, [1, 2, 3])
+    assert excinfo.value.index == 0
+    assert excinfo.value.errno == 13
+    assert excinfo.value.args[0].endswith("errno is 13")
+    marq.close()
+
+
 def test_send_extended():
     """Exercise send_simple with good and bad input."""
     marq = Marquise(TEST_GOOD_NAMESPACE, debug=DEBUG)
@@ -138,6 +248,57 @@ def test_send_extended():
     marq.close()
 
 
+def test_send_extended_binary():
+    """Ensure that bytes-like values are sent verbatim by send_extended."""
+    marq = Marquise(TEST_GOOD_NAMESPACE, debug=DEBUG)
+    payload = b"\xff\x00not valid utf8\xfe"
+    assert marq.send_extended(address=TEST_GOOD_ADDRESS, timestamp=1234567890, value=b"lorem ipsum")
+    assert marq.send_extended(address=TEST_GOOD_ADDRESS, timestamp=1234567890, value=bytearray(b"dolor"))
+    assert marq.send_extended(address=TEST_GOOD_ADDRESS, timestamp=1234567890, value=memoryview(b"xxsit ametxx")[2:-2])
+    assert marq.send_extended(address=TEST_GOOD_ADDRESS, timestamp=1234567890, value=payload)
+    spool_path = marq.spool_path_points
+    marq.close()
+    with open(spool_path, 'rb') as spool:
+        assert spool.read().endswith(payload)
+
+
+def test_send_extended_many():
+    """Exercise send_extended_many with sequences and packed buffers."""
+    marq = Marquise(TEST_GOOD_NAMESPACE, debug=DEBUG)
+    # A sequence of bytestrings and text
+    assert marq.send_extended_many([TEST_GOOD_ADDRESS]*3, None, [b"lorem", u"ipsum \u2603", bytearray(b"dolor")]) == 3
+    # A packed buffer with lengths, optionally with offsets
+    assert marq.send_extended_many([TEST_GOOD_ADDRESS]*3, [1, 2, 3], b"loremipsumdolor", lengths=[5, 5, 5]) == 3
+    assert marq.send_extended_many(array('Q', [TEST_GOOD_ADDRESS]*2), None, b"loremipsumdolor", offsets=array('Q', [10, 0]), lengths=array('Q', [5, 5])) == 2
+    # Values that run off the end of the buffer
+    with RAISES(ValueError):
+        marq.send_extended_many([TEST_GOOD_ADDRESS]*2, None, b"lorem", lengths=[3, 3])
+    with RAISES(ValueError):
+        marq.send_extended_many([TEST_GOOD_ADDRESS], None, b"lorem", offsets=[6], lengths=[0])
+    # Offsets without lengths, and mismatched lengths
+    with RAISES(ValueError):
+        marq.send_extended_many([TEST_GOOD_ADDRESS], None, [b"lorem"], offsets=[0])
+    with RAISES(ValueError):
+        marq.send_extended_many([TEST_GOOD_ADDRESS]*2, None, [b"lorem"])
+    # None as a value
+    with RAISES(TypeError):
+        marq.send_extended_many([TEST_GOOD_ADDRESS], None, [None])
+    marq.close()
+    with RAISES(ValueError):
+        marq.send_extended_many([TEST_GOOD_ADDRESS], None, [b"lorem"])
+
+
+def test_send_extended_many_write_failure():
+    """Ensure that send_extended_many reports where the batch failed."""
+    marq = Marquise(TEST_GOOD_NAMESPACE, debug=DEBUG)
+    os.chmod(marq.spool_path_points, 0o400)
+    with RAISES(BatchWriteError) as excinfo:
+        marq.send_extended_many([TEST_GOOD_ADDRESS]*2, None, [b"lorem", b"ipsum"])
+    assert excinfo.value.index == 0
+    assert excinfo.value.args[0].endswith("errno is 13")
+    marq.close()
+
+
 def test_send_extended_after_close():
     """Ensure that send_extended explodes if you attempt to use a closed handle."""
     marq = Marquise(TEST_GOOD_NAMESPACE, debug=DEBUG)
@@ -183,6 +344,73 @@ def test_update_source():
     marq.close()
 
 
+def test_update_source_cache():
+    """Ensure that unchanged source dicts are skipped when caching is on."""
+    marq = Marquise(TEST_GOOD_NAMESPACE, debug=DEBUG, source_cache=2)
+    assert marq.update_source(TEST_GOOD_ADDRESS, TEST_GOOD_SOURCE_DICT)
+    assert marq.source_cache.get(TEST_GOOD_ADDRESS) == Marquise.source_digest(TEST_GOOD_SOURCE_DICT)
+    # Unchanged, in any order, is skipped
+    hits = marq.source_cache.hits
+    assert marq.update_source(TEST_GOOD_ADDRESS, dict(reversed(list(TEST_GOOD_SOURCE_DICT.items()))))
+    assert marq.source_cache.hits == hits + 1
+    # Changed dicts and forced updates are sent and remembered
+    assert marq.update_source(TEST_GOOD_ADDRESS, TEST_GOOD_SOURCE_DICT_NONE_VAL)
+    assert marq.source_cache.get(TEST_GOOD_ADDRESS) == Marquise.source_digest(TEST_GOOD_SOURCE_DICT_NONE_VAL)
+    assert marq.update_source(TEST_GOOD_ADDRESS, TEST_GOOD_SOURCE_DICT_NONE_VAL, force=True)
+    # Failed updates aren't remembered
+    with RAISES(ValueError):
+        marq.update_source(TEST_GOOD_ADDRESS + 2, TEST_BAD_SOURCE_DICT_COLON_VAL)
+    assert TEST_GOOD_ADDRESS + 2 not in marq.source_cache
+    with RAISES(TypeError):
+        marq.update_source(TEST_GOOD_ADDRESS, TEST_BAD_SOURCE_DICT_UNSTR_VAL)
+    with RAISES(TypeError):
+        marq.update_source(TEST_GOOD_ADDRESS, TEST_BAD_SOURCE_DICT_NONE_KEY)
+    # The cache is bounded
+    assert marq.update_source(TEST_GOOD_ADDRESS + 4, TEST_GOOD_SOURCE_DICT)
+    assert marq.update_source(TEST_GOOD_ADDRESS + 6, TEST_GOOD_SOURCE_DICT)
+    assert len(marq.source_cache) == 2
+    assert TEST_GOOD_ADDRESS not in marq.source_cache
+    marq.close()
+    # Caching is off by default
+    marq = Marquise(TEST_GOOD_NAMESPACE, debug=DEBUG)
+    assert marq.source_cache is None
+    marq.close()
+
+
+def test_update_sources():
+    """Exercise update_sources, ensuring failures don't stop the batch."""
+    marq = Marquise(TEST_GOOD_NAMESPACE, debug=DEBUG, source_cache=10)
+    sources = {
+        TEST_GOOD_ADDRESS:     TEST_GOOD_SOURCE_DICT,
+        TEST_GOOD_ADDRESS + 2: TEST_BAD_SOURCE_DICT_COLON_KEY,
+        TEST_GOOD_ADDRESS + 4: TEST_GOOD_SOURCE_DICT_NONE_VAL,
+        TEST_GOOD_ADDRESS + 6: TEST_BAD_SOURCE_DICT_UNSTR_VAL,
+        TEST_BAD_ADDRESS:      TEST_GOOD_SOURCE_DICT,
+    }
+    failures = marq.update_sources(sources)
+    assert sorted(failures.keys(), key=str) == sorted([TEST_GOOD_ADDRESS + 2, TEST_GOOD_ADDRESS + 6, TEST_BAD_ADDRESS], key=str)
+    assert isinstance(failures[TEST_GOOD_ADDRESS + 2], ValueError)
+    assert isinstance(failures[TEST_GOOD_ADDRESS + 6], TypeError)
+    assert isinstance(failures[TEST_BAD_ADDRESS], TypeError)
+    assert TEST_GOOD_ADDRESS in marq.source_cache
+    assert TEST_GOOD_ADDRESS + 4 in marq.source_cache
+    # Pairs work too
+    assert marq.update_sources([(TEST_GOOD_ADDRESS, TEST_GOOD_SOURCE_DICT)], force=True) == {}
+    marq.close()
+    with RAISES(ValueError):
+        marq.update_sources({TEST_GOOD_ADDRESS: TEST_GOOD_SOURCE_DICT})
+
+
+def test_update_sources_write_failure():
+    """Ensure that update_sources reports write failures for each address."""
+    marq = Marquise(TEST_GOOD_NAMESPACE, debug=DEBUG)
+    os.chmod(marq.spool_path_contents, 0o400)
+    failures = marq.update_sources({TEST_GOOD_ADDRESS: TEST_GOOD_SOURCE_DICT, TEST_GOOD_ADDRESS + 2: TEST_GOOD_SOURCE_DICT})
+    assert len(failures) == 2
+    assert all([ exc.args[0].endswith("errno is 13") for exc in failures.values() ])
+    marq.close()
+
+
 def test_update_source_after_close():
     """Ensure that update_source explodes if you attempt to use a closed handle."""
     marq = Marquise(TEST_GOOD_NAMESPACE, debug=DEBUG)
@@ -203,6 +431,1136 @@ def test_update_source_write_failure():
     marq.close()
 
 
+def test_async_marquise():
+    """Exercise AsyncMarquise writes, flushing and closing."""
+    amarq = AsyncMarquise(Marquise(TEST_GOOD_NAMESPACE, debug=DEBUG), batch_size=3)
+    for i in range(5):
+        assert amarq.send_simple(TEST_GOOD_ADDRESS, None, i)
+    assert amarq.send_extended(TEST_GOOD_ADDRESS, None, "lorem ipsum")
+    assert amarq.update_source(TEST_GOOD_ADDRESS, TEST_GOOD_SOURCE_DICT)
+    # Bad writes are counted, without losing the good writes around them
+    assert amarq.send_simple(TEST_GOOD_ADDRESS, None, "pantsu")
+    assert amarq.send_simple(TEST_GOOD_ADDRESS, None, 6)
+    assert amarq.update_source(TEST_GOOD_ADDRESS, TEST_BAD_SOURCE_DICT_COLON_KEY)
+    with RAISES(TypeError):
+        amarq.send_simple(TEST_GOOD_ADDRESS, None, None)
+    assert amarq.flush(timeout=10)
+    stats = amarq.stats()
+    assert stats == {'queued': 0, 'enqueued': 10, 'written': 8, 'dropped': 0, 'errors': 2}
+    amarq.close()
+    assert amarq.marquise.marquise_ctx is None
+    amarq.close()
+    with RAISES(ValueError):
+        amarq.send_simple(TEST_GOOD_ADDRESS, None, 42)
+    with RAISES(ValueError):
+        AsyncMarquise(None, policy="yolo")
+
+    # force reaches the wrapped handle's source cache
+    events = []
+    tracer = Tracer([lambda event, fields: events.append(event)])
+    amarq = AsyncMarquise(Marquise(TEST_GOOD_NAMESPACE, debug=DEBUG, source_cache=10, tracer=tracer))
+    for force in (False, False, True):
+        assert amarq.update_source(TEST_GOOD_ADDRESS, TEST_GOOD_SOURCE_DICT, force=force)
+    amarq.close()
+    assert [ event for event in events if event.startswith('update_source') ] == ['update_source', 'update_source_unchanged', 'update_source']
+
+
+def test_async_marquise_backpressure():
+    """Ensure that the drop policies discard the right writes when full."""
+    amarq = AsyncMarquise(Marquise(TEST_GOOD_NAMESPACE, debug=DEBUG), maxsize=2, policy='drop_oldest', start=False)
+    with RAISES(ValueError):
+        amarq.flush()
+    for i in range(3):
+        assert amarq.send_simple(TEST_GOOD_ADDRESS, 1234567890, i)
+    assert [ item[3] for item in amarq._queue ] == [1, 2]
+    amarq.close()
+    assert amarq.stats() == {'queued': 0, 'enqueued': 3, 'written': 2, 'dropped': 1, 'errors': 0}
+
+    amarq = AsyncMarquise(Marquise(TEST_GOOD_NAMESPACE, debug=DEBUG), maxsize=2, policy='drop_newest', start=False)
+    assert amarq.send_simple(TEST_GOOD_ADDRESS, 1234567890, 0)
+    assert amarq.send_simple(TEST_GOOD_ADDRESS, 1234567890, 1)
+    assert not amarq.send_simple(TEST_GOOD_ADDRESS, 1234567890, 2)
+    assert [ item[3] for item in amarq._queue ] == [0, 1]
+    amarq.start()
+    assert amarq.flush(timeout=10)
+    assert amarq.stats() == {'queued': 0, 'enqueued': 2, 'written': 2, 'dropped': 1, 'errors': 0}
+    amarq.close()
+
+
+def test_async_marquise_asyncio():
+    """Ensure that AsyncMarquise can be flushed and closed from asyncio."""
+    import asyncio
+    loop = asyncio.new_event_loop()
+    amarq = AsyncMarquise(Marquise(TEST_GOOD_NAMESPACE, debug=DEBUG))
+    assert amarq.send_simple(TEST_GOOD_ADDRESS, None, 42)
+    assert loop.run_until_complete(amarq.aflush(loop=loop))
+    loop.run_until_complete(amarq.aclose(loop=loop))
+    assert amarq.stats()['written'] == 1
+    loop.close()
+
+
+def test_marquise_pool():
+    """Exercise MarquisePool routing by thread and by address."""
+    pool = MarquisePool(TEST_GOOD_NAMESPACE, 4, debug=DEBUG)
+    assert len(pool) == 4
+    assert [ cprint(handle.marquise_ctx.marquise_namespace) for handle in pool.handles ] == [ TEST_GOOD_NAMESPACE + str(i) for i in range(4) ]
+    # Each thread sticks to a handle, and different threads get different handles
+    seen = []
+    def writer():
+        assert pool.send_simple(TEST_GOOD_ADDRESS, None, 42)
+        assert pool.send_extended(TEST_GOOD_ADDRESS, None, "lorem ipsum")
+        assert pool.update_source(TEST_GOOD_ADDRESS, TEST_GOOD_SOURCE_DICT)
+        with pool.handle() as first:
+            pass
+        with pool.handle() as second:
+            assert second.send_simple_many([TEST_GOOD_ADDRESS], None, [42]) == 1
+        assert first is second
+        seen.append(first)
+    threads = [ threading.Thread(target=writer) for _ in range(4) ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(seen) == 4
+    assert len(set([ id(handle) for handle in seen ])) == 4
+    pool.close()
+    assert all([ handle.marquise_ctx is None for handle in pool.handles ])
+    pool.close()
+
+    pool = MarquisePool(TEST_GOOD_NAMESPACE, 3, route='address', debug=DEBUG)
+    with pool.handle(TEST_GOOD_ADDRESS) as handle:
+        assert handle is pool.handles[TEST_GOOD_ADDRESS % 3]
+    assert pool.send_simple(TEST_GOOD_ADDRESS, None, 42)
+    with RAISES(ValueError):
+        with pool.handle():
+            pass
+    pool.close()
+
+    # force reaches the handle's source cache
+    events = []
+    tracer = Tracer([lambda event, fields: events.append(event)])
+    pool = MarquisePool(TEST_GOOD_NAMESPACE, 2, route='address', debug=DEBUG, source_cache=10, tracer=tracer)
+    for force in (False, False, True):
+        assert pool.update_source(TEST_GOOD_ADDRESS, TEST_GOOD_SOURCE_DICT, force=force)
+    pool.close()
+    assert [ event for event in events if event.startswith('update_source') ] == ['update_source', 'update_source_unchanged', 'update_source']
+
+    with RAISES(ValueError):
+        MarquisePool(TEST_GOOD_NAMESPACE, 0)
+    with RAISES(ValueError):
+        MarquisePool(TEST_GOOD_NAMESPACE, 2, route="yolo")
+    with RAISES(ValueError):
+        MarquisePool(TEST_BAD_NAMESPACE, 2)
+
+
+def test_fork_gets_new_context():
+    """Ensure that a forked child never writes through its parent's context."""
+    marq = Marquise(TEST_GOOD_NAMESPACE, debug=DEBUG)
+    parent_spool = marq.spool_path_points
+    pid = os.fork()
+    if pid == 0:
+        # The child's context is only opened when it first writes
+        ok = marq.spool_path_points is None and marq.bytes_written_points == 0
+        ok = ok and marq.send_simple(TEST_GOOD_ADDRESS, None, 42) and marq.spool_path_points not in (None, parent_spool)
+        marq.close()
+        os._exit(0 if ok else 1)
+    assert os.waitpid(pid, 0)[1] == 0
+
+    # A child that never writes leaves no spool files
+    spool_files = sorted(os.listdir(os.path.dirname(parent_spool)))
+    pid = os.fork()
+    if pid == 0:
+        with marq.session():
+            pass
+        marq.flush()
+        marq.close()
+        os._exit(0)
+    assert os.waitpid(pid, 0)[1] == 0
+    assert sorted(os.listdir(os.path.dirname(parent_spool))) == spool_files
+    # The parent's context is untouched by the child
+    assert marq.spool_path_points == parent_spool
+    assert marq.send_simple(TEST_GOOD_ADDRESS, None, 42)
+    marq.after_fork()
+    assert marq.spool_path_points == parent_spool
+    marq.close()
+
+
+def test_shared_ring_buffer():
+    """Exercise SharedRingBuffer with forked writers and one owner."""
+    ring = SharedRingBuffer(capacity=8)
+    pids = []
+    for i in range(3):
+        pid = os.fork()
+        if pid == 0:
+            for j in range(2):
+                ring.send_simple(TEST_GOOD_ADDRESS, 1234567890 + j, i)
+            os._exit(0)
+        pids.append(pid)
+    for pid in pids:
+        assert os.waitpid(pid, 0)[1] == 0
+    assert len(ring) == 6
+    addresses, timestamps, values = ring.take(4)
+    assert list(addresses) == [TEST_GOOD_ADDRESS]*4
+    assert len(ring) == 2
+    # Wrap around the end of the ring, then overfill it
+    for i in range(6):
+        assert ring.send_simple(TEST_GOOD_ADDRESS, None, 100 + i)
+    assert not ring.send_simple(TEST_GOOD_ADDRESS, None, 42)
+    assert ring.dropped == 1
+    with RAISES(TypeError):
+        ring.send_simple(TEST_GOOD_ADDRESS, None, None)
+    marq = Marquise(TEST_GOOD_NAMESPACE, debug=DEBUG)
+
+    # A failed drain leaves what wasn't written in the ring
+    class FailingMarquise(object):
+        """Writes the first three datapoints of a batch, then fails."""
+        def send_simple_many(self, addresses, timestamps, values):
+            marq.send_simple_many(addresses[:3], timestamps[:3], values[:3])
+            raise BatchWriteError("send_simple_many was unsuccessful at index 3, errno is 28", 3, 28)
+    with RAISES(BatchWriteError):
+        ring.drain(FailingMarquise())
+    assert len(ring) == 5
+    assert ring.drain(marq) == 5
+    assert ring.drain(marq) == 0
+    assert len(ring) == 0
+    marq.close()
+    ring.close()
+
+
+def test_siphash24():
+    """Ensure the pure-Python siphash matches the reference test vector and libmarquise."""
+    key = bytearray(range(16))
+    k0 = int(key[:8][::-1].hex(), 16)
+    k1 = int(key[8:][::-1].hex(), 16)
+    assert siphash24(bytes(bytearray(range(15))), k0, k1) == 0xa129ca6149be45e5
+    assert NativeMarquise.hash_identifier(TEST_IDENTIFIER) == 7602883380529707052
+    assert NativeMarquise.hash_identifiers([TEST_IDENTIFIER, TEST_SOURCE1])[0] == 7602883380529707052
+
+
+def test_native_marquise():
+    """Exercise the native backend's writes and closed-handle behaviour."""
+    spool_dir = tempfile.mkdtemp()
+    try:
+        marq = Marquise(TEST_GOOD_NAMESPACE, debug=DEBUG, backend='native')
+        assert isinstance(marq, NativeMarquise)
+        marq.close()
+        with RAISES(ValueError):
+            Marquise(TEST_GOOD_NAMESPACE, backend='yolo')
+        with RAISES(ValueError):
+            NativeMarquise(TEST_BAD_NAMESPACE, spool_dir=spool_dir)
+
+        marq = NativeMarquise(TEST_GOOD_NAMESPACE, debug=DEBUG, spool_dir=spool_dir)
+        assert marq.spool_path_points.startswith(os.path.join(spool_dir, "points", TEST_GOOD_NAMESPACE, "new"))
+        assert marq.send_simple(TEST_GOOD_ADDRESS, None, 42)
+        assert marq.send_simple_many(array('Q', [TEST_GOOD_ADDRESS]*3), None, [1, 2, 3]) == 3
+        assert marq.send_extended(TEST_GOOD_ADDRESS, None, u"\u2603 snowman")
+        assert marq.send_extended_many([TEST_GOOD_ADDRESS]*2, [1, 2], b"foobar", lengths=[3, 3]) == 2
+        assert marq.update_source(TEST_GOOD_ADDRESS, TEST_GOOD_SOURCE_DICT)
+        assert marq.bytes_written_points == 4*24 + 24 + len(u"\u2603 snowman".encode('utf8')) + 2*27
+        with RAISES(TypeError):
+            marq.send_simple(TEST_BAD_ADDRESS, None, 42)
+        with RAISES(TypeError):
+            marq.send_simple(TEST_GOOD_ADDRESS, None, None)
+        with RAISES(ValueError):
+            marq.send_extended_many([TEST_GOOD_ADDRESS], None, b"foo", lengths=[4])
+        with RAISES(ValueError):
+            marq.update_source(TEST_GOOD_ADDRESS, TEST_BAD_SOURCE_DICT_COLON_VAL)
+        marq.close()
+        assert marq.close() is None
+        with RAISES(ValueError):
+            marq.send_simple(TEST_GOOD_ADDRESS, None, 42)
+        with RAISES(ValueError):
+            marq.update_source(TEST_GOOD_ADDRESS, TEST_GOOD_SOURCE_DICT)
+        with RAISES(ValueError):
+            marq.flush()
+
+        # A forked child never flushes the parent's buffered writes
+        marq = NativeMarquise(TEST_GOOD_NAMESPACE, debug=DEBUG, spool_dir=spool_dir)
+        parent_spool = marq.spool_path_points
+        marq.send_simple(TEST_GOOD_ADDRESS, 1, 1)
+        pid = os.fork()
+        if pid == 0:
+            ok = marq.spool_path_points is None and marq.send_simple(TEST_GOOD_ADDRESS, 2, 2)
+            ok = ok and marq.spool_path_points not in (None, parent_spool)
+            child_spool = marq.spool_path_points
+            marq.close()
+            ok = ok and list(spool.iter_points(child_spool)) == [(TEST_GOOD_ADDRESS & ~1, 2, 2)]
+            os._exit(0 if ok else 1)
+        assert os.waitpid(pid, 0)[1] == 0
+        marq.close()
+        assert list(spool.iter_points(parent_spool)) == [(TEST_GOOD_ADDRESS & ~1, 1, 1)]
+    finally:
+        shutil.rmtree(spool_dir)
+
+
+def test_native_marquise_conformance():
+    """Ensure the native backend writes exactly the spool files libmarquise does."""
+    def spool(marquise_class, spool_dir):
+        """Write the same datapoints and source dicts through a handle."""
+        os.environ['MARQUISE_SPOOL_DIR'] = spool_dir
+        marq = marquise_class(TEST_GOOD_NAMESPACE, debug=DEBUG)
+        marq.send_simple(TEST_GOOD_ADDRESS, 1234567890, 42)
+        marq.send_simple_many([TEST_GOOD_ADDRESS, 1, 2], [1, 2, 3], [4, 5, 6])
+        marq.send_extended(TEST_GOOD_ADDRESS, 1234567890, u"\u2603 snowman")
+        marq.send_extended(TEST_GOOD_ADDRESS, 1234567891, memoryview(array('Q', [1, 2])))
+        marq.send_extended_many([TEST_GOOD_ADDRESS]*3, [1, 2, 3], [b"foo", b"", b"barbaz"])
+        marq.send_extended_many([TEST_GOOD_ADDRESS]*2, [4, 5], [memoryview(array('Q', [3])), b"quux"])
+        marq.update_source(TEST_GOOD_ADDRESS, TEST_GOOD_SOURCE_DICT)
+        marq.update_source(TEST_GOOD_ADDRESS + 2, TEST_GOOD_SOURCE_DICT_NONE_VAL)
+        paths = marq.spool_path_points, marq.spool_path_contents
+        marq.close()
+        contents = []
+        for path in paths:
+            with open(path, 'rb') as spool_file:
+                contents.append(spool_file.read())
+        return contents
+
+    old_spool_dir = os.environ.get('MARQUISE_SPOOL_DIR')
+    c_spool_dir, native_spool_dir = tempfile.mkdtemp(), tempfile.mkdtemp()
+    try:
+        c_points, c_contents = spool(Marquise, c_spool_dir)
+        native_points, native_contents = spool(NativeMarquise, native_spool_dir)
+    finally:
+        if old_spool_dir is None:
+            del os.environ['MARQUISE_SPOOL_DIR']
+        else:
+            os.environ['MARQUISE_SPOOL_DIR'] = old_spool_dir
+        shutil.rmtree(c_spool_dir)
+        shutil.rmtree(native_spool_dir)
+    assert native_points == c_points
+    assert native_contents == c_contents
+
+
+def test_spool_reader():
+    """Ensure spool files read back as they were written, and can be replayed."""
+    spool_dir = tempfile.mkdtemp()
+    saved_spool_dir = os.environ.get("MARQUISE_SPOOL_DIR")
+    try:
+        marq = Marquise(TEST_GOOD_NAMESPACE, debug=DEBUG, backend='native', spool_dir=spool_dir)
+        marq.send_simple_many([2, 4, 6], [1, 2, 3], [10, 20, 30])
+        marq.send_extended(TEST_GOOD_ADDRESS, 4, b"foobar")
+        marq.send_simple(8, 5, 40)
+        marq.update_source(TEST_GOOD_ADDRESS, TEST_GOOD_SOURCE_DICT)
+        marq.close()
+
+        points_paths = spool.spool_paths('points', spool_dir=spool_dir)
+        contents_paths = spool.spool_paths('contents', TEST_GOOD_NAMESPACE, spool_dir)
+        assert points_paths == [marq.spool_path_points]
+        assert list(spool.iter_points(points_paths[0])) == [(2, 1, 10), (4, 2, 20), (6, 3, 30), (TEST_GOOD_ADDRESS, 4, b"foobar"), (8, 5, 40)]
+        assert list(spool.iter_sources(contents_paths[0])) == [(TEST_GOOD_ADDRESS, TEST_GOOD_SOURCE_DICT)]
+        assert spool.count_points(points_paths[0]) == (4, 1)
+        with RAISES(ValueError):
+            spool.spool_paths('yolo')
+
+        if numpy is not None:
+            points = spool.points_array(points_paths[0])
+            assert list(points['value']) == [10, 20, 30, 40]
+
+        replayed = NativeMarquise("replayed", debug=DEBUG, spool_dir=spool_dir)
+        assert spool.replay(replayed, points_paths, contents_paths, batch_size=2) == (5, 1)
+        replayed.close()
+        assert list(spool.iter_points(replayed.spool_path_points)) == list(spool.iter_points(points_paths[0]))
+        assert spool.main(["--spool-dir", spool_dir, "--namespace", "replayed", "count"]) == 0
+
+        # The cffi backend replays into --spool-dir too
+        assert spool.main(["--spool-dir", spool_dir, "--namespace", "replayed", "replay", "cffireplayed"]) == 0
+        replayed_paths = spool.spool_paths('points', "cffireplayed", spool_dir)
+        assert [ list(spool.iter_points(path)) for path in replayed_paths ] == [list(spool.iter_points(points_paths[0]))]
+        assert os.environ.get("MARQUISE_SPOOL_DIR") == saved_spool_dir
+    finally:
+        shutil.rmtree(spool_dir)
+
+
+def test_tracer():
+    """Ensure write events reach tracing hooks, sampled, on traced handles only."""
+    events = []
+    def hook(event, fields):
+        """Collect an event."""
+        events.append((event, fields))
+
+    marq = Marquise(TEST_GOOD_NAMESPACE, debug=DEBUG, tracer=Tracer([hook]))
+    assert marq.send_simple(TEST_GOOD_ADDRESS, 1234567890, 42)
+    assert marq.send_extended(TEST_GOOD_ADDRESS, 1234567890, b"foobar")
+    assert marq.update_source(TEST_GOOD_ADDRESS, TEST_GOOD_SOURCE_DICT)
+    assert events == [
+        ('send_simple', {'address': TEST_GOOD_ADDRESS, 'timestamp': 1234567890, 'value': 42}),
+        ('send_extended', {'address': TEST_GOOD_ADDRESS, 'timestamp': 1234567890, 'length': 6}),
+        ('update_source', {'address': TEST_GOOD_ADDRESS, 'n_fields': len(TEST_GOOD_SOURCE_DICT)}),
+    ]
+
+    # Sampling applies to successful writes only, failures always get out
+    del events[:]
+    marq.tracer = Tracer([hook], sample_every=3)
+    assert marq.send_simple_many([TEST_GOOD_ADDRESS]*2, None, [1, 2]) == 2
+    for i in range(6):
+        assert marq.send_simple(TEST_GOOD_ADDRESS, None, i)
+    assert [ event for event, _ in events ] == ['send_simple_many', 'send_simple', 'send_simple']
+    os.chmod(marq.spool_path_points, 0o400)
+    with RAISES(RuntimeError):
+        marq.send_simple(TEST_GOOD_ADDRESS, None, 42)
+    assert events[-1][0] == 'send_simple_failed' and events[-1][1]['errno'] == 13
+
+    # No tracer, no events
+    del events[:]
+    marq.tracer = None
+    marq.close()
+    assert not events
+    with RAISES(ValueError):
+        Tracer(sample_every=0)
+
+
+def test_aggregator():
+    """Ensure the Aggregator writes one datapoint per series per flush."""
+    spool_dir = tempfile.mkdtemp()
+    try:
+        marq = NativeMarquise(TEST_GOOD_NAMESPACE, debug=DEBUG, spool_dir=spool_dir)
+        aggregator = Aggregator(marq, start=False)
+        for _ in range(1000):
+            aggregator.incr(TEST_IDENTIFIER)
+        aggregator.incr(TEST_GOOD_ADDRESS, 5)
+        aggregator.gauge(TEST_SOURCE1, 3)
+        aggregator.gauge(TEST_SOURCE1, 7)
+        for i in range(1, 101):
+            aggregator.timing(TEST_SOURCE1, i)
+        with RAISES(TypeError):
+            aggregator.timing(TEST_GOOD_ADDRESS, 1)
+        with RAISES(TypeError):
+            aggregator.gauge(TEST_SOURCE1, 1.5)
+        with RAISES(ValueError):
+            aggregator.incr(TEST_IDENTIFIER, -1)
+        assert aggregator.stats()['pending'] == 4
+        assert aggregator.flush() == 3 + 7
+        assert aggregator.flush() == 0
+        aggregator.incr(TEST_IDENTIFIER)
+        aggregator.close()
+        assert aggregator.stats() == {'pending': 0, 'flushes': 2, 'written': 11, 'errors': 0}
+
+        points = dict([ (address, value) for address, _, value in spool.iter_points(marq.spool_path_points) ][:10])
+        timer_addresses = NativeMarquise.hash_identifiers(Aggregator.timer_identifiers(TEST_SOURCE1))
+        assert points[7602883380529707052 & ~1] == 1000
+        assert points[TEST_GOOD_ADDRESS & ~1] == 5
+        assert points[NativeMarquise.hash_identifier(TEST_SOURCE1) & ~1] == 7
+        assert [ points[address & ~1] for address in timer_addresses ] == [100, 5050, 1, 100, 50, 90, 99]
+
+        # A failed flush keeps what it didn't write for the next flush
+        class FailingMarquise(NativeMarquise):
+            failing = True
+            def send_simple_many(self, addresses, timestamps, values):
+                if not self.failing:
+                    return NativeMarquise.send_simple_many(self, addresses, timestamps, values)
+                self.send_simple(addresses[0], timestamps[0], values[0])
+                raise BatchWriteError("Failed to write simple datapoint, errno is 28", 1, 28)
+        marq = FailingMarquise(TEST_GOOD_NAMESPACE, debug=DEBUG, spool_dir=spool_dir)
+        aggregator = Aggregator(marq, start=False)
+        aggregator.incr(TEST_GOOD_ADDRESS, 5)
+        aggregator.gauge(TEST_SOURCE1, 3)
+        aggregator.timing(TEST_SOURCE1, 10)
+        with RAISES(BatchWriteError):
+            aggregator.flush()
+        assert aggregator.stats()['pending'] == 2
+        aggregator.incr(TEST_GOOD_ADDRESS, 1)
+        aggregator.timing(TEST_SOURCE1, 20)
+        marq.failing = False
+        assert aggregator.flush() == 1 + 1 + 7
+        aggregator.close()
+        points = list(spool.iter_points(marq.spool_path_points))
+        assert points[0][0::2] == (TEST_GOOD_ADDRESS & ~1, 5)
+        points = dict([ (address, value) for address, _, value in points[1:] ])
+        assert points[TEST_GOOD_ADDRESS & ~1] == 1
+        assert points[NativeMarquise.hash_identifier(TEST_SOURCE1) & ~1] == 3
+        assert [ points[address & ~1] for address in timer_addresses ] == [2, 30, 10, 20, 10, 20, 20]
+
+        # The handle is closed even if the last flush fails
+        marq = FailingMarquise(TEST_GOOD_NAMESPACE, debug=DEBUG, spool_dir=spool_dir)
+        aggregator = Aggregator(marq, start=False)
+        aggregator.incr(TEST_GOOD_ADDRESS)
+        with RAISES(BatchWriteError):
+            aggregator.close()
+        assert marq.closed
+
+        # Timers keep a bounded sample, and exact count, sum, min and max
+        series = TimerSeries()
+        for i in range(1, 3 * MAX_TIMER_SAMPLES + 1):
+            series.add(i)
+        assert len(series.samples) == MAX_TIMER_SAMPLES
+        count, total, low, high, p50, _, _ = series.summary()
+        assert (count, total, low, high) == (3 * MAX_TIMER_SAMPLES, 3 * MAX_TIMER_SAMPLES * (3 * MAX_TIMER_SAMPLES + 1) // 2, 1, 3 * MAX_TIMER_SAMPLES)
+        assert 1.2 * MAX_TIMER_SAMPLES < p50 < 1.8 * MAX_TIMER_SAMPLES
+        other = TimerSeries()
+        other.add(0)
+        series.merge(other)
+        assert len(series.samples) == MAX_TIMER_SAMPLES and series.summary()[:3] == (count + 1, total, 0)
+
+        # The background flusher
+        marq = NativeMarquise(TEST_GOOD_NAMESPACE, debug=DEBUG, spool_dir=spool_dir)
+        aggregator = Aggregator(marq, interval=0.01)
+        aggregator.incr(TEST_IDENTIFIER)
+        deadline = time.time() + 5
+        while aggregator.stats()['flushes'] == 0 and time.time() < deadline:
+            time.sleep(0.01)
+        aggregator.close()
+        assert aggregator.stats()['written'] == 1
+    finally:
+        shutil.rmtree(spool_dir)
+
+
+def test_last_value_table():
+    """Exercise the open-addressing last-value table, through growth."""
+    table = LastValueTable(capacity=4)
+    for address in range(0, 1000, 3):
+        table.set(address, address + 1, address + 2)
+    table.set(2**64 - 1, 42, 43)
+    assert len(table) == 335
+    assert table.get(0) == (1, 2)
+    assert table.get(999) == (1000, 1001)
+    assert table.get(2**64 - 1) == (42, 43)
+    assert table.get(1) is None
+    table.set(999, 5, 6)
+    assert table.get(999) == (5, 6)
+    assert len(table) == 335
+    table.clear()
+    assert len(table) == 0 and table.get(999) is None
+
+
+def test_dedupe_filter():
+    """Ensure repeated values are dropped, except for heartbeats."""
+    spool_dir = tempfile.mkdtemp()
+    try:
+        marq = NativeMarquise(TEST_GOOD_NAMESPACE, debug=DEBUG, spool_dir=spool_dir)
+        dedupe = DedupeFilter(marq, heartbeat=10)
+        second = 1000000000
+        for i in range(30):
+            assert dedupe.send_simple(TEST_GOOD_ADDRESS, i * second, 42)
+            assert dedupe.send_extended(TEST_GOOD_ADDRESS, i * second, u"ok")
+        # Changes are always written
+        assert dedupe.send_simple(TEST_GOOD_ADDRESS, 30 * second, 43)
+        assert dedupe.send_extended(TEST_GOOD_ADDRESS, 30 * second, b"degraded")
+        assert dedupe.send_simple_many([TEST_GOOD_ADDRESS, TEST_GOOD_ADDRESS, 2], [31 * second, 32 * second, 33 * second], [43, 44, 44]) == 3
+        assert dedupe.send_extended_many([TEST_GOOD_ADDRESS]*2, [31 * second, 32 * second], [b"degraded", b"ok"]) == 2
+        with RAISES(TypeError):
+            dedupe.send_simple(TEST_GOOD_ADDRESS, None, None)
+        with RAISES(ValueError):
+            dedupe.send_simple_many([TEST_GOOD_ADDRESS], [1, 2], [1])
+        assert dedupe.stats() == {'written': 11, 'suppressed': 56, 'tracked': 3}
+        dedupe.close()
+
+        points = [ (timestamp // second, value) for _, timestamp, value in spool.iter_points(marq.spool_path_points) ]
+        assert [ point for point in points if not isinstance(point[1], bytes) ] == [(0, 42), (10, 42), (20, 42), (30, 43), (32, 44), (33, 44)]
+        assert [ point for point in points if isinstance(point[1], bytes) ] == [(0, b"ok"), (10, b"ok"), (20, b"ok"), (30, b"degraded"), (32, b"ok")]
+    finally:
+        shutil.rmtree(spool_dir)
+
+
+def test_write_stats():
+    """Exercise the write-path counters, histograms and stats reporter."""
+    marq = Marquise(TEST_GOOD_NAMESPACE, debug=DEBUG)
+    assert 'methods' not in marq.stats()
+    assert marq.send_simple(TEST_GOOD_ADDRESS, None, 42)
+    assert marq.bytes_written_points == marq.stats()['bytes_written_points'] > 0
+    marq.close()
+    assert marq.bytes_written_points is None
+
+    marq = Marquise(TEST_GOOD_NAMESPACE, debug=DEBUG, stats=True)
+    assert marq.send_simple(TEST_GOOD_ADDRESS, None, 42)
+    assert marq.send_simple_many([TEST_GOOD_ADDRESS]*3, None, [1, 2, 3]) == 3
+    assert marq.update_sources({TEST_GOOD_ADDRESS: TEST_GOOD_SOURCE_DICT}) == {}
+    with RAISES(TypeError):
+        marq.send_simple(TEST_GOOD_ADDRESS, None, None)
+    os.chmod(marq.spool_path_points, 0o400)
+    with RAISES(RuntimeError):
+        marq.send_extended(TEST_GOOD_ADDRESS, None, "foo")
+
+    methods = marq.stats()['methods']
+    assert methods['send_simple']['calls'] == 2
+    assert methods['send_simple']['datapoints'] == 1
+    assert methods['send_simple']['rejected'] == 1
+    assert methods['send_simple']['latency']['count'] == 2
+    assert methods['send_simple']['c_latency']['count'] == 1
+    assert methods['send_simple']['latency']['p99_ns'] >= methods['send_simple']['latency']['p50_ns'] > 0
+    assert methods['send_simple_many']['datapoints'] == 3
+    assert methods['update_sources']['c_latency']['count'] == 1
+    assert methods['update_source']['calls'] == 0
+    assert methods['send_extended']['failures'] == {13: 1}
+
+    reports = []
+    reported = threading.Event()
+    def callback(snapshot):
+        """Collect a stats snapshot."""
+        reports.append(snapshot)
+        reported.set()
+    reporter = StatsReporter(marq, callback, interval=0.01)
+    assert reported.wait(5)
+    reporter.stop()
+    assert reports[0]['methods']['send_simple_many']['calls'] == 1
+    marq.close()
+
+
+def test_ingestd_parsers():
+    """Exercise the statsd, graphite and collectd line parsers."""
+    assert ingestd.parse_graphite("web.requests 42 1400000000") == ("web.requests", 42, 1400000000000000000)
+    assert ingestd.parse_graphite("web.load 0.5 1400000000.5") == ("web.load", b"0.5", 1400000000500000000)
+    assert ingestd.parse_graphite("web.delta -3 1400000000")[1] == b"-3"
+    assert ingestd.parse_graphite("web.bytes 1e3 1400000000")[1] == 1000
+    assert ingestd.parse_statsd("api:latency:12|ms|@0.5") == ("api:latency", 12.0, "ms", 0.5)
+    assert ingestd.parse_collectd('PUTVAL "fe1/interface-eth0/if_octets" interval=10 1400000000:7:9') == ("fe1/interface-eth0/if_octets", 1400000000000000000, [7, 9])
+    assert ingestd.parse_collectd("PUTVAL fe1/load/load N:1")[1] is None
+    for parse, line in ((ingestd.parse_graphite, "web.requests 42"), (ingestd.parse_graphite, "web.requests nan 1"),
+                        (ingestd.parse_statsd, "web.requests|c"), (ingestd.parse_statsd, "a:1|c|@2"),
+                        (ingestd.parse_collectd, "PUTNOTIF message=hi")):
+        with RAISES(ValueError):
+            parse(line)
+    assert ingestd.identifier_for({'metric': 'web.requests', 'index': '0'}) == "index:0,metric:web.requests,"
+    assert ingestd.parse_listen("graphite=tcp://:2003") == ("graphite", "tcp", ("0.0.0.0", 2003))
+    assert ingestd.parse_listen("collectd=unix:///run/collectd.sock") == ("collectd", "unix", "/run/collectd.sock")
+    with RAISES(ValueError):
+        ingestd.parse_listen("carbon=tcp://:2003")
+
+
+def test_ingestd():
+    """Send metrics to an IngestServer over UDP and TCP, and check what
+    reaches the spool.
+    """
+    import asyncio
+    import socket
+    spool_dir = tempfile.mkdtemp()
+    loop = asyncio.new_event_loop()
+    try:
+        marq = NativeMarquise(TEST_GOOD_NAMESPACE, debug=DEBUG, spool_dir=spool_dir)
+        server = ingestd.IngestServer(marq, loop, flush_interval=60)
+        udp_address = server.listen("graphite=udp://127.0.0.1:0")
+        tcp_address = server.listen("statsd=tcp://127.0.0.1:0")
+        unix_address = server.listen("collectd=unix://" + os.path.join(spool_dir, "collectd.sock"))
+
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sender.sendto(b"web.requests 42 1400000000\nweb.load 0.5 1400000000\n", udp_address)
+        sender.sendto(b"web.requests 43 1400000010\nbogus\n", udp_address)
+        sender.close()
+        stream = socket.create_connection(tcp_address)
+        stream.sendall(b"hits:1|c\nhits:2|c|@0.5\nqueue:7|g\nqueue:+3|g\nqueue:-4|g\nlat")
+        stream.sendall(b"ency:5|ms\nlatency:9|ms")
+        stream.close()
+        stream = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stream.connect(unix_address)
+        stream.sendall(b'PUTVAL "fe1/interface-eth0/if_octets" interval=10 1400000000:7:9\n')
+        stream.close()
+        loop.run_until_complete(asyncio.sleep(0.2))
+        server.close()
+
+        assert server.stats() == {'lines': {'statsd': 7, 'graphite': 4, 'collectd': 1}, 'bad_lines': 1, 'points': 3 + 2 + 7 + 2, 'sources': 2 + 2 + 7 + 2, 'errors': 0}
+        points = list(spool.iter_points(marq.spool_path_points))
+        requests = marq.hash_identifier("metric:web.requests,") & ~1
+        assert [ (timestamp, value) for address, timestamp, value in points if address == requests ] == [(1400000000000000000, 42), (1400000010000000000, 43)]
+        assert [ value for address, _, value in points if address == marq.hash_identifier("metric:web.load,") | 1 ] == [b"0.5"]
+        assert [ value for address, _, value in points if address == marq.hash_identifier("metric:hits,") & ~1 ] == [5]
+        assert [ value for address, _, value in points if address == marq.hash_identifier("metric:queue,") & ~1 ] == [6]
+        assert [ value for address, _, value in points if address == marq.hash_identifier("metric:latency,statistic:max,") & ~1 ] == [9]
+        assert [ value for address, _, value in points if address == marq.hash_identifier("index:1,metric:fe1/interface-eth0/if_octets,") & ~1 ] == [9]
+        sources = dict(spool.iter_sources(marq.spool_path_contents))
+        assert sources[marq.hash_identifier("metric:latency,statistic:p99,")] == {'metric': 'latency', 'statistic': 'p99'}
+
+        # A failed source dict write is counted, and the rest of the batch is kept
+        class FailingSources(NativeMarquise):
+            """Fails to send the source dict of "broken"."""
+            def update_source(self, address, metadata_dict, force=False):
+                if metadata_dict['metric'] == "broken":
+                    raise RuntimeError("marquise_update_source was unsuccessful, errno is 28")
+                return NativeMarquise.update_source(self, address, metadata_dict, force)
+        marq = FailingSources(TEST_GOOD_NAMESPACE, debug=DEBUG, spool_dir=spool_dir)
+        server = ingestd.IngestServer(marq, loop, flush_interval=60)
+        server.feed('graphite', b"broken 1 1400000000\nworking 2 1400000000\n")
+        server.flush_points()
+        server.close()
+        stats = server.stats()
+        assert stats['errors'] == 1 and stats['points'] == 1 and stats['bad_lines'] == 0
+        assert isinstance(server.last_error, RuntimeError)
+    finally:
+        loop.close()
+        shutil.rmtree(spool_dir)
+
+
+def test_ingestd_limits():
+    """Gauge values outlive the series caches, overlong stream lines drop
+    the connection, and the daemon refuses to start without asyncio.
+    """
+    import asyncio
+    spool_dir = tempfile.mkdtemp()
+    loop = asyncio.new_event_loop()
+    try:
+        marq = NativeMarquise(TEST_GOOD_NAMESPACE, debug=DEBUG, spool_dir=spool_dir)
+        server = ingestd.IngestServer(marq, loop, flush_interval=60, max_series=2)
+        server.feed('statsd', b"queue:7|g\nother:1|g\nthird:1|g\nqueue:+3|g\n")
+        assert server._gauges[server.address("queue")] == 10 # pylint: disable=protected-access
+
+        class Transport(object):
+            """Records whether it was closed."""
+            closed = False
+            def close(self):
+                self.closed = True
+        transport = Transport()
+        stream = ingestd.StreamProtocol(server, 'graphite')
+        stream.connection_made(transport)
+        stream.data_received(b"web.requests 1 1400000000\nweb.")
+        assert not transport.closed and stream.partial == b"web."
+        stream.data_received(b"x" * ingestd.MAX_LINE_LENGTH)
+        assert transport.closed and stream.partial == b""
+        stats = server.stats()
+        assert stats['lines']['graphite'] == 1 and stats['bad_lines'] == 1
+        server.close()
+
+        saved, ingestd.asyncio = ingestd.asyncio, None
+        try:
+            with pytest.raises(RuntimeError):
+                ingestd.main([TEST_GOOD_NAMESPACE])
+        finally:
+            ingestd.asyncio = saved
+    finally:
+        loop.close()
+        shutil.rmtree(spool_dir)
+
+
+def test_bulk_loader():
+    """Load CSV and JSON Lines files through two writers, then resume
+    from the checkpoint after more rows are appended.
+    """
+    spool_dir = tempfile.mkdtemp()
+    try:
+        csv_path = os.path.join(spool_dir, "backfill.csv")
+        jsonl_path = os.path.join(spool_dir, "backfill.jsonl")
+        checkpoint = os.path.join(spool_dir, "checkpoint.json")
+        with open(csv_path, 'w') as csv_file:
+            csv_file.write("identifier,address,timestamp,value\n")
+            for i in range(100):
+                csv_file.write('"metric:load,host:web%d,",,%d,%d\n' % (i % 5, 1400000000 + i, i))
+                if i == 14:
+                    # A quoted newline, across the first chunk boundary
+                    csv_file.write(',%d,1400000001,"two\nlines, ""quoted"""\n' % TEST_GOOD_ADDRESS)
+            csv_file.write('"metric:load,",,bogus,1\n')
+            csv_file.write(",%d,1400000000.5,degraded\n" % TEST_GOOD_ADDRESS)
+        with open(jsonl_path, 'w') as jsonl_file:
+            jsonl_file.write('{"identifier": "metric:temp,", "timestamp": 1400000000, "value": 21.5, "source": {"metric": "temp", "unit": "C"}}\n')
+            jsonl_file.write('{"address": 42, "timestamp": 1400000000, "value": 7}\n')
+
+        loader = Loader(TEST_GOOD_NAMESPACE, workers=2, backend='native', timestamp_unit='s', chunk_rows=16, checkpoint=checkpoint, spool_dir=spool_dir)
+        stats = loader.load([csv_path, jsonl_path])
+        assert stats['rows'] == 105 and stats['bad_rows'] == 1 and stats['points'] == 104 and stats['sources'] == 6
+        assert len(loader.first_errors) == 1
+
+        points = []
+        sources = {}
+        for i in range(2):
+            for path in spool.spool_paths('points', TEST_GOOD_NAMESPACE + str(i), spool_dir):
+                points.extend(spool.iter_points(path))
+            for path in spool.spool_paths('contents', TEST_GOOD_NAMESPACE + str(i), spool_dir):
+                sources.update(spool.iter_sources(path))
+        assert len(points) == 104
+        web3 = NativeMarquise.hash_identifier("metric:load,host:web3,")
+        assert [ (timestamp, value) for address, timestamp, value in points if address == web3 & ~1 ] == [ (1400000000000000000 + i * 1000000000, i) for i in range(3, 100, 5) ]
+        assert (TEST_GOOD_ADDRESS | 1, 1400000000500000000, b"degraded") in points
+        assert (TEST_GOOD_ADDRESS | 1, 1400000001000000000, b'two\nlines, "quoted"') in points
+        assert (NativeMarquise.hash_identifier("metric:temp,") | 1, 1400000000000000000, b"21.5") in points
+        assert sources[web3] == {'metric': 'load', 'host': 'web3'}
+        assert sources[NativeMarquise.hash_identifier("metric:temp,")] == {'metric': 'temp', 'unit': 'C'}
+
+        # Only the appended rows are loaded on a rerun
+        with open(csv_path, 'a') as csv_file:
+            csv_file.write('"metric:load,host:web0,",,1400000100,100\n')
+        stats = Loader(TEST_GOOD_NAMESPACE, workers=2, backend='native', checkpoint=checkpoint, spool_dir=spool_dir).load([csv_path, jsonl_path])
+        assert stats['rows'] == 1 and stats['points'] == 1
+        with RAISES(ValueError):
+            Loader(TEST_GOOD_NAMESPACE, backend='native').load([os.path.join(spool_dir, "backfill.txt")])
+
+        # Out of range rows are skipped as bad, plain identifiers are hashed
+        edge_path = os.path.join(spool_dir, "edge.csv")
+        with open(edge_path, 'w') as csv_file:
+            csv_file.write("identifier,address,timestamp,value\n,2,-5,1\n,-2,5,1\n,%d,5,1\n,2,%d,1\ncpu.load,,5,1\n" % (2**64, 2**64))
+        loader = Loader(TEST_GOOD_NAMESPACE, workers=2, backend='native', spool_dir=spool_dir)
+        stats = loader.load([edge_path])
+        assert stats['rows'] == 5 and stats['bad_rows'] == 4 and stats['points'] == 1 and stats['sources'] == 0
+        assert all([ "out of range" in error for error in loader.first_errors ])
+        points = []
+        for i in range(2):
+            for path in spool.spool_paths('points', TEST_GOOD_NAMESPACE + str(i), spool_dir):
+                points.extend(spool.iter_points(path))
+        assert (NativeMarquise.hash_identifier("cpu.load") & ~1, 5, 1) in points
+
+        # Writers that can't open their handle fail the load, not hang it
+        with RAISES(RuntimeError):
+            Loader(TEST_BAD_NAMESPACE, workers=2, backend='native', chunk_rows=5, spool_dir=spool_dir).load([csv_path])
+    finally:
+        shutil.rmtree(spool_dir)
+
+
+def test_source_index():
+    """Exercise SourceIndex as an identifier index and a source cache
+    that persists across handles and processes.
+    """
+    spool_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(spool_dir, "sources.idx")
+        identifier_address = Marquise.hash_identifier(TEST_IDENTIFIER)
+        index = SourceIndex(path, capacity=10)
+        assert index.hash_identifier(TEST_IDENTIFIER) == identifier_address
+        assert index.address(TEST_IDENTIFIER) == identifier_address
+        assert index.address("metric:unseen,") is None
+        assert index.hash_identifiers([TEST_IDENTIFIER, u"metric:other,"]) == [identifier_address, Marquise.hash_identifier("metric:other,")]
+        assert index.identifier_count == 2
+        hashed = []
+        def hasher(identifier):
+            """Hash in Python, remembering what was hashed."""
+            hashed.append(identifier)
+            return NativeMarquise.hash_identifier(identifier)
+        native_index = SourceIndex(path + ".native", capacity=10, hasher=hasher)
+        assert native_index.hash_identifiers([TEST_IDENTIFIER, TEST_IDENTIFIER]) == [NativeMarquise.hash_identifier(TEST_IDENTIFIER)] * 2
+        assert native_index.hash_identifiers([TEST_IDENTIFIER]) == [NativeMarquise.hash_identifier(TEST_IDENTIFIER)]
+        assert hashed == [TEST_IDENTIFIER] * 2 and native_index.identifier_count == 1
+        native_index.close()
+
+        marq = NativeMarquise(TEST_GOOD_NAMESPACE, debug=DEBUG, spool_dir=spool_dir, source_cache=index)
+        assert marq.update_source(TEST_GOOD_ADDRESS, TEST_GOOD_SOURCE_DICT)
+        assert marq.update_source(0, TEST_GOOD_SOURCE_DICT)
+        assert index.get(TEST_GOOD_ADDRESS) == NativeMarquise.source_digest(TEST_GOOD_SOURCE_DICT)
+        assert 0 in index and len(index) == 2
+        marq.close()
+        index.close()
+        index.close()
+
+        # A new handle, even in another process, skips what was sent
+        def child():
+            child_index = SourceIndex(path)
+            child_marq = NativeMarquise(TEST_GOOD_NAMESPACE, debug=DEBUG, spool_dir=spool_dir, source_cache=child_index)
+            child_marq.update_source(TEST_GOOD_ADDRESS, TEST_GOOD_SOURCE_DICT)
+            child_marq.update_source(0, TEST_GOOD_SOURCE_DICT)
+            child_marq.update_source(TEST_GOOD_ADDRESS + 2, TEST_GOOD_SOURCE_DICT)
+            child_marq.close()
+            os._exit(0 if [ address for address, _ in spool.iter_sources(child_marq.spool_path_contents) ] == [TEST_GOOD_ADDRESS + 2] else 1)
+        pid = os.fork()
+        if pid == 0:
+            child()
+        assert os.waitpid(pid, 0)[1] == 0
+
+        readonly = SourceIndex(path, readonly=True)
+        assert len(readonly) == 3 and readonly.address(TEST_IDENTIFIER) == identifier_address
+        assert readonly.hash_identifier("metric:unseen,") == Marquise.hash_identifier("metric:unseen,")
+        assert readonly.identifier_count == 2
+        with RAISES(ValueError):
+            readonly[TEST_GOOD_ADDRESS] = 1
+        readonly.close()
+
+        # Once three-quarters full, new entries are dropped
+        index = SourceIndex(path)
+        for i in range(20):
+            index[i + 1] = i
+        assert index.stats() == {'identifiers': 2, 'addresses': 13, 'capacity': 12, 'overflows': 10}
+        assert index.get(20) is None
+        index.close()
+
+        with open(path + ".bad", 'wb') as bad_file:
+            bad_file.write(b"x" * 64)
+        with RAISES(ValueError):
+            SourceIndex(path + ".bad")
+    finally:
+        shutil.rmtree(spool_dir)
+
+
+def test_rotate():
+    """Ensure rotate() starts new spool files for the same namespace."""
+    marq = Marquise(TEST_GOOD_NAMESPACE, debug=DEBUG)
+    assert marq.send_simple(TEST_GOOD_ADDRESS, None, 42)
+    first_path = marq.spool_path_points
+    marq.rotate()
+    assert marq.spool_path_points != first_path and marq.bytes_written_points == 0
+    assert cprint(marq.marquise_ctx.marquise_namespace) == TEST_GOOD_NAMESPACE
+    assert marq.send_simple(TEST_GOOD_ADDRESS, None, 42)
+    marq.close()
+    with RAISES(ValueError):
+        marq.rotate()
+
+
+def test_spool_policy():
+    """Ensure SpoolPolicy rotates the spool files at its thresholds and
+    sheds unprotected datapoints as the backlog grows.
+    """
+    spool_dir = tempfile.mkdtemp()
+    try:
+        marq = NativeMarquise(TEST_GOOD_NAMESPACE, debug=DEBUG, spool_dir=spool_dir)
+        policy = SpoolPolicy(marq, spool_dir=spool_dir, rotate_bytes=24 * 10, backlog_high_water=1000, backlog_limit=2500, min_free_bytes=0, protected=set([TEST_GOOD_ADDRESS]), start=False)
+        first_path = marq.spool_path_points
+        for i in range(10):
+            assert policy.send_simple(TEST_GOOD_ADDRESS + 2, i, i)
+        assert policy.stats()['rotations'] == 1 and marq.spool_path_points != first_path
+        assert marq.bytes_written_points == 0
+        marq.flush()
+
+        # Another namespace's backlog pushes us past the high water mark
+        backlog = os.path.join(spool_dir, "points", "othernamespace", "new")
+        os.makedirs(backlog)
+        with open(os.path.join(backlog, "backlog"), 'wb') as backlog_file:
+            backlog_file.write(b"x" * 2000)
+        policy.check()
+        assert policy.backlog_bytes == 2240 and 0.8 < policy.backpressure < 0.85
+        results = [ policy.send_simple(TEST_GOOD_ADDRESS + 2, i, i) for i in range(100) ]
+        assert 16 <= results.count(True) <= 18
+        assert policy.send_simple_many([TEST_GOOD_ADDRESS] * 10, None, range(10)) == 10
+        assert 1 <= policy.send_extended_many([TEST_GOOD_ADDRESS + 2] * 10, None, [b"x"] * 10) <= 2
+
+        # Nothing unprotected is written when the disk is nearly full
+        policy.min_free_bytes = 2**62
+        policy.check()
+        assert policy.backpressure == 1.0
+        assert not policy.send_extended(TEST_GOOD_ADDRESS + 2, None, "shed")
+        assert policy.send_extended(TEST_GOOD_ADDRESS, None, "kept")
+        assert policy.send_simple_many([TEST_GOOD_ADDRESS + 2], None, [1]) == 0
+        assert policy.update_source(TEST_GOOD_ADDRESS + 2, TEST_GOOD_SOURCE_DICT)
+        stats = policy.stats()
+        assert stats['written'] + stats['shed'] == 10 + 100 + 10 + 10 + 3 and stats['write_failures'] == 0
+        policy.close()
+        policy.close()
+
+        # A failed write sheds everything unprotected until the next check
+        class FailingMarquise(object):
+            """Fails every write, like a handle on a full disk."""
+            def send_simple(self, address, timestamp, value):
+                raise RuntimeError("marquise_send_simple was unsuccessful, errno is 28")
+        policy = SpoolPolicy(FailingMarquise(), spool_dir=spool_dir, min_free_bytes=0, start=False)
+        with RAISES(RuntimeError):
+            policy.send_simple(TEST_GOOD_ADDRESS + 2, None, 1)
+        assert not policy.send_simple(TEST_GOOD_ADDRESS + 2, None, 1)
+        assert policy.stats()['write_failures'] == 1
+        policy.check()
+        assert policy.backpressure == 0.0
+
+        # ... or for check_interval, or until a write succeeds
+        policy = SpoolPolicy(FailingMarquise(), spool_dir=spool_dir, min_free_bytes=0, check_interval=0.05, start=False)
+        with RAISES(RuntimeError):
+            policy.send_simple(TEST_GOOD_ADDRESS + 2, None, 1)
+        assert policy.backpressure == 1.0
+        time.sleep(0.06)
+        assert policy.backpressure == 0.0
+        marq = NativeMarquise(TEST_GOOD_NAMESPACE, debug=DEBUG, spool_dir=spool_dir)
+        policy = SpoolPolicy(marq, spool_dir=spool_dir, min_free_bytes=0, protected=set([TEST_GOOD_ADDRESS]), start=False)
+        policy._failed(RuntimeError("marquise_send_simple was unsuccessful, errno is 28"))
+        assert not policy.send_simple(TEST_GOOD_ADDRESS + 2, None, 1)
+        assert policy.send_simple(TEST_GOOD_ADDRESS, None, 1)
+        assert policy.send_simple(TEST_GOOD_ADDRESS + 2, None, 1)
+
+        # Interleaved series are each thinned, not starved
+        policy.keep_ratio = 0.5
+        results = [ policy.send_simple(TEST_GOOD_ADDRESS + 2 + 2 * (i % 2), None, i) for i in range(200) ]
+        assert 49 <= results[0::2].count(True) <= 51 and 49 <= results[1::2].count(True) <= 51
+
+        # Age is counted from when the spool file was opened
+        policy.keep_ratio = 1.0
+        policy.rotate_seconds = 60
+        assert policy.send_simple(TEST_GOOD_ADDRESS, None, 1) and policy.rotations == 0
+        marq.points.opened -= 120
+        assert policy.send_simple(TEST_GOOD_ADDRESS, None, 1) and policy.rotations == 1
+        policy.close()
+
+        with RAISES(ValueError):
+            SpoolPolicy(marq, backlog_high_water=10, backlog_limit=10)
+    finally:
+        shutil.rmtree(spool_dir)
+
+
+def test_session():
+    """Exercise context manager support, flush and session."""
+    with Marquise(TEST_GOOD_NAMESPACE, debug=DEBUG) as marq:
+        with marq.session(durable=True) as session:
+            assert session is marq
+            assert marq.send_simple(TEST_GOOD_ADDRESS, None, 42)
+            assert marq.update_source(TEST_GOOD_ADDRESS, TEST_GOOD_SOURCE_DICT)
+        marq.flush()
+        marq.flush(durable=True)
+        with RAISES(KeyError):
+            with marq.session():
+                raise KeyError("the block's exception isn't swallowed")
+    assert marq.marquise_ctx is None
+    with RAISES(ValueError):
+        marq.flush()
+    with RAISES(ValueError):
+        with marq.session():
+            pass
+
+    spool_dir = tempfile.mkdtemp()
+    try:
+        with NativeMarquise(TEST_GOOD_NAMESPACE, debug=DEBUG, spool_dir=spool_dir) as native:
+            with native.session(durable=True):
+                assert native.send_simple(TEST_GOOD_ADDRESS, 1, 42)
+                assert os.path.getsize(native.spool_path_points) == 0
+            assert list(spool.iter_points(native.spool_path_points)) == [(TEST_GOOD_ADDRESS & ~1, 1, 42)]
+        assert native.closed
+        with RAISES(ValueError):
+            with native.session():
+                pass
+    finally:
+        shutil.rmtree(spool_dir)
+
+
+def test_source_identifier():
+    """Check SourceIdentifier builds canonical identifiers, and that its
+    address and source dict match the handle's.
+    """
+    source = SourceIdentifier({'service': "memory", 'metric': "BytesUsed", 'hostname': "fe1.example.com"})
+    assert source.identifier == TEST_IDENTIFIER
+    assert source.encoded == TEST_IDENTIFIER.encode('utf8')
+    assert source.address == Marquise.hash_identifier(TEST_IDENTIFIER)
+    assert source.metadata == {'service': "memory", 'metric': "BytesUsed", 'hostname': "fe1.example.com"}
+    assert SourceIdentifier.parse(TEST_SOURCE1).identifier == TEST_SOURCE1
+    assert SourceIdentifier.parse("service:memory,hostname:fe1.example.com,metric:BytesUsed,") == source
+    assert len(set([source, SourceIdentifier.parse(TEST_IDENTIFIER)])) == 1
+
+    # The address is the source dict's digest, whatever the key order
+    assert SourceIdentifier(TEST_GOOD_SOURCE_DICT).address == Marquise.source_digest(TEST_GOOD_SOURCE_DICT)
+    assert SourceIdentifier(TEST_GOOD_SOURCE_DICT_NONE_VAL).address == Marquise.source_digest(TEST_GOOD_SOURCE_DICT_NONE_VAL)
+    unicode_source = SourceIdentifier([(u"metric", u"caf\u00e9"), ("port", 80)])
+    assert unicode_source.identifier == u"metric:caf\u00e9,port:80,"
+    assert unicode_source.address == Marquise.hash_identifier(u"metric:caf\u00e9,port:80,")
+
+    for bad in (TEST_BAD_SOURCE_DICT_COLON_KEY, TEST_BAD_SOURCE_DICT_COLON_VAL, {'a,b': "c"}, {'': "c"}):
+        with RAISES(ValueError):
+            SourceIdentifier(bad)
+    with RAISES(ValueError):
+        SourceIdentifier.parse("metric,")
+
+    sources = [ SourceIdentifier({'metric': "m%d" % i}) for i in range(5) ]
+    assert sources[2].address
+    assert SourceIdentifier.resolve(sources) == Marquise.hash_identifiers([ "metric:m%d," % i for i in range(5) ])
+
+    spool_dir = tempfile.mkdtemp()
+    try:
+        marq = NativeMarquise(TEST_GOOD_NAMESPACE, debug=DEBUG, spool_dir=spool_dir, source_cache=10)
+        assert source.update_source(marq)
+        assert source.update_source(marq)
+        assert source.update_source(marq, force=True)
+        assert marq.send_simple(source.address, 1, 2)
+        marq.close()
+        assert list(spool.iter_sources(marq.spool_path_contents)) == [(source.address, source.metadata)]
+    finally:
+        shutil.rmtree(spool_dir)
+
+
+def test_clock():
+    """Check timestamps are whole nanoseconds from the handle's clock."""
+    before = time.time()
+    timestamp = Marquise.current_timestamp()
+    assert isinstance(timestamp, int)
+    assert int(before * 1000000000) - 1000000 <= timestamp <= int(time.time() * 1000000000) + 1000000
+    assert NativeMarquise.current_timestamp() >= timestamp
+    stamps = Clock().stamp(3)
+    assert stamps.typecode == 'Q' and len(stamps) == 3 and stamps[0] == stamps[2] >= timestamp
+
+    clock = CoarseClock(tick=60, start=False)
+    first = clock.now()
+    assert clock.now() == first and list(clock.stamp(2)) == [first, first]
+    clock._now += 10**18 # pylint: disable=protected-access
+    clock.update()
+    assert clock.now() == first + 10**18, "a coarse clock mustn't go backwards"
+    clock.close()
+    with RAISES(ValueError):
+        CoarseClock(tick=0)
+
+    spool_dir = tempfile.mkdtemp()
+    try:
+        fixed = CoarseClock(tick=60, start=False)
+        marq = NativeMarquise(TEST_GOOD_NAMESPACE, debug=DEBUG, spool_dir=spool_dir, clock=fixed)
+        assert marq.current_timestamp() == fixed.now()
+        marq.send_simple(TEST_GOOD_ADDRESS, None, 1)
+        marq.send_simple_many([TEST_GOOD_ADDRESS], None, [2])
+        marq.close()
+        assert [ timestamp for _, timestamp, _ in spool.iter_points(marq.spool_path_points) ] == [fixed.now()] * 2
+
+        ticking = CoarseClock(tick=0.001)
+        marq = Marquise(TEST_GOOD_NAMESPACE, debug=DEBUG, clock=ticking)
+        first = marq.current_timestamp()
+        deadline = time.time() + 5
+        while marq.current_timestamp() == first and time.time() < deadline:
+            time.sleep(0.01)
+        assert marq.current_timestamp() > first
+        marq.close()
+        ticking.close()
+        ticking.close()
+    finally:
+        shutil.rmtree(spool_dir)
+
+
+def test_consume():
+    """Stream datapoints of every form through Marquise.consume."""
+    spool_dir = tempfile.mkdtemp()
+    try:
+        string_address = NativeMarquise.hash_identifier(TEST_IDENTIFIER)
+        source_address = Marquise.hash_identifier(TEST_IDENTIFIER)
+        dict_address = Marquise.source_digest(TEST_GOOD_SOURCE_DICT)
+        def items():
+            yield (TEST_GOOD_ADDRESS, 10, 1)
+            yield (TEST_IDENTIFIER, 20, 2)
+            yield {'source': TEST_GOOD_SOURCE_DICT, 'timestamp': 30, 'value': b"extended"}
+            yield {'identifier': SourceIdentifier.parse(TEST_IDENTIFIER), 'timestamp': 40, 'value': 3}
+            yield {'address': 0, 'value': u"caf\u00e9"}
+        marq = NativeMarquise(TEST_GOOD_NAMESPACE, debug=DEBUG, spool_dir=spool_dir)
+        reports = []
+        stats = marq.consume(items(), chunk_size=2, progress=reports.append, progress_interval=0)
+        marq.close()
+        assert stats['read'] == 5 and stats['written'] == 5 and stats['sources'] == 3 and stats['batches'] == 3
+        assert reports[-1] == stats and len(reports) == 4
+        points = list(spool.iter_points(marq.spool_path_points))
+        assert [ point for point in points if point[0] & 1 == 0 ] == [(TEST_GOOD_ADDRESS & ~1, 10, 1), (string_address & ~1, 20, 2), (source_address & ~1, 40, 3)]
+        assert (dict_address | 1, 30, b"extended") in points
+        assert [ value for address, _, value in points if address == 1 ] == [u"caf\u00e9".encode('utf8')]
+        sources = dict(spool.iter_sources(marq.spool_path_contents))
+        metadata = SourceIdentifier.parse(TEST_IDENTIFIER).metadata
+        assert sources == {string_address: metadata, source_address: metadata, dict_address: TEST_GOOD_SOURCE_DICT}
+
+        # Identifier strings are hashed as given, sorted or not
+        unsorted = "metric:BytesUsed,hostname:fe1.example.com,"
+        marq = NativeMarquise(TEST_GOOD_NAMESPACE, debug=DEBUG, spool_dir=spool_dir)
+        assert marq.consume([(unsorted, 1, 1), ("cpu.load", 1, 2)])['sources'] == 1
+        assert marq.consume([(unsorted, 2, 3)], update_sources=False)['written'] == 1
+        marq.close()
+        assert list(spool.iter_points(marq.spool_path_points)) == [(marq.hash_identifier(unsorted) & ~1, 1, 1), (marq.hash_identifier("cpu.load") & ~1, 1, 2), (marq.hash_identifier(unsorted) & ~1, 2, 3)]
+        assert dict(spool.iter_sources(marq.spool_path_contents)) == {marq.hash_identifier(unsorted): {'metric': 'BytesUsed', 'hostname': 'fe1.example.com'}}
+
+        # Only a chunk is read ahead, and what came before an error stays written
+        def failing():
+            for i in range(5):
+                yield (TEST_GOOD_ADDRESS, i + 1, i)
+            raise RuntimeError("exporter died")
+        marq = NativeMarquise(TEST_GOOD_NAMESPACE, debug=DEBUG, spool_dir=spool_dir)
+        with RAISES(RuntimeError):
+            marq.consume(failing(), chunk_size=2)
+        marq.close()
+        assert [ value for _, _, value in spool.iter_points(marq.spool_path_points) ] == [0, 1, 2, 3]
+        with RAISES(ValueError):
+            marq.consume([])
+
+        marq = NativeMarquise(TEST_GOOD_NAMESPACE, debug=DEBUG, spool_dir=spool_dir)
+        with RAISES(ValueError):
+            marq.consume([{'timestamp': 1, 'value': 1}])
+        with RAISES(TypeError):
+            marq.consume([(TEST_GOOD_ADDRESS, 1, -1)])
+        marq.close()
+
+        # Stages run in order: filter, dedupe, then aggregate
+        marq = NativeMarquise(TEST_GOOD_NAMESPACE, debug=DEBUG, spool_dir=spool_dir)
+        second = 1000000000
+        points = [ (TEST_GOOD_ADDRESS, i * second, value) for i, value in enumerate([5, 5, 5, 7, 100, 7, 2]) ] + [ (TEST_GOOD_ADDRESS, 3 * second, b"x") ] * 2
+        pipeline = Pipeline(marq, chunk_size=100).filter(lambda point: point[2] != 100).dedupe(heartbeat=60).aggregate(window=4, how='sum')
+        stats = pipeline.run(points)
+        marq.close()
+        assert stats['filtered'] == 1 and stats['suppressed'] == 4 and stats['aggregated'] == 1 and stats['written'] == 3
+        assert sorted(spool.iter_points(marq.spool_path_points)) == [(TEST_GOOD_ADDRESS & ~1, 0, 12), (TEST_GOOD_ADDRESS & ~1, 4 * second, 2), (TEST_GOOD_ADDRESS | 1, 3 * second, b"x")]
+
+        with RAISES(ValueError):
+            Pipeline(marq).aggregate(window=10, how='median')
+        with RAISES(ValueError):
+            Pipeline(marq, chunk_size=0)
+
+        marq = Marquise(TEST_GOOD_NAMESPACE, debug=DEBUG)
+        assert marq.consume(( (TEST_GOOD_ADDRESS, None, i) for i in range(25) ), chunk_size=10)['batches'] == 3
+        marq.close()
+    finally:
+        shutil.rmtree(spool_dir)
+
+
 def test_double_close_okay():
     """Ensure that double-close() is safe, it should be a no-op."""
     marq = Marquise(TEST_GOOD_NAMESPACE, debug=DEBUG)
@@ -217,6 +1575,9 @@ if __name__ == '__main__':
 
     test_yo_dawg_i_heard_you_liek_tests()
     test_hash_identifier()
+    test_hash_identifier_non_ascii()
+    test_hash_identifiers()
+    test_address_cache()
     test_bogus_namespace()
     test_very_very_very_long_namespace()
     test_print_a_marquise_with_debugging()
@@ -224,15 +1585,52 @@ if __name__ == '__main__':
     test_send_simple()
     test_send_simple_after_close()
     test_send_simple_write_failure()
+    test_send_simple_many()
+    test_uint64_buffer()
+    test_send_simple_many_write_failure()
 
     test_send_extended()
     test_send_extended_after_close()
     test_send_extended_write_failure()
+    test_send_extended_binary()
+    test_send_extended_many()
+    test_send_extended_many_write_failure()
 
     test_update_source()
+    test_update_source_cache()
+    test_update_sources()
+    test_update_sources_write_failure()
     test_update_source_after_close()
     test_update_source_write_failure()
 
+    test_tracer()
+    test_write_stats()
+
+    test_aggregator()
+    test_last_value_table()
+    test_dedupe_filter()
+    test_ingestd_parsers()
+    test_ingestd()
+    test_ingestd_limits()
+    test_bulk_loader()
+    test_source_index()
+    test_rotate()
+    test_spool_policy()
+    test_session()
+    test_source_identifier()
+    test_clock()
+    test_consume()
+    test_async_marquise()
+    test_async_marquise_backpressure()
+    test_async_marquise_asyncio()
+    test_marquise_pool()
+    test_fork_gets_new_context()
+    test_shared_ring_buffer()
+    test_siphash24()
+    test_native_marquise()
+    test_native_marquise_conformance()
+    test_spool_reader()
+
     test_double_close_okay()
 
     sys.exit(0)